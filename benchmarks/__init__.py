@@ -0,0 +1 @@
+"""Benchmark suite for bundle_notifications."""
@@ -0,0 +1,152 @@
+"""Seeded generator of synthetic notification streams.
+
+The streams look like the real data: 30-character hex ids, heavy-tailed
+number of events per user and day (most users get a couple of events, a few
+get hundreds), friends that go on several tours a day, and names in many
+scripts. Rows are sorted by time, and the same arguments always give the
+same rows.
+
+Usage::
+
+    python -m benchmarks.generate 1000000 events_1M.csv
+
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Names from the sample dataset, in several scripts
+NAMES = np.array([
+    'Mona', 'Toomas', 'Sean', 'Buse', 'Σωτήριος', '三浦', 'Victoria',
+    'Franciso', 'Λυκάων', 'Δαμιανός', 'Bakos', 'Rozalia', 'Marcu',
+    'Blanduzia', '史', 'Geir', 'Antim', 'Laura', 'Amelia', 'Magdaléna',
+    'Sara', 'Bonifác', 'Rameshwor', 'Ørjan', 'Zoë', 'Łukasz', 'Şule',
+    'Ngọc', 'Дмитрий', 'محمد', 'יעל', 'สมชาย', '하늘', 'さくら'],
+    dtype=object)
+
+
+def hex_ids(values):
+    """30-character hex ids of integers, like the ids of the real data"""
+
+    values = np.asarray(values, dtype=np.uint64)
+    return np.char.mod('%030X', values * np.uint64(2654435761)) \
+        .astype(object)
+
+
+def user_day_sizes(rng, n_rows, alpha=1.3):
+    """Heavy-tailed (Pareto) number of events of each user-day, adding up
+    to n_rows"""
+
+    sizes = []
+    total = 0
+    while total < n_rows:
+        batch = (rng.pareto(alpha, max(n_rows // 4, 16)) + 1).astype(np.int64)
+        sizes.append(batch)
+        total += batch.sum()
+    sizes = np.concatenate(sizes)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), n_rows) + 1]
+    sizes[-1] -= sizes.sum() - n_rows
+
+    return sizes
+
+
+def generate_day(n_rows, day, n_users, seed=0, start='2017-08-01'):
+    """Events of a single day
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of events
+    day : int
+        Day number, from 0
+    n_users : int
+        Number of users in the whole stream
+    seed : int
+        Random seed. Each day uses its own stream of random numbers.
+    start : str
+        Date of day 0
+
+    Returns
+    -------
+    pd.DataFrame
+        Events sorted by time, with the columns
+        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+    """
+
+    rng = np.random.default_rng([seed, day])
+    sizes = user_day_sizes(rng, n_rows)
+
+    # Users of each user-day and of each event
+    user = np.repeat(rng.integers(0, n_users, len(sizes)), sizes)
+
+    # Each user has a pool of friends. Some friends are much more active
+    # (Zipf), so the same friend appears several times in a day.
+    friend = user * 97 + np.minimum(rng.zipf(1.6, n_rows), 97) - 1
+
+    seconds = rng.integers(0, 86400, n_rows)
+    order = np.argsort(seconds, kind='stable')
+    timestamp = pd.Timestamp(start) + pd.Timedelta(days=day) + \
+        pd.to_timedelta(seconds[order], unit='s')
+
+    return pd.DataFrame({'timestamp': timestamp,
+                         'user_id': hex_ids(user[order]),
+                         'friend_id': hex_ids(friend[order] + n_users),
+                         'friend_name': NAMES[friend[order] % len(NAMES)]})
+
+
+def iter_days(n_rows, n_days=30, events_per_user=50, seed=0):
+    """Generates a stream day by day, so that large streams never have to
+    fit in memory
+
+    Parameters
+    ----------
+    n_rows : int
+        Total number of events
+    n_days : int
+        Number of days
+    events_per_user : int
+        Average number of events of a user in the whole stream
+    seed : int
+        Random seed
+
+    Yields
+    ------
+    pd.DataFrame
+        Events of each day, see ``generate_day``
+    """
+
+    n_users = max(n_rows // events_per_user, 1)
+    rows = np.full(n_days, n_rows // n_days)
+    rows[:n_rows % n_days] += 1
+    for day, n in enumerate(rows):
+        if n > 0:
+            yield generate_day(n, day, n_users, seed=seed)
+
+
+def generate_events(n_rows, n_days=30, events_per_user=50, seed=0):
+    """Synthetic stream of events, see ``iter_days``
+
+    Returns
+    -------
+    pd.DataFrame
+        Events sorted by time, with the columns
+        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+    """
+
+    return pd.concat(iter_days(n_rows, n_days, events_per_user, seed),
+                     ignore_index=True)
+
+
+def write_csv(path, n_rows, n_days=30, events_per_user=50, seed=0):
+    """Writes a synthetic stream to a headerless csv file, like the input
+    of ``load_data``"""
+
+    mode = 'w'
+    for df in iter_days(n_rows, n_days, events_per_user, seed):
+        df.to_csv(path, header=False, index=False, mode=mode)
+        mode = 'a'
+
+
+if __name__ == "__main__":
+    write_csv(sys.argv[2], int(float(sys.argv[1])))
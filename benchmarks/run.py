@@ -0,0 +1,243 @@
+"""Runs the benchmarks and appends the results to a JSON lines file.
+
+Each target is run at each scale point in a fresh process, so that the peak
+resident memory (RSS) of the process only includes that run. Numba kernels
+are compiled on a small stream before timing, except for the ``cli`` target
+which measures the command as a user runs it. Input files are generated
+once with ``benchmarks.generate`` and kept in the data directory.
+
+Usage::
+
+    python -m benchmarks.run --sizes 1e4,1e5,1e6
+    python -m benchmarks.run --sizes 1e7,5e7 --targets bundle,cli
+    python -m benchmarks.run --compare
+
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Default scale points, in rows. 1e7 and 5e7 are supported but slow and
+# need several GB of disk for the inputs.
+SIZES = [10**4, 10**5, 10**6]
+
+TARGETS = ('load_data', 'local_search', 'count_tours_per_notif', 'bundle',
+           'cli')
+
+
+def git_commit():
+    """Short hash of the commit being measured, if any"""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def input_path(data_dir, n_rows, seed):
+    """Generates the input csv of a scale point, unless it already exists"""
+
+    path = os.path.join(data_dir, f'events_{n_rows}_{seed}.csv')
+    if not os.path.exists(path):
+        generate.write_csv(path + '.tmp', n_rows, seed=seed)
+        os.replace(path + '.tmp', path)
+
+    return path
+
+
+def big_segments(events, k=4):
+    """Timestamps and friend codes of the (user, day) segments with more than
+    k events, the ones that need a schedule"""
+
+    from bundle_notifications import segments
+
+    day = events.timestamp // segments.DAY_NS
+    order = segments.segment_order(events.user_code, day, events.timestamp)
+    timestamp = events.timestamp[order]
+    friend_code = events.friend_code[order]
+    offsets = segments.segment_offsets(events.user_code[order], day[order])
+
+    return [(timestamp[a:b], friend_code[a:b])
+            for a, b in zip(offsets[:-1], offsets[1:]) if b - a > k]
+
+
+def run_load_data(path):
+    from bundle_notifications.bundle_notifications import load_data
+
+    start = time.perf_counter()
+    load_data(path, compact=True)
+    return time.perf_counter() - start
+
+
+def run_local_search(path):
+    from bundle_notifications.bundle_notifications import load_data
+    from bundle_notifications.optimal_delay import local_search
+
+    seg = big_segments(load_data(path, compact=True))
+    local_search(np.arange(10, dtype=np.int64))  # compile
+
+    start = time.perf_counter()
+    for timestamp, _ in seg:
+        local_search(timestamp)
+    return time.perf_counter() - start
+
+
+def run_count_tours_per_notif(path):
+    from bundle_notifications.bundle_notifications import (
+        add_notif_counter, count_tours_per_notif, load_data)
+    from bundle_notifications.optimal_delay import local_search
+
+    seg = big_segments(load_data(path, compact=True))
+    counters = [add_notif_counter(local_search(t)) for t, _ in seg]
+    names = np.zeros(max([len(t) for t, _ in seg], default=0), dtype=object)
+    count_tours_per_notif(np.ones(1, dtype=int), np.zeros(1, dtype=int),
+                          names[:1], np.zeros(1, dtype=np.int64))  # compile
+
+    start = time.perf_counter()
+    for (timestamp, friend_code), counter in zip(seg, counters):
+        count_tours_per_notif(counter, friend_code, names[:len(timestamp)],
+                              timestamp)
+    return time.perf_counter() - start
+
+
+def run_bundle(path):
+    from bundle_notifications.bundle_notifications import bundle, load_data
+
+    bundle(load_data(path, compact=True, nrows=1000))  # compile
+    events = load_data(path, compact=True)
+
+    start = time.perf_counter()
+    bundle(events, render=False)
+    return time.perf_counter() - start
+
+
+def run_cli(path):
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'bundle_notifications.cli',
+                        '-p', path, '-o', os.path.join(directory, 'out.csv'),
+                        '-n', '0'], check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+
+def measure(target, path, results):
+    """Runs a target in the current (child) process and reports its time and
+    peak memory"""
+
+    seconds = globals()['run_' + target](path)
+    rusage = resource.RUSAGE_CHILDREN if target == 'cli' \
+        else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux
+    results.put((seconds, resource.getrusage(rusage).ru_maxrss / 1024))
+
+
+def run(target, path, n_rows):
+    """Runs a target in a fresh process
+
+    Returns
+    -------
+    dict
+        Result record, as written to the results file
+    """
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=measure, args=(target, path, results))
+    process.start()
+    while True:
+        try:
+            seconds, peak_rss_mb = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f'Benchmark {target} failed')
+    process.join()
+
+    return {'target': target, 'rows': n_rows, 'seconds': round(seconds, 4),
+            'rows_per_second': round(n_rows / seconds),
+            'peak_rss_mb': round(peak_rss_mb, 1)}
+
+
+def compare(results_path):
+    """Prints the throughput of the last run of each benchmark against the
+    previous one"""
+
+    last = {}
+    previous = {}
+    with open(results_path) as f:
+        for line in f:
+            record = json.loads(line)
+            key = (record['target'], record['rows'])
+            if key in last:
+                previous[key] = last[key]
+            last[key] = record
+
+    for key in sorted(last):
+        old = previous.get(key)
+        ratio = last[key]['rows_per_second'] / old['rows_per_second'] \
+            if old else float('nan')
+        print(f'{key[0]:<22} {key[1]:>10} rows '
+              f'{last[key]["rows_per_second"]:>12} rows/s '
+              f'{last[key]["peak_rss_mb"]:>8} MB  x{ratio:.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='Comma-separated scale points, in rows')
+    parser.add_argument('--targets', default=','.join(TARGETS),
+                        help='Comma-separated targets: ' + ', '.join(TARGETS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data_dir', default=os.path.join(HERE, 'data'),
+                        help='Directory of the generated inputs')
+    parser.add_argument('--output', default=os.path.join(HERE,
+                                                         'results.jsonl'),
+                        help='Results file, one JSON record per line')
+    parser.add_argument('--compare', action='store_true',
+                        help='Only compare the last two runs of the results')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(args.output)
+
+    targets = args.targets.split(',')
+    for target in targets:
+        if target not in TARGETS:
+            parser.error(f'Target not recognized: {target}')
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    context = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'commit': git_commit(), 'python': platform.python_version(),
+               'machine': platform.machine(), 'cpus': os.cpu_count(),
+               'seed': args.seed}
+
+    for n_rows in (int(float(s)) for s in args.sizes.split(',')):
+        path = input_path(args.data_dir, n_rows, args.seed)
+        for target in targets:
+            record = dict(context, **run(target, path, n_rows))
+            print(f'{target:<22} {n_rows:>10} rows {record["seconds"]:>9}s '
+                  f'{record["rows_per_second"]:>12} rows/s '
+                  f'{record["peak_rss_mb"]:>8} MB')
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,79 @@
 """Main module."""
+import functools
+import time
+
 import pandas as pd
 import numpy as np
 
-from .optimal_delay import local_search
+from . import cache as cache_module
+from . import cleaning, database, parallel, segments, store
+from .events import EventTable
+from .messages import ENGLISH, render_messages
+from .metrics import Metrics
+from .optimal_delay import AUTO, AUTO_THRESHOLDS, SOLVERS, auto_solvers, \
+    optimal_schedule, solver_id
+
+# Columns of the input data
+COLUMNS = ['timestamp', 'user_id', 'friend_id', 'friend_name']
+
+# Rows rendered at once when writing messages to csv
+RENDER_BLOCK = 100000
+
+# How the maximum number of notifications is enforced: per calendar day, or
+# over any rolling 24-hour window
+WINDOWS = ('calendar', 'rolling')
+
+# Segments scheduled per call of the compiled kernel, so that the progress
+# of long runs can be reported
+SOLVE_BLOCK = 20000
+
+# File extensions of the columnar formats. Anything else is read as csv.
+FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather',
+           '.arrow': 'feather', '.ipc': 'feather'}
+
+
+def file_format(path):
+    """Guesses the format of a file from its extension
+
+    Parameters
+    ----------
+    path : str
+        Path or url to the file
+
+    Returns
+    -------
+    str
+        ``'parquet'``, ``'feather'`` (Arrow IPC), ``'sqlite'`` for SQLite
+        URLs (see ``database.parse_url``), ``'store'`` for directories
+        written by ``store.write_store`` or ``'csv'``
+    """
+
+    if database.is_database_url(path):
+        return 'sqlite'
+    if store.is_store(path):
+        return 'store'
+
+    for extension, fmt in FORMATS.items():
+        if str(path).lower().endswith(extension):
+            return fmt
 
+    return 'csv'
 
-def load_data(path_csv, nrows=None):
+
+def load_data(path_csv, nrows=None, friend_codes=False, chunksize=None,
+              compact=False):
     """Loads the notification csv file
 
+    Parquet and Feather/Arrow IPC files are also supported, see
+    ``file_format``. They are expected to contain the columns
+    ``'timestamp','user_id','friend_id','friend_name'``, and only those
+    columns are read from disk.
+
+    Events can also be read from the table of a SQLite database, with a URL
+    like ``sqlite:///events.db?table=events``. They are fetched in time
+    order, see ``database.stream_events``. Binary stores written by
+    ``bundle_notifications convert`` are memory-mapped, see ``store``.
+
     Parameters
     ----------
     path_csv : str
@@ -18,6 +84,23 @@ def load_data(path_csv, nrows=None):
         Number of rows of file to read. Useful for reading pieces of large
         files or for testing this function.
 
+    friend_codes : bool, optional
+        If True, add a 'friend_code' column with the friend ids factorized
+        to dense int32 codes. It is used by ``bundle`` and
+        ``count_tours_per_notif`` instead of hashing the id strings.
+
+    chunksize : int, optional
+        If given, return an iterator of DataFrames of chunksize rows instead
+        of reading the whole file. See ``streaming.bundle_stream``. Friend
+        codes are not available in this mode, since they would not be
+        consistent across chunks.
+
+    compact : bool, optional
+        If True, return an ``events.EventTable`` instead of a DataFrame:
+        integer timestamps and int32 codes for users, friends and names,
+        about 20 bytes per event. Strings are parsed as categories, so the
+        full DataFrame of strings is never built.
+
     Returns
     -------
     pd.DataFrame
@@ -26,13 +109,169 @@ def load_data(path_csv, nrows=None):
         The column named 'timestamp' is cast as a datetime64[ns] type.
     """
 
-    df = pd.read_csv(path_csv, sep=",", header=None, names=[
-        'timestamp', 'user_id', 'friend_id', 'friend_name'],
-        parse_dates=['timestamp'], nrows=nrows)
+    if chunksize is not None and (friend_codes or compact):
+        raise ValueError('friend_codes and compact are not supported with '
+                         'chunksize')
+
+    fmt = file_format(path_csv)
+    if fmt == 'store':
+        if chunksize is not None:
+            raise ValueError('Stores are sorted by user, not by time, and '
+                             'cannot be read in chunks')
+        events = store.open_store(path_csv)
+        if nrows is not None:
+            events = events.take(slice(0, nrows))
+        if compact:
+            return events
+        df = events.to_frame()
+    elif fmt == 'parquet' and chunksize is not None:
+        return load_parquet_chunks(path_csv, chunksize)
+    elif fmt == 'feather' and chunksize is not None:
+        return load_feather_chunks(path_csv, chunksize)
+    elif fmt == 'sqlite' and chunksize is not None:
+        return database.stream_url(path_csv, chunksize=chunksize, nrows=nrows)
+    elif fmt == 'sqlite':
+        connection, table = database.connect_url(path_csv, 'events')
+        df = database.read_events(connection, table, nrows=nrows)
+        connection.close()
+    elif fmt == 'parquet':
+        df = pd.read_parquet(path_csv, columns=COLUMNS)
+    elif fmt == 'feather':
+        df = pd.read_feather(path_csv, columns=COLUMNS)
+    else:
+        dtype = {c: 'category' for c in COLUMNS[1:]} if compact else None
+        df = pd.read_csv(path_csv, sep=",", header=None, names=COLUMNS,
+                         parse_dates=['timestamp'], nrows=nrows,
+                         chunksize=chunksize, dtype=dtype)
+
+    if fmt in FORMATS.values():
+        df = df.head(nrows) if nrows is not None else df
+        df['timestamp'] = df.timestamp.astype('datetime64[ns]')
+
+    if compact:
+        return EventTable.from_frame(df)
+
+    if friend_codes:
+        df['friend_code'] = pd.factorize(df.friend_id)[0].astype(np.int32)
 
     return df
 
 
+def load_parquet_chunks(path, chunksize):
+    """Reads a Parquet file in chunks, without loading it whole
+
+    Parameters
+    ----------
+    path : str
+        Path to the Parquet file
+    chunksize : int
+        Maximum number of rows per chunk
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks with the columns ``'timestamp','user_id','friend_id',
+        'friend_name'``
+    """
+
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize,
+                                                   columns=COLUMNS):
+        df = batch.to_pandas()
+        df['timestamp'] = df.timestamp.astype('datetime64[ns]')
+        yield df
+
+
+def load_feather_chunks(path, chunksize):
+    """Reads a Feather/Arrow IPC file in chunks, without loading it whole
+
+    The file is memory-mapped and its record batches are read one at a
+    time, so only one batch is decompressed at once. Batches larger than
+    chunksize are split.
+
+    Parameters
+    ----------
+    path : str
+        Path to the Feather file (version 2, i.e. Arrow IPC)
+    chunksize : int
+        Maximum number of rows per chunk
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks with the columns ``'timestamp','user_id','friend_id',
+        'friend_name'``
+    """
+
+    import pyarrow as pa
+
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        columns = [reader.schema.get_field_index(c) for c in COLUMNS]
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            batch = pa.RecordBatch.from_arrays(
+                [batch.column(c) for c in columns], COLUMNS)
+            for start in range(0, batch.num_rows, chunksize):
+                df = batch.slice(start, chunksize).to_pandas()
+                df['timestamp'] = df.timestamp.astype('datetime64[ns]')
+                yield df
+
+
+def save_data(df, path, templates=ENGLISH, metrics=None):
+    """Saves the bundled notifications. The format is chosen from the
+    extension of path, see ``file_format``.
+
+    In Parquet and Feather/Arrow IPC files, the repetitive 'receiver_id' and
+    'message' columns are dictionary-encoded. With a SQLite URL, the rows of
+    the table are replaced, see ``database.write_notifications``.
+
+    Messages of notifications bundled with ``render=False`` are rendered
+    here, in blocks of rows when writing csv.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Bundled notifications, e.g. the output of ``bundle``
+    path : str
+        Output path
+    templates : messages.MessageTemplates
+        Templates used to render the messages, if needed
+    metrics : metrics.Metrics, optional
+        Records the time of the 'render' and 'write' stages
+    """
+
+    metrics = metrics or Metrics()
+
+    fmt = file_format(path)
+    if fmt == 'sqlite':
+        connection, table = database.connect_url(path, 'notifications')
+    if fmt in ('csv', 'sqlite'):
+        for i in range(0, max(len(df), 1), RENDER_BLOCK):
+            with metrics.stage('render'):
+                block = render_messages(df.iloc[i:i+RENDER_BLOCK], templates)
+            with metrics.stage('write'):
+                if fmt == 'csv':
+                    block.to_csv(path, index=False, header=i == 0,
+                                 mode='w' if i == 0 else 'a')
+                else:
+                    database.write_notifications(block, connection, table,
+                                                 replace=i == 0)
+        if fmt == 'sqlite':
+            connection.close()
+        return
+
+    with metrics.stage('render'):
+        df = render_messages(df, templates)
+        df = df.astype({'receiver_id': 'category', 'message': 'category'})
+    with metrics.stage('write'):
+        if fmt == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(path)
+
+
 def create_message(tours, name_first):
     """Returns the notification message as a numpy array
 
@@ -46,15 +285,11 @@ def create_message(tours, name_first):
     Returns
     -------
     np.array
-        array with the message like "Mona and 12 others went on a tour"
+        array with the message like "Mona and 12 others went on a tour",
+        rendered with ``messages.ENGLISH``
     """
-    # Allocate solution
-    message_array = np.empty(len(tours), dtype='<U256')
-
-    for i, (t, n) in enumerate(zip(tours, name_first)):
-        message_array[i] = create_message_single(t, n)
 
-    return message_array
+    return ENGLISH.render(tours, name_first)
 
 
 def create_message_single(t, n):
@@ -122,20 +357,20 @@ def add_notif_counter(x):
     Parameters
     ----------
     x : np.array of int
-        Array of length 4 with. Each element is an index, indicating the
-        timestamp when the notification should be sent.
+        Array of length k (usually 4). Each element is an index, indicating
+        the timestamp when the notification should be sent.
         Example: ``x = np.array([0,1,2,5])``
 
     Returns
     -------
     np.array of int
-        Numpy array containing a counter, starting from 1 up to 4
+        Numpy array containing a counter, starting from 1 up to len(x)
     """
     notification_counter = np.zeros(x[-1]+1, dtype='int')
-    notification_counter[:x[0]+1] = 1
-    notification_counter[x[0]+1:x[1]+1] = 2
-    notification_counter[x[1]+1:x[2]+1] = 3
-    notification_counter[(x[2]+1):] = 4
+    start = 0
+    for i, end in enumerate(x):
+        notification_counter[start:end+1] = i + 1
+        start = end + 1
 
     return notification_counter
 
@@ -156,23 +391,25 @@ def count_tours_per_notif(notification_counter, friend_id, friend_name,
 
     - As an input, we have a dataset filtered by user_id and day of the year
     - Each of the inputs of this function are numpy arrays, corresponding to a
-      column of the dataset. Doing basic in numpy is much faster, especially if
-      we manage to use a @jit compilator (TODO)
+      column of the dataset. Friend ids are converted to integer codes, so
+      that the counting is done by the compiled ``segments.count_tours``
     - Let us call the solution _tours_. For each element in friend_id we do:
         - Start tours = 1 at iteration i=0
         - We add tours += 1 if the friend_id is new.
         - We continue until i in notification_counter
             - Reset tours = 1
-            - Keep track of the name and timestamp of the first element
-                (name_first,timestamp_first_tour)
+            - Keep track of the index of the first element, to get the name
+                and timestamp (name_first,timestamp_first_tour)
 
     Parameters
     ----------
     notification_counter : np.array
         notification counter. Could be the output of an optimal_delay method.
         For example, ``np.array([1,2,3,10])`` for a 10 element array
-    friend_id : np.array of str
-        array containing names of the friends
+    friend_id : np.array of str or int
+        array containing the ids of the friends. Integer codes, like the
+        ``friend_code`` column of ``load_data(..., friend_codes=True)``, are
+        used as they are.
     friend_name : np.array of str
         array containing names of the friends
     timestamp: np.array of datetime64[ns]
@@ -183,71 +420,37 @@ def count_tours_per_notif(notification_counter, friend_id, friend_name,
     tours : np.array of int
         Count of the number of tours done since the last notification was sent,
         for unique friends-id
-    name_first : np.array of <U256
+    name_first : np.array of str
         Names of the friend who first did a tour since the last notification
         was sent.
-        len(name_first) <=4
+        ``len(name_first) == notification_counter[-1]``, usually 4
     timestamp_first_tour : np.array of datetime64[ns]
         Timestamp of the first tour done by a friend, since the last
         notification was sent.
-        ``len(timestamp_first_tour) <=4``
+        ``len(timestamp_first_tour) == notification_counter[-1]``
     message : np.array of np.array of <U256
         Message to be sent.
-        ``len(message) <= 4``
+        ``len(message) == notification_counter[-1]``
     """
-    # Allocate solution
-    N = len(notification_counter)
-    tours = np.zeros(N, dtype='int')
-    tours_counter = 1
-
-    message = np.empty(4, dtype='<U256')
 
-    # First name and timestamp is always kept
-    name_first = np.empty(4, dtype='<U256')
-    name_first[0] = friend_name[0]
+    friend_id = np.asarray(friend_id)
+    if friend_id.dtype.kind not in 'iu':
+        friend_id, _ = pd.factorize(friend_id)
 
-    timestamp_first_tour = np.zeros(4, dtype='datetime64[ns]')
-    timestamp_first_tour[0] = timestamp[0]
+    tours, first_idx = segments.count_tours(
+        np.asarray(notification_counter, dtype=np.int64),
+        friend_id.astype(np.int32, copy=False))
 
-    # Aux counter and hash table
-    prev_counter = notification_counter[0]  # == 1
-    frend_id_hash = set({friend_id[0]})
-
-    for i in range(0, N):
-
-        if prev_counter == notification_counter[i]:
-            # do the counting
-            if friend_id[i] not in frend_id_hash:
-                # New friend. Add one more tour
-                tours_counter += 1
-                # Add friend to set
-                frend_id_hash.add(friend_id[i])
-            tours[i] = tours_counter
-
-        else:
-            # Create message
-            message[prev_counter-1] = create_message_single(
-                tours_counter, name_first[prev_counter-1])
-
-            # Keep name and timestamp of reset index (aka, first friend)
-            name_first[prev_counter] = friend_name[i]
-            timestamp_first_tour[prev_counter] = timestamp[i]
-
-            # Reset
-            prev_counter = notification_counter[i]
-            frend_id_hash = set({friend_id[i]})
-            tours_counter = 1
-            tours[i] = 1
-
-    # Final message
-    message[prev_counter - 1] = \
-        create_message_single(tours_counter, name_first[prev_counter-1])
+    # Tours of each notification are counted at its last event
+    last_idx = np.append(first_idx[1:] - 1, len(tours) - 1)
+    name_first = np.asarray(friend_name)[first_idx]
+    message = create_message(tours[last_idx], name_first)
 
     # END
-    return tours, name_first, timestamp_first_tour, message
+    return tours, name_first, np.asarray(timestamp)[first_idx], message
 
 
-def bundle_func(df_g):
+def bundle_func(df_g, max_notifications=4, solver='local_search'):
     """Bundles notifications for a user_id
 
     This function is meant to be used after a pandas grouping
@@ -258,6 +461,11 @@ def bundle_func(df_g):
     df_g : pd.DataFrame
         DataFrame containing 4 columns: ``['timestamp', 'user_id', 'friend_id',
         'friend_name']``
+    max_notifications : int
+        Maximum number of notifications sent per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
 
     Returns
     -------
@@ -268,7 +476,7 @@ def bundle_func(df_g):
     """
 
     # Always send if less than 4 notifications per day
-    if df_g.shape[0] <= 4:
+    if df_g.shape[0] <= max_notifications:
 
         df_g['notification_bool'] = True
         df_g['tours'] = 1
@@ -280,7 +488,8 @@ def bundle_func(df_g):
     else:
 
         # Calculate best times to send notification
-        x = local_search(df_g.timestamp_ns.to_numpy())
+        x = optimal_schedule(df_g.timestamp_ns.to_numpy(),
+                             k=max_notifications, solver=solver)
 
         # Add up an indicator whether the notification is sent at those times
         df_g['notification_counter'] = add_notif_counter(x)
@@ -290,7 +499,8 @@ def bundle_func(df_g):
         # first element in the notification counter
         df_g['tours'], name_first, timestamp_first_tour, message = \
             count_tours_per_notif(df_g.notification_counter.to_numpy('int'),
-                                  df_g.friend_id.to_numpy(),
+                                  df_g.get('friend_code', df_g.friend_id)
+                                  .to_numpy(),
                                   df_g.friend_name.to_numpy(),
                                   df_g.timestamp.to_numpy())
 
@@ -306,14 +516,52 @@ def bundle_func(df_g):
     return df_g
 
 
-def bundle(df):
+def bundle(df, max_notifications=4, solver='local_search',
+           engine='segments', n_jobs=1, render=True, metrics=None,
+           window='calendar', cache=None, dedup=None):
     """Bundles the motifications given a pd.dataFrame of events
 
     Parameters
     ----------
-    df : pd.DataFrame
+    df : pd.DataFrame or events.EventTable
         DataFrame containing 4 columns:
-        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``, or the same
+        events in compact form, see ``load_data(..., compact=True)``
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule: ``'local_search'`` (heuristic),
+        ``'dp'`` or ``'enumerate'`` (exact), ``'bucketed'`` (approximate,
+        linear time), or ``'auto'`` to choose one for each user-day from its
+        number of events. See ``optimal_delay.optimal_schedule``
+    engine : str
+        ``'segments'`` (default) sorts the events once and bundles all the
+        (user, day) segments in compiled code, see ``bundle_segments``.
+        ``'pandas'`` uses a groupby-apply of ``bundle_func``: it is much
+        slower, adds auxiliary columns to df and groups by day of the year.
+        It is kept for reference.
+    n_jobs : int
+        Number of processes used by the ``'segments'`` engine. Users are
+        split in shards by a stable hash of their id, see ``parallel``.
+    render : bool
+        If False, the ``'segments'`` engine returns a categorical
+        'name_first' column instead of the 'message' text. Messages are then
+        rendered when needed by ``messages.render_messages`` or
+        ``save_data``.
+    metrics : metrics.Metrics, optional
+        Records stage times and counters of the ``'segments'`` engine
+    window : str
+        ``'calendar'`` (default) sends at most max_notifications per user and
+        calendar day. ``'rolling'`` sends at most max_notifications in any
+        24-hour window, so that a user cannot get them all late in a day
+        and again early the next day. See ``bundle_events``.
+    cache : cache.ResultCache, optional
+        Persistent cache of schedules. Only segments that are not in the
+        cache are solved. See ``solve_cached``.
+    dedup : float, optional
+        If given, invalid events and exact duplicates are dropped before
+        bundling, and so are events of the same user and friend at most
+        dedup seconds apart. See ``cleaning.clean_events``.
 
     Returns
     -------
@@ -322,12 +570,30 @@ def bundle(df):
         'timestamp_first_tour', 'tours', 'receiver_id', 'message']``
     """
 
+    if isinstance(df, EventTable):
+        return bundle_events(df, max_notifications=max_notifications,
+                             solver=solver, n_jobs=n_jobs, render=render,
+                             metrics=metrics, window=window, cache=cache,
+                             dedup=dedup)
+    elif engine == 'segments':
+        return bundle_segments(df, max_notifications=max_notifications,
+                               solver=solver, n_jobs=n_jobs, render=render,
+                               metrics=metrics, window=window, cache=cache,
+                               dedup=dedup)
+    elif engine != 'pandas':
+        raise ValueError(f'Engine not recognized: {engine}')
+    elif dedup is not None:
+        raise ValueError('The pandas engine does not support dedup')
+    elif window != 'calendar':
+        raise ValueError('The pandas engine only supports calendar days')
+
     # Create auxiliary columns. Times as int are used for delay calculations.
     df['timestamp_ns'] = df.timestamp.copy().astype("int")
     df['dayofyear'] = df.timestamp.copy().dt.dayofyear
 
     # groypby-apply
-    df = df.groupby(['user_id', 'dayofyear']).apply(bundle_func)
+    df = df.groupby(['user_id', 'dayofyear']).apply(
+        bundle_func, max_notifications=max_notifications, solver=solver)
 
     # Keep interesting columns only
     df.rename(columns={'timestamp': 'notification_sent',
@@ -336,3 +602,504 @@ def bundle(df):
     # END
     return df[['notification_sent', 'timestamp_first_tour', 'tours',
                'receiver_id', 'message']]
+
+
+def bundle_segments(df, max_notifications=4, solver='local_search',
+                    n_jobs=1, render=True, metrics=None, window='calendar',
+                    cache=None, dedup=None):
+    """Bundles the notifications of all users and days at once
+
+    The events are encoded as an ``events.EventTable`` and bundled by
+    ``bundle_events``.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame containing 4 columns:
+        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``.
+        It is not modified.
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes. With more than one, segments are solved by
+        ``parallel.solve_segments_parallel``.
+    render : bool
+        If False, return the 'name_first' column instead of 'message'
+    metrics : metrics.Metrics, optional
+        Records stage times and counters, see ``bundle_events``
+    window : str
+        ``'calendar'`` or ``'rolling'``, see ``bundle_events``
+    cache : cache.ResultCache, optional
+        Persistent cache of schedules, see ``bundle_events``
+    dedup : float, optional
+        Window in seconds to drop duplicate events, see ``bundle_events``
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per notification, sorted by receiver, day and time, with
+        columns ``['notification_sent', 'timestamp_first_tour', 'tours',
+        'receiver_id', 'message']``
+    """
+
+    return bundle_events(EventTable.from_frame(df),
+                         max_notifications=max_notifications, solver=solver,
+                         n_jobs=n_jobs, render=render, metrics=metrics,
+                         window=window, cache=cache, dedup=dedup)
+
+
+def bundle_events(events, max_notifications=4, solver='local_search',
+                  n_jobs=1, render=True, metrics=None, window='calendar',
+                  cache=None, dedup=None):
+    """Bundles the notifications of an ``events.EventTable``
+
+    The events are sorted once by integer (user, day, timestamp) keys, where
+    days are derived from the timestamp so that days of different years are
+    never mixed up. Events that carry their segment offsets, like those of
+    ``store.open_store``, are already sorted and are used as they are, and
+    so are events already sorted by (user, time), which is checked in one
+    pass. Events sorted by time only need a stable sort by user. All
+    the (user, day) segments are then solved by the
+    compiled kernel ``segments.solve_segments`` and the output columns are
+    built at the end.
+
+    Parameters
+    ----------
+    events : events.EventTable
+        Events to bundle. They are not modified.
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes. With more than one, segments are solved by
+        ``parallel.solve_segments_parallel``.
+    render : bool
+        If False, return a categorical 'name_first' column, sharing the
+        dictionary of names of events, instead of the 'message' text. See
+        ``messages.render_messages``.
+    metrics : metrics.Metrics, optional
+        Records the time of the 'keys', 'sort', 'solve', 'tours' and
+        'render' stages, the number of user-days with at most and with more
+        than max_notifications events, a histogram of events per user-day
+        and, for the local search, the number of moves and of early exits
+        (user-days whose initial schedule is already a local optimum).
+        With n_jobs > 1, tours are counted in the 'solve' stage and local
+        search counters are not recorded.
+    window : str
+        ``'calendar'`` (default): segments are (user, day) groups and get at
+        most max_notifications each. ``'rolling'``: segments are the whole
+        history of each user, scheduled in one pass by
+        ``optimal_delay.rolling_schedule`` so that no 24-hour window has
+        more than max_notifications notifications. solver is not used, and
+        counters refer to users instead of user-days.
+    cache : cache.ResultCache, optional
+        Persistent cache of schedules, keyed by the content of each segment
+        and the parameters of the run. Cached segments are not solved
+        again, and new ones are added. Segments with at most
+        max_notifications events are cheaper to solve than to look up, so
+        they are not cached in calendar mode.
+    dedup : float, optional
+        If given, invalid events, exact duplicates and events of the same
+        user and friend at most dedup seconds after the previous one are
+        dropped, like ``cleaning.clean_events(events, burst=dedup)``. It is
+        done on the sorted events, in the 'clean' stage, and the number of
+        events dropped is counted.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per notification, sorted by receiver (in the order of
+        ``events.users``), day and time, with columns
+        ``['notification_sent', 'timestamp_first_tour', 'tours',
+        'receiver_id', 'message']``
+    """
+
+    if window not in WINDOWS:
+        raise ValueError(f'Window not recognized: {window}. '
+                         f'Use one of {list(WINDOWS)}')
+
+    metrics = metrics or Metrics()
+    k = max_notifications
+    window_ns = segments.DAY_NS if window == 'rolling' else 0
+    unit = 'users' if window == 'rolling' else 'user_days'
+
+    if dedup is not None:
+        with metrics.stage('clean'):
+            valid = cleaning.valid_events(events)
+            if not valid.all():
+                events = events.take(np.flatnonzero(valid))
+
+    if events.offsets is not None:
+        # Already sorted and segmented, e.g. memory-mapped from a store
+        by_user, by_time = True, False
+    else:
+        with metrics.stage('sort'):
+            by_user, by_time = segments.presorted(events.user_code,
+                                                  events.timestamp)
+    metrics.setting('input_order', 'user' if by_user else
+                    'time' if by_time else 'none')
+
+    if by_user:
+        # Sorted by (user, time): the arrays are used as they are
+        order = None
+        timestamp_ns = events.timestamp
+        user_code = events.user_code
+        friend_code = events.friend_code
+    else:
+        # Sort once by (user, day, time). Within each user, events sorted
+        # by time are already sorted by day.
+        with metrics.stage('sort'):
+            if by_time:
+                order = np.argsort(events.user_code, kind='stable')
+            else:
+                order = segments.segment_order(
+                    events.user_code, events.timestamp // segments.DAY_NS,
+                    events.timestamp)
+            timestamp_ns = events.timestamp[order]
+            user_code = events.user_code[order]
+            friend_code = events.friend_code[order]
+
+    offsets = events.offsets if window_ns == 0 else None
+    if dedup is not None:
+        # One pass over the sorted events, see cleaning.duplicate_events
+        with metrics.stage('clean'):
+            label = cleaning.duplicate_events(
+                timestamp_ns, user_code, friend_code, len(events.friends),
+                int(dedup * 10**9))
+            cleaning.count_labels(label, np.sum(~valid), metrics)
+            keep = np.flatnonzero(label == cleaning.KEEP)
+            if len(keep) < len(label):
+                order = keep if order is None else order[keep]
+                timestamp_ns = timestamp_ns[keep]
+                user_code = user_code[keep]
+                friend_code = friend_code[keep]
+                offsets = None
+
+    if offsets is None:
+        # Find the (user, day) segments, or a single segment per user in
+        # rolling mode
+        with metrics.stage('keys'):
+            offsets = segments.segment_offsets(
+                user_code, timestamp_ns // segments.DAY_NS if window_ns == 0
+                else np.zeros(len(user_code), dtype=np.int64))
+    starts, ends = offsets[:-1], offsets[1:]
+
+    sizes = np.diff(offsets)
+    metrics.count('events', len(timestamp_ns))
+    metrics.count(unit, len(sizes))
+    metrics.count(unit + '_small', np.sum(sizes <= k))
+    metrics.count(unit + '_large', np.sum(sizes > k))
+    metrics.histogram('events_per_' + unit[:-1], sizes)
+
+    shard = None
+    if n_jobs > 1:
+        shard = parallel.user_shards(events.users, n_jobs)[user_code[starts]]
+    solve = functools.partial(
+        solve_batches, timestamp_ns, friend_code, k=k, solver=solver,
+        n_jobs=n_jobs, window=window_ns, metrics=metrics)
+
+    if cache is None:
+        sent_idx, first_idx, tours = solve(starts, ends, shard=shard)
+    else:
+        # Segments with at most k events are not worth caching
+        sent_idx, first_idx, tours = solve_cached(
+            cache, solve, timestamp_ns,
+            cache_module.friend_hashes(events.friends)[friend_code],
+            starts, ends, cache_module.cache_params(
+                f'{solver}{sorted(AUTO_THRESHOLDS.items())}'
+                if solver == AUTO else solver, k, window_ns),
+            min_events=k + 1 if window_ns == 0 else 1, shard=shard,
+            metrics=metrics)
+    metrics.count('notifications', len(sent_idx))
+
+    # Build the output columns once. Messages are kept as name codes.
+    name_first = pd.Categorical.from_codes(
+        events.name_code[first_idx if order is None else order[first_idx]],
+        categories=pd.Index(events.names, dtype=object))
+
+    df = pd.DataFrame({
+        'notification_sent': timestamp_ns[sent_idx].view('datetime64[ns]'),
+        'timestamp_first_tour':
+            timestamp_ns[first_idx].view('datetime64[ns]'),
+        'tours': tours,
+        'receiver_id': events.users[user_code[sent_idx]],
+        'name_first': name_first})
+
+    if not render:
+        return df
+
+    with metrics.stage('render'):
+        return render_messages(df)
+
+
+def solve_batches(timestamp_ns, friend_code, starts, ends, k=4,
+                  solver='local_search', n_jobs=1, window=0, metrics=None,
+                  shard=None):
+    """Schedules segments of sorted events and counts the tours of each
+    notification
+
+    Parameters
+    ----------
+    timestamp_ns : np.array of int
+        Sorted timestamps, as integers
+    friend_code : np.array of int
+        Dense integer code of the friend of each event
+    starts : np.array of int
+        First event of each segment to solve
+    ends : np.array of int
+        End (excluded) of each segment to solve
+    k : int
+        Maximum number of notifications per segment, or per window
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes. With more than one, segments are solved by
+        ``parallel.solve_segments_parallel``.
+    window : int
+        Length of the rolling window, or 0 for calendar days. See
+        ``segments.schedule_segments``.
+    metrics : metrics.Metrics, optional
+        Records the 'solve' and 'tours' stages, see ``bundle_events``
+    shard : np.array of int, optional
+        Shard of each segment, see ``parallel.user_shards``. Required if
+        n_jobs > 1.
+
+    Returns
+    -------
+    tuple of np.array
+        ``(sent_idx, first_idx, tours)``, see ``segments.solve_segments``
+    """
+
+    metrics = metrics or Metrics()
+    sizes = ends - starts
+
+    if solver == AUTO:
+        return solve_auto(timestamp_ns, friend_code, starts, ends, k=k,
+                          n_jobs=n_jobs, window=window, metrics=metrics,
+                          shard=shard)
+
+    if n_jobs > 1:
+        with metrics.stage('solve'):
+            return parallel.solve_segments_parallel(
+                timestamp_ns, friend_code, starts, ends, shard, k,
+                solver_id(solver), n_jobs, window=window)
+
+    sent_idx, n_iter = [np.empty(0, dtype=np.int64)], []
+    with metrics.stage('solve'), \
+            metrics.progress('Bundling notifications', sizes.sum()) as update:
+        for a in range(0, len(sizes), SOLVE_BLOCK):
+            sent, moves = segments.schedule_segments(
+                timestamp_ns, starts[a:a+SOLVE_BLOCK], ends[a:a+SOLVE_BLOCK],
+                k, solver_id(solver), window)
+            sent_idx.append(sent)
+            n_iter.append(moves)
+            update(sizes[a:a+SOLVE_BLOCK].sum())
+        sent_idx = np.concatenate(sent_idx)
+
+    if solver == 'local_search' and window == 0 and n_iter:
+        n_iter = np.concatenate(n_iter)
+        metrics.count('local_search_moves', n_iter.sum())
+        metrics.count('local_search_early_exits',
+                      np.sum((n_iter == 0) & (sizes > k)))
+
+    with metrics.stage('tours'):
+        first_idx, tours = segments.count_segment_tours(
+            friend_code, starts, ends, sent_idx)
+
+    return sent_idx, first_idx, tours
+
+
+def solve_auto(timestamp_ns, friend_code, starts, ends, k=4, n_jobs=1,
+               window=0, metrics=None, shard=None, thresholds=None):
+    """Like ``solve_batches``, choosing the solver of each segment with
+    ``optimal_delay.auto_solvers``
+
+    Segments are grouped by solver, each group is solved by
+    ``solve_batches`` and the results are merged in the order of the
+    segments.
+
+    Parameters
+    ----------
+    thresholds : dict, optional
+        Limits of each solver, see ``optimal_delay.auto_solvers``. By
+        default, ``optimal_delay.AUTO_THRESHOLDS``.
+
+    See ``solve_batches`` for the other parameters. The thresholds and the
+    number of segments of more than k events given to each solver are
+    recorded in metrics.
+
+    Returns
+    -------
+    tuple of np.array
+        ``(sent_idx, first_idx, tours)``, see ``segments.solve_segments``
+    """
+
+    metrics = metrics or Metrics()
+    thresholds = thresholds or AUTO_THRESHOLDS
+    for name, value in thresholds.items():
+        metrics.setting(f'auto_{name}_max', value)
+
+    # The solver is not used in rolling mode
+    sizes = ends - starts
+    ids = auto_solvers(sizes, k, thresholds) if window == 0 else \
+        np.full(len(sizes), SOLVERS['local_search'])
+
+    results = []
+    for solver, i in SOLVERS.items():
+        group = np.flatnonzero(ids == i)
+        metrics.count(f'auto_{solver}', np.sum(sizes[group] > k))
+        if len(group) or not results:
+            results.append(solve_batches(
+                timestamp_ns, friend_code, starts[group], ends[group], k=k,
+                solver=solver, n_jobs=n_jobs, window=window, metrics=metrics,
+                shard=None if shard is None else shard[group]))
+
+    # Segments are disjoint ranges of events: sort by notification
+    sent_idx, first_idx, tours = [np.concatenate(r) for r in zip(*results)]
+    order = np.argsort(sent_idx, kind='stable')
+
+    return sent_idx[order], first_idx[order], tours[order]
+
+
+def warmup(max_notifications=4):
+    """Compiles the kernels of ``bundle`` for all solvers, or loads them from
+    the on-disk cache
+
+    Kernels are otherwise compiled on the first call in each process, so
+    long-lived processes (servers, workers) can call this at startup to keep
+    the first request fast.
+
+    Parameters
+    ----------
+    max_notifications : int
+        Maximum number of notifications sent to a user per day. Any value
+        compiles the same kernels.
+
+    Returns
+    -------
+    float
+        Elapsed time, in seconds
+    """
+
+    start = time.perf_counter()
+
+    # Two user-days, one of them with more than max_notifications events
+    n = 2 * max_notifications + 1
+    events = EventTable(
+        timestamp=np.arange(n, dtype=np.int64) * 60 * 10**9,
+        user_code=np.zeros(n, dtype=np.int32),
+        friend_code=np.arange(n, dtype=np.int32) % 3,
+        name_code=np.zeros(n, dtype=np.int32),
+        users=np.array(['user'], dtype=object),
+        friends=np.array(['a', 'b', 'c'], dtype=object),
+        names=np.array(['name'], dtype=object))
+    events.timestamp[-1] += segments.DAY_NS
+
+    for solver in SOLVERS:
+        bundle_events(events, max_notifications=max_notifications,
+                      solver=solver)
+        optimal_schedule(events.timestamp[:-1], k=max_notifications,
+                         solver=solver)
+    bundle_events(events, max_notifications=max_notifications,
+                  window='rolling')
+    cache_module.segment_hashes(
+        events.timestamp, cache_module.friend_hashes(events.friends)[
+            events.friend_code], np.zeros(1, dtype=np.int64),
+        np.ones(1, dtype=np.int64))
+
+    return time.perf_counter() - start
+
+
+def solve_cached(cache, solve, timestamp_ns, friend_hash, starts, ends,
+                 params, min_events=1, shard=None, metrics=None):
+    """Like ``solve_batches``, but reuses the results of the segments found
+    in a ``cache.ResultCache`` and stores the new ones
+
+    Parameters
+    ----------
+    cache : cache.ResultCache
+        Cache of results
+    solve : callable
+        ``solve(starts, ends, shard=shard)`` solves segments, e.g.
+        ``solve_batches`` with the other arguments fixed
+    timestamp_ns : np.array of int
+        Sorted timestamps, as integers
+    friend_hash : np.array of uint64
+        Hash of the friend id of each event, see ``cache.friend_hashes``
+    starts : np.array of int
+        First event of each segment
+    ends : np.array of int
+        End (excluded) of each segment
+    params : str
+        Parameters of the run, see ``cache.cache_params``
+    min_events : int
+        Only segments with at least this many events are cached
+    shard : np.array of int, optional
+        Shard of each segment, passed to solve
+    metrics : metrics.Metrics, optional
+        Records the 'cache' stage and the 'cache_hits' and 'cache_misses'
+        counters
+
+    Returns
+    -------
+    tuple of np.array
+        ``(sent_idx, first_idx, tours)``, see ``segments.solve_segments``
+    """
+
+    metrics = metrics or Metrics()
+
+    with metrics.stage('cache'):
+        cached = np.flatnonzero(ends - starts >= min_events)
+        h1, h2 = cache_module.segment_hashes(timestamp_ns, friend_hash,
+                                             starts[cached], ends[cached])
+        pos, hit_x, hit_tours = cache.lookup(params, h1, h2)
+
+    metrics.count('cache_hits', len(pos))
+    metrics.count('cache_misses', len(cached) - len(pos))
+
+    hit = np.zeros(len(starts), dtype=bool)
+    hit[cached[pos]] = True
+    miss = np.flatnonzero(~hit)
+    sent_idx, first_idx, tours = solve(
+        starts[miss], ends[miss],
+        shard=None if shard is None else shard[miss])
+
+    with metrics.stage('cache'):
+        # Store the new segments. The notifications of each segment are
+        # contiguous, since the solved segments are sorted.
+        bounds = np.searchsorted(sent_idx, ends[miss])
+        new = np.flatnonzero(ends[miss] - starts[miss] >= min_events)
+        is_new = np.zeros(len(starts), dtype=bool)
+        is_new[miss[new]] = True
+        lo = np.append(0, bounds[:-1])[new]
+        hi = bounds[new]
+        new_pos = np.flatnonzero(is_new[cached])
+        cache.store(params, h1[new_pos], h2[new_pos],
+                    [sent_idx[a:b] - s for a, b, s in
+                     zip(lo, hi, starts[miss[new]])],
+                    [tours[a:b] for a, b in zip(lo, hi)])
+
+        # Results of the cached segments, relative to their first event
+        lengths = np.array([len(x) for x in hit_x], dtype=np.int64)
+        segment_start = np.repeat(starts[cached[pos]], lengths)
+        hit_sent = segment_start + np.concatenate(
+            hit_x + [np.empty(0, dtype=np.int32)])
+        hit_first = np.append(segment_start[:1], hit_sent[:-1] + 1)
+        is_first = np.zeros(len(hit_sent), dtype=bool)
+        is_first[np.cumsum(lengths) - lengths] = True
+        hit_first = np.where(is_first, segment_start, hit_first)
+        hit_tours = np.concatenate(hit_tours + [np.empty(0, dtype=np.int32)])
+
+    # Merge in the order of the events
+    sent_idx = np.concatenate([sent_idx, hit_sent])
+    order = np.argsort(sent_idx, kind='stable')
+
+    return (sent_idx[order],
+            np.concatenate([first_idx, hit_first])[order],
+            np.concatenate([tours, hit_tours]).astype(np.int64)[order])
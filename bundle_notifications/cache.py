@@ -0,0 +1,261 @@
+"""Persistent cache of the schedules of the (user, day) segments.
+
+Re-bundling the same history gives the same schedules, so they can be kept
+in a SQLite file and reused. Each entry is keyed by a 128-bit hash of the
+sorted ``(timestamp, friend_id)`` content of a segment and by the parameters
+of the run (solver, maximum number of notifications, window and package
+version), and stores the schedule ``x`` and the tours of each notification.
+Only new or changed segments are solved again.
+
+The cache keeps at most ``max_entries`` entries. When it grows larger, the
+least recently used entries are evicted.
+
+"""
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+from numba import jit
+
+from . import __version__
+
+# Bump when the format of the entries or the results of the solvers change
+CACHE_VERSION = 1
+
+# Default maximum number of entries, about 1 GB of SQLite file
+MAX_ENTRIES = 10**7
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    params TEXT NOT NULL,
+    h1 INTEGER NOT NULL,
+    h2 INTEGER NOT NULL,
+    x BLOB NOT NULL,
+    tours BLOB NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (params, h1, h2)
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+'''
+
+
+@jit(nopython=True, cache=True)
+def mix(z):  # pragma: no cover
+    """splitmix64 finalizer: scrambles the bits of an uint64"""
+
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@jit(nopython=True, cache=True)
+def segment_hashes(timestamp, friend_hash, starts, ends):  # pragma: no cover
+    """128-bit hash of the content of each segment
+
+    The hash depends on the timestamps, the friends and their order, so two
+    segments with the same sorted events have the same hash.
+
+    Parameters
+    ----------
+    timestamp : np.array of int
+        Sorted timestamps, as integers
+    friend_hash : np.array of uint64
+        Hash of the friend id of each event, e.g. from ``pd.util.hash_array``
+    starts : np.array of int
+        First event of each segment
+    ends : np.array of int
+        End (excluded) of each segment
+
+    Returns
+    -------
+    h1, h2 : np.array of uint64
+        Two independent 64-bit halves of the hash of each segment
+    """
+
+    n = len(starts)
+    h1 = np.empty(n, dtype=np.uint64)
+    h2 = np.empty(n, dtype=np.uint64)
+
+    for s in range(n):
+        a = np.uint64(0x9E3779B97F4A7C15)
+        b = np.uint64(0xC2B2AE3D27D4EB4F)
+        for i in range(starts[s], ends[s]):
+            v = mix(np.uint64(timestamp[i])) ^ friend_hash[i]
+            a = mix(a ^ v)
+            b = mix(b + v * np.uint64(0x165667B19E3779F9))
+        length = np.uint64(ends[s] - starts[s])
+        h1[s] = mix(a ^ length)
+        h2[s] = mix(b + length)
+
+    return h1, h2
+
+
+def cache_params(solver, k, window):
+    """Parameters of a run that the cached results depend on
+
+    Parameters
+    ----------
+    solver : str
+        Solver name
+    k : int
+        Maximum number of notifications
+    window : int
+        Length of the rolling window, or 0 for calendar days
+
+    Returns
+    -------
+    str
+        Part of the key of the entries
+    """
+
+    return f'{solver}:{k}:{window}:{__version__}:{CACHE_VERSION}'
+
+
+class ResultCache:
+    """SQLite cache of segment schedules
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file. It is created if it does not exist.
+    max_entries : int
+        Maximum number of entries. Least recently used entries are evicted
+        when more are stored.
+
+    Examples
+    --------
+    ::
+
+        with ResultCache('bundle_cache.sqlite') as cache:
+            df = bundle(events, cache=cache)
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        """Commits and closes the database"""
+
+        self.connection.commit()
+        self.connection.close()
+
+    def clear(self):
+        """Removes all the entries"""
+
+        self.connection.execute('DELETE FROM results')
+        self.connection.commit()
+
+    def lookup(self, params, h1, h2):
+        """Finds cached segments and marks them as recently used
+
+        Parameters
+        ----------
+        params : str
+            Parameters of the run, see ``cache_params``
+        h1, h2 : np.array of uint64
+            Hashes of the segments, see ``segment_hashes``
+
+        Returns
+        -------
+        pos : np.array of int
+            Position in h1 of the segments found
+        x : list of np.array of int32
+            Schedule of each segment found, relative to its first event
+        tours : list of np.array of int32
+            Number of tours of each notification of each segment found
+        """
+
+        db = self.connection
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS lookup '
+                   '(pos INTEGER, h1 INTEGER, h2 INTEGER)')
+        db.execute('DELETE FROM lookup')
+        db.executemany('INSERT INTO lookup VALUES (?, ?, ?)', zip(
+            range(len(h1)), h1.view(np.int64).tolist(),
+            h2.view(np.int64).tolist()))
+
+        join = 'FROM lookup JOIN results ON results.params = ? AND ' \
+            'results.h1 = lookup.h1 AND results.h2 = lookup.h2'
+        rows = db.execute(f'SELECT lookup.pos, results.x, results.tours '
+                          f'{join} ORDER BY lookup.pos', (params,)).fetchall()
+        db.execute(f'UPDATE results SET last_used = ? WHERE rowid IN '
+                   f'(SELECT results.rowid {join})',
+                   (time.time_ns(), params))
+        db.commit()
+
+        pos = np.array([row[0] for row in rows], dtype=np.int64)
+        x = [np.frombuffer(row[1], dtype=np.int32) for row in rows]
+        tours = [np.frombuffer(row[2], dtype=np.int32) for row in rows]
+
+        return pos, x, tours
+
+    def store(self, params, h1, h2, x, tours):
+        """Saves the results of segments and evicts old entries if needed
+
+        Parameters
+        ----------
+        params : str
+            Parameters of the run, see ``cache_params``
+        h1, h2 : np.array of uint64
+            Hashes of the segments
+        x : list of np.array of int
+            Schedule of each segment, relative to its first event
+        tours : list of np.array of int
+            Number of tours of each notification of each segment
+        """
+
+        now = time.time_ns()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+            ((params, a, b, xs.astype(np.int32).tobytes(),
+              ts.astype(np.int32).tobytes(), now)
+             for a, b, xs, ts in zip(h1.view(np.int64).tolist(),
+                                     h2.view(np.int64).tolist(), x, tours)))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries above ``max_entries``
+
+        Returns
+        -------
+        int
+            Number of entries removed
+        """
+
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                'DELETE FROM results WHERE rowid IN (SELECT rowid FROM '
+                'results ORDER BY last_used LIMIT ?)', (excess,))
+        self.connection.commit()
+
+        return max(excess, 0)
+
+
+def friend_hashes(friends):
+    """Stable 64-bit hash of each friend id of a dictionary
+
+    Parameters
+    ----------
+    friends : np.array
+        Dictionary of friend ids, e.g. ``EventTable.friends``
+
+    Returns
+    -------
+    np.array of uint64
+    """
+
+    return pd.util.hash_array(np.asarray(friends, dtype=object))
@@ -0,0 +1,164 @@
+"""Deduplication and cleaning of integer-coded events.
+
+Events are delivered at least once upstream, so the same tour can appear
+several times, with the same timestamp, user and friend. Duplicates would
+not change the tours counted, since a friend is counted once per
+notification, but they make user-days longer and the solver slower.
+
+Cleaning works on the codes of an ``events.EventTable``:
+
+1. Invalid events are dropped: missing timestamps, users or friends.
+2. In the events of each user, sorted by time, each event is compared with
+   the previous event of the same friend. Those at the same time are exact
+   duplicates. Optionally, those less than ``burst`` seconds later are
+   collapsed into the first one of the burst.
+
+The second step is a single compiled pass over events sorted by user and
+time, with the time of the last event of each friend stored in an array
+indexed by friend code. ``bundle`` runs it on the arrays it has sorted
+anyway, so cleaning does not add a sort.
+
+Functions decorated with @jit are not included in the coverage report.
+
+"""
+import numpy as np
+from numba import jit
+
+from .metrics import Metrics
+from .segments import segment_order
+
+# Value of NaT in int64 timestamps
+NAT = np.iinfo(np.int64).min
+
+# Labels of the events returned by ``duplicate_events``
+KEEP, DUPLICATE, BURST = 0, 1, 2
+
+
+def valid_events(events):
+    """Mask of the events with a timestamp, a user and a friend
+
+    Missing values are NaT timestamps and -1 codes, see ``events.encode``.
+    """
+
+    return (np.asarray(events.timestamp) != NAT) & \
+        (np.asarray(events.user_code) >= 0) & \
+        (np.asarray(events.friend_code) >= 0)
+
+
+@jit(nopython=True, cache=True)
+def duplicate_events(timestamp, user_code, friend_code, n_friends,
+                     burst_ns):  # pragma: no cover
+    """Labels the duplicates of events sorted by user and time
+
+    Parameters
+    ----------
+    timestamp : np.array of int
+        Timestamp of each event, sorted within each user
+    user_code : np.array of int
+        User of each event, sorted
+    friend_code : np.array of int
+        Friend of each event, from 0 to n_friends-1
+    n_friends : int
+        Number of friend codes
+    burst_ns : int
+        Events at most this many nanoseconds after the previous event of the
+        same user and friend are labeled BURST
+
+    Returns
+    -------
+    np.array of int8
+        KEEP, DUPLICATE (same timestamp, user and friend as a previous
+        event) or BURST for each event
+    """
+
+    label = np.zeros(len(timestamp), dtype=np.int8)
+    # Last event of each friend, valid only if stamped with the current user
+    last = np.empty(n_friends, dtype=np.int64)
+    stamp = np.full(n_friends, -1, dtype=np.int64)
+
+    user = -1
+    generation = -1
+    for i in range(len(timestamp)):
+        if user_code[i] != user:
+            user = user_code[i]
+            generation += 1
+        f = friend_code[i]
+        if stamp[f] == generation:
+            gap = timestamp[i] - last[f]
+            if gap == 0:
+                label[i] = DUPLICATE
+            elif gap <= burst_ns:
+                label[i] = BURST
+        stamp[f] = generation
+        last[f] = timestamp[i]
+
+    return label
+
+
+def count_labels(label, invalid=0, metrics=None):
+    """Counts the events dropped, and records them in metrics
+
+    Returns
+    -------
+    dict
+        Number of ``'invalid_events'``, ``'duplicate_events'`` and
+        ``'burst_events'``
+    """
+
+    counts = {'invalid_events': int(invalid),
+              'duplicate_events': int(np.sum(label == DUPLICATE)),
+              'burst_events': int(np.sum(label == BURST))}
+    if metrics is not None:
+        for name, value in counts.items():
+            metrics.count(name, value)
+
+    return counts
+
+
+def clean_events(events, burst=0, metrics=None):
+    """Drops invalid and duplicate events
+
+    Parameters
+    ----------
+    events : events.EventTable
+        Events to clean. They are not modified.
+    burst : float
+        Events of a user and friend at most this many seconds after the
+        previous one are dropped, so that a burst counts as its first event.
+        With 0, only exact duplicates (same timestamp, user and friend) are
+        dropped.
+    metrics : metrics.Metrics, optional
+        Records the time of the 'clean' stage and the counters of the
+        returned counts
+
+    Returns
+    -------
+    events.EventTable
+        Events kept, in their input order. ``events`` itself if nothing was
+        dropped.
+    counts : dict
+        Number of ``'invalid_events'``, ``'duplicate_events'`` and
+        ``'burst_events'`` dropped
+    """
+
+    metrics = metrics or Metrics()
+
+    with metrics.stage('clean'):
+        valid = valid_events(events)
+        if not valid.all():
+            events = events.take(np.flatnonzero(valid))
+
+        timestamp = np.asarray(events.timestamp)
+        user_code = np.asarray(events.user_code)
+        order = segment_order(user_code, np.zeros(len(events), np.int64),
+                              timestamp)
+        label = np.empty(len(events), dtype=np.int8)
+        label[order] = duplicate_events(
+            timestamp[order], user_code[order], events.friend_code[order],
+            len(events.friends), int(burst * 10**9))
+
+        counts = count_labels(label, np.sum(~valid), metrics)
+        if (label != KEEP).any():
+            events = events.take(np.flatnonzero(label == KEEP))
+
+    return events, counts
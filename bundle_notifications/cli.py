@@ -1,50 +1,342 @@
-"""Console script for bundle_notifications package."""
+"""Console script for bundle_notifications package.
+
+pandas, numba and the compiled kernels are only imported when the command
+runs, so that ``--help`` and argument errors are fast.
+"""
 import sys
 import click
-import tabulate
-from .bundle_notifications import load_data, bundle
+
+from .solvers import SOLVER_NAMES
+
+# Rows read at a time with --partitions when --chunksize is not given
+PARTITION_CHUNKSIZE = 10**6
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-p', '--path_input_csv',
               default="https://static-eu-komoot.s3.amazonaws.com/backend/"
               "challenge/notifications.csv",
               type=click.STRING,
-              help='Input path to csv file.',
+              help='Input path to csv file. Parquet and Feather/Arrow files '
+              'are read if the extension is .parquet, .pq, .feather, .arrow '
+              'or .ipc, the table of a SQLite database from a URL like '
+              'sqlite:///events.db?table=events, and directories written by '
+              'the convert command are memory-mapped.',
               show_default=True)
 @click.option('-o', '--path_output_csv', default="bundle_notifications.csv",
-              type=click.STRING, help='Output path to csv file.',
+              type=click.STRING,
+              help='Output path to csv file. The format is chosen from the '
+              'extension, like for the input. With a SQLite URL, the rows of '
+              'the table (by default, notifications) are replaced.',
               show_default=True)
 @click.option('-n', '--nrows_print', default=50, type=click.IntRange(min=0),
               help='Number of rows to print to stout', show_default=True)
-def main(path_input_csv, path_output_csv, nrows_print):
+@click.option('-k', '--max_notifications', default=4,
+              type=click.IntRange(min=1),
+              help='Maximum number of notifications per user and day.',
+              show_default=True)
+@click.option('-s', '--solver', default='local_search',
+              type=click.Choice(SOLVER_NAMES),
+              help='Method used to compute the notification schedule.',
+              show_default=True)
+@click.option('--window', default='calendar',
+              type=click.Choice(['calendar', 'rolling']),
+              help='Enforce the maximum number of notifications per calendar '
+              'day, or over any rolling 24-hour window.',
+              show_default=True)
+@click.option('-c', '--chunksize', default=None, type=click.IntRange(min=1),
+              help='Read the input in chunks of this many rows and bundle '
+              'each day as soon as it is complete. The input must be sorted '
+              'by time, unless --partitions is given.')
+@click.option('--partitions', default=None, type=click.IntRange(min=1),
+              help='Out-of-core mode for inputs larger than memory: split '
+              'the events in this many on-disk partitions by user, then '
+              'bundle one partition at a time. The input can be in any '
+              'order, and is read in chunks of --chunksize rows.')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              help='Number of processes used to bundle notifications.',
+              show_default=True)
+@click.option('--incremental', is_flag=True,
+              help='Treat the input as an append-only log and the output as '
+              'a directory with one csv file per day. Only the events added '
+              'since the last run are read, and only their days are '
+              'rewritten.')
+@click.option('--memory_limit', default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help='Memory limit in MB, e.g. of the container. The plan is '
+              'static, made before reading the input from an estimate of its '
+              'size: it is bundled at once if its estimated footprint fits, '
+              'and out of core with chunks and partitions sized for the limit'
+              ' otherwise. Out of core, csv chunks shrink at run time when '
+              'memory gets close to the limit, but the number of partitions '
+              'is fixed. The limit is not enforced: the peak memory is '
+              'reported at the end.')
+@click.option('--dedup', default=None, type=click.FloatRange(min=0),
+              help='Drop invalid and duplicate events before bundling: '
+              'those with the same timestamp, user and friend, and those of '
+              'the same user and friend at most this many seconds after the '
+              'previous one. Use 0 for exact duplicates only.')
+@click.option('--cache', 'cache_path', default=None,
+              type=click.Path(dir_okay=False),
+              help='SQLite file with the schedules of previous runs. Only '
+              'new or changed user-days are solved.')
+@click.option('--cache_size', default=10**7, type=click.IntRange(min=1),
+              help='Maximum number of user-days kept in the cache. The '
+              'least recently used are evicted.',
+              show_default=True)
+@click.option('--dispatch', 'dispatch_url', default=None, type=click.STRING,
+              help='POST the notifications as JSON arrays to this http(s) '
+              'URL after bundling.')
+@click.option('--concurrency', default=16, type=click.IntRange(min=1),
+              help='Number of connections used by --dispatch.',
+              show_default=True)
+@click.option('--rate_limit', default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help='Maximum number of requests per second sent by '
+              '--dispatch.')
+@click.option('--profile', is_flag=True,
+              help='Print the time and memory of each stage and the '
+              'counters of the run.')
+@click.option('--metrics-json', 'metrics_json', default=None,
+              type=click.Path(dir_okay=False, writable=True),
+              help='Save the metrics of the run to this JSON file.')
+@click.pass_context
+def main(ctx, path_input_csv, path_output_csv, nrows_print, max_notifications,
+         solver, window, chunksize, partitions, workers, incremental,
+         memory_limit, dedup, cache_path, cache_size, dispatch_url,
+         concurrency, rate_limit, profile, metrics_json):
     """Download data, bundles notifications and prints solution to stdout
     """
 
+    if ctx.invoked_subcommand is not None:
+        return 0
+
+    from .bundle_notifications import load_data, bundle, save_data, \
+        file_format
+    from .cache import ResultCache
+    from .incremental import bundle_incremental
+    from .memory import adaptive_chunks, estimate_rows, plan_memory
+    from .metrics import Metrics
+    from .partitioned import bundle_partitioned
+    from .streaming import bundle_stream, write_stream
+
+    plan = None
+    if memory_limit is not None:
+        if chunksize is not None or partitions is not None or incremental:
+            raise click.UsageError('--memory_limit chooses the chunk size and'
+                                   ' the partitions, and does not support '
+                                   '--chunksize, --partitions or '
+                                   '--incremental')
+        try:
+            plan = plan_memory(estimate_rows(path_input_csv), memory_limit)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        # Stores are memory-mapped: their pages can always be evicted
+        if plan['mode'] == 'partitioned' and \
+                file_format(path_input_csv) != 'store':
+            if dispatch_url is not None:
+                raise click.UsageError(
+                    f'The input does not fit in {memory_limit:.0f} MB, and '
+                    f'--dispatch needs all the notifications in memory')
+            chunksize, partitions = plan['chunksize'], plan['partitions']
+        click.echo(click.style(
+            f'Memory limit of {memory_limit:.0f} MB: ' + (
+                f'bundling in {partitions} partitions, reading chunks of '
+                f'{chunksize} rows' if partitions is not None else
+                'bundling in memory'), fg='green'))
+
+    # Days are bundled one block at a time when streaming, so the progress
+    # bar is only shown when the whole input is bundled at once
+    metrics = Metrics(progress=chunksize is None and partitions is None,
+                      memory_limit=memory_limit)
+    if plan is not None:
+        for name, value in plan.items():
+            metrics.setting(f'memory_{name}', value)
+
+    if partitions is not None and (incremental or dispatch_url is not None):
+        raise click.UsageError('--partitions does not support --incremental '
+                               'or --dispatch')
+    if partitions is not None and file_format(path_input_csv) == 'store':
+        raise click.UsageError('--partitions reads the input in chunks, which'
+                               ' is not supported for binary stores')
+    if incremental and (chunksize is not None or window == 'rolling'):
+        raise click.UsageError('--incremental bundles calendar days and does '
+                               'not support --chunksize or --window rolling')
+    if incremental and file_format(path_input_csv) != 'csv':
+        raise click.UsageError('--incremental reads a csv file')
+    if partitions is None and chunksize is not None and \
+            dispatch_url is not None:
+        raise click.UsageError('--dispatch is not supported with --chunksize')
+    if partitions is None and chunksize is not None and \
+            cache_path is not None:
+        raise click.UsageError('--cache is not supported with --chunksize')
+    if partitions is None and chunksize is not None and window == 'rolling':
+        raise click.UsageError('--chunksize bundles one day at a time and '
+                               'does not support --window rolling')
+
+    if partitions is not None:
+        # Out of core: partition the input on disk, bundle each partition
+        chunksize = chunksize or PARTITION_CHUNKSIZE
+        click.echo(click.style(
+            f'Bundling notifications in {partitions} partitions...',
+            fg='green'))
+        cache = None if cache_path is None else \
+            ResultCache(cache_path, max_entries=cache_size)
+        chunks = load_data(path_csv=path_input_csv, chunksize=chunksize)
+        if memory_limit is not None:
+            chunks = adaptive_chunks(chunks, memory_limit, chunksize,
+                                     metrics=metrics)
+        df, n_rows = write_stream(
+            bundle_partitioned(chunks, n_partitions=partitions,
+                               max_notifications=max_notifications,
+                               solver=solver, n_jobs=workers, window=window,
+                               cache=cache, metrics=metrics, dedup=dedup),
+            path_output_csv, nrows=nrows_print, metrics=metrics)
+        if cache is not None:
+            cache.close()
+        click.echo(click.style(
+            f'Saved {n_rows} notifications to {file_format(path_output_csv)}:'
+            f' {path_output_csv}',
+            fg='green'))
+
+        return finish(df, nrows_print, metrics, profile, metrics_json)
+
+    if chunksize is not None:
+        # Bounded memory: stream the input, write each day when it closes
+        click.echo(click.style(
+            f'Bundling notifications in chunks of {chunksize} rows...',
+            fg='green'))
+        chunks = load_data(path_csv=path_input_csv, chunksize=chunksize)
+        df, n_rows = write_stream(
+            bundle_stream(chunks, max_notifications=max_notifications,
+                          solver=solver, n_jobs=workers, metrics=metrics,
+                          dedup=dedup),
+            path_output_csv, nrows=nrows_print, metrics=metrics)
+        click.echo(click.style(
+            f'Saved {n_rows} notifications to {file_format(path_output_csv)}:'
+            f' {path_output_csv}',
+            fg='green'))
+
+        return finish(df, nrows_print, metrics, profile, metrics_json)
+
+    cache = None if cache_path is None else \
+        ResultCache(cache_path, max_entries=cache_size)
+
+    if incremental:
+        click.echo(click.style(
+            f'Bundling new events of {path_input_csv}...', fg='green'))
+        df, summary = bundle_incremental(
+            path_input_csv, path_output_csv,
+            max_notifications=max_notifications, solver=solver,
+            n_jobs=workers, cache=cache, metrics=metrics, dedup=dedup)
+        click.echo(click.style(
+            f'Read {summary["rows_read"]} events and wrote '
+            f'{summary["days_written"]} days to {path_output_csv}' +
+            (' (full rebuild)' if summary['full_rebuild'] else ''),
+            fg='green'))
+        if cache is not None:
+            cache.close()
+        if dispatch_url is not None:
+            deliver(df, dispatch_url, concurrency, rate_limit, metrics)
+
+        return finish(df, nrows_print, metrics, profile, metrics_json)
+
     # Load dataset
     click.echo(click.style('Downloading data...', fg='green'))
-    df = load_data(path_csv=path_input_csv)
+    with metrics.stage('load'):
+        events = load_data(path_csv=path_input_csv, compact=True)
+
+    # Events are sorted by user, day and time while bundling. The progress
+    # bar shows the ETA from the measured throughput.
+    click.echo(click.style(f'Bundling {len(events)} events...', fg='green'))
+    df = bundle(events, max_notifications=max_notifications, solver=solver,
+                n_jobs=workers, render=False, metrics=metrics, window=window,
+                cache=cache, dedup=dedup)
+    if cache is not None:
+        cache.close()
+
+    # Save to csv, or to the format of the extension
+    click.echo(click.style(f'Saving to {file_format(path_output_csv)}: '
+                           f'{path_output_csv}', fg='green'))
+    save_data(df, path_output_csv, metrics=metrics)
+    if dispatch_url is not None:
+        deliver(df, dispatch_url, concurrency, rate_limit, metrics)
+
+    return finish(df, nrows_print, metrics, profile, metrics_json)
+
+
+@main.command()
+@click.argument('path_input')
+@click.argument('directory', type=click.Path(file_okay=False))
+def convert(path_input, directory):
+    """Converts events to a memory-mapped binary store
+
+    The events of PATH_INPUT, in any input format, are sorted by user, day
+    and time and saved to DIRECTORY as fixed-width columns. Pass DIRECTORY
+    to -p to bundle them without parsing.
+    """
+
+    from .bundle_notifications import load_data
+    from .store import write_store
+
+    click.echo(click.style(f'Reading {path_input}...', fg='green'))
+    events = load_data(path_input, compact=True)
+    n_segments = write_store(events, directory)
+    click.echo(click.style(
+        f'Saved {len(events)} events and {n_segments} user-days to '
+        f'{directory}', fg='green'))
+
+    return 0
+
+
+def deliver(df, dispatch_url, concurrency, rate_limit, metrics):
+    """Sends the notifications to the push endpoint and reports the
+    throughput"""
+
+    from .dispatch import dispatch
+
+    click.echo(click.style(f'Sending {len(df)} notifications to '
+                           f'{dispatch_url}...', fg='green'))
+    stats = dispatch(df, dispatch_url, concurrency=concurrency,
+                     rate_limit=rate_limit, metrics=metrics)
+    click.echo(click.style(
+        f'Delivered {stats["delivered"]} notifications '
+        f'({stats["per_second"]:.0f} per second), {stats["failed"]} failed '
+        f'after {stats["retries"]} retries',
+        fg='green' if stats['failed'] == 0 else 'red'))
+
+
+def finish(df, nrows_print, metrics, profile, metrics_json):
+    """Prints the first notifications and reports the metrics of the run"""
+
+    print_head(df, nrows_print)
+    if profile:
+        click.echo(metrics.report())
+    elif metrics.memory_limit is not None:
+        from .metrics import peak_rss_mb
+
+        peak = peak_rss_mb()
+        if peak is not None:
+            click.echo(click.style(
+                f'Peak memory: {peak:.0f} MB of {metrics.memory_limit:.0f} MB',
+                fg='green' if peak <= metrics.memory_limit else 'red'))
+    if metrics_json is not None:
+        metrics.write_json(metrics_json)
+
+    return 0
 
-    # Give an approximate execution time
-    approx_time = df.shape[0]*(60*6)/330000
-    approx_text = f"Bundling notifications... (Estimated time:"\
-        f" {approx_time:.2f} seconds for {df.shape[0]} rows)"
-    click.echo(click.style(approx_text, fg='green'))
 
-    # The data needs to be sorted by date. Then bundle.
-    df.sort_values('timestamp', inplace=True)
-    df = bundle(df)
+def print_head(df, nrows_print):
+    """Prints the first rows of the bundled notifications to stdout"""
 
-    # Save to csv
-    click.echo(click.style(f'Saving to csv: {path_output_csv}', fg='green'))
-    df.to_csv(path_output_csv, index=False)
+    import tabulate
+    from .messages import render_messages
 
-    # Print to stout
     click.echo(click.style(
         f'Great! Here there are the first {nrows_print} bundled notifications',
         fg='green'))
-    click.echo(tabulate.tabulate(
-        df.head(nrows_print), df.columns, showindex=False))
+    df = render_messages(df.head(nrows_print))
+    click.echo(tabulate.tabulate(df, df.columns, showindex=False))
 
     return 0
 
@@ -0,0 +1,320 @@
+"""Reading events from and writing notifications to a database.
+
+Any DB-API 2.0 connection can be used, e.g. from ``sqlite3`` or
+``psycopg2``. Events are read in time order with ``fetchmany``, one chunk at
+a time, so they can be bundled with ``streaming.bundle_stream`` without
+exporting them to csv first. Date-range and user filters are part of the
+query, so only the matching rows leave the database. An index on the
+timestamp column lets the database return the rows in order without
+sorting them.
+
+Notifications are written with batched ``executemany`` calls, each call of
+``write_notifications`` in one transaction.
+
+``load_data`` and ``save_data`` accept SQLite URLs like
+``sqlite:///events.db`` (relative path) or ``sqlite:////tmp/events.db``
+(absolute path), with an optional ``?table=`` name. The default tables are
+``events`` for the input and ``notifications`` for the output. Table names
+cannot be query parameters: they are validated and quoted by
+``quote_identifier`` instead.
+
+"""
+import re
+import sqlite3
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+# Rows per fetchmany or executemany call
+BATCH_SIZE = 10000
+
+# Placeholder of a query parameter for each DB-API paramstyle
+PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+# Unquoted SQL identifier, e.g. a table or schema name
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+EVENT_COLUMNS = ['timestamp', 'user_id', 'friend_id', 'friend_name']
+
+NOTIFICATION_COLUMNS = ['notification_sent', 'timestamp_first_tour',
+                        'tours', 'receiver_id', 'message']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    notification_sent TIMESTAMP NOT NULL,
+    timestamp_first_tour TIMESTAMP NOT NULL,
+    tours INTEGER NOT NULL,
+    receiver_id TEXT NOT NULL,
+    message TEXT NOT NULL
+)
+'''
+
+
+def is_database_url(path):
+    """True if path is a SQLite URL, see ``parse_url``"""
+
+    return str(path).startswith('sqlite://')
+
+
+def parse_url(url, table):
+    """Splits a SQLite URL into the path of the file and the table
+
+    Parameters
+    ----------
+    url : str
+        URL like ``sqlite:///events.db?table=events``
+    table : str
+        Table used if the URL does not name one
+
+    Returns
+    -------
+    path : str
+    table : str
+
+    Raises
+    ------
+    ValueError
+        If it is not a SQLite URL, or the table is not a valid name, see
+        ``quote_identifier``
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme != 'sqlite' or parts.netloc:
+        raise ValueError(f'Not a SQLite URL: {url}')
+    table = parse_qs(parts.query).get('table', [table])[0]
+    quote_identifier(table)
+
+    return parts.path[1:], table
+
+
+def quote_identifier(name):
+    """Quotes a table name to insert it in a query
+
+    Parameters
+    ----------
+    name : str
+        Table name, optionally qualified by a schema, e.g. ``public.events``.
+        Each part must be a plain identifier: letters, digits and
+        underscores, not starting with a digit.
+
+    Returns
+    -------
+    str
+        Name with each part in double quotes, e.g. ``"public"."events"``
+
+    Raises
+    ------
+    ValueError
+        If the name is not a valid identifier
+    """
+
+    parts = str(name).split('.')
+    if not all(IDENTIFIER.fullmatch(part) for part in parts):
+        raise ValueError(f'Invalid table name: {name!r}. Use letters, '
+                         f'digits and underscores')
+
+    return '.'.join(f'"{part}"' for part in parts)
+
+
+def placeholder(connection):
+    """Placeholder of query parameters for the module of a connection"""
+
+    module = sys.modules[type(connection).__module__.split('.')[0]]
+    paramstyle = getattr(module, 'paramstyle', 'qmark')
+    if paramstyle not in PLACEHOLDERS:
+        raise ValueError(f'Unsupported paramstyle: {paramstyle}')
+
+    return PLACEHOLDERS[paramstyle]
+
+
+def events_query(table, start=None, end=None, users=None, mark='?'):
+    """Query of the events in time order, with the filters as parameters
+
+    Parameters
+    ----------
+    table : str
+        Table of events, see ``quote_identifier``
+    start, end : str or pd.Timestamp, optional
+        Only events with ``start <= timestamp < end``
+    users : list of str, optional
+        Only events of these users
+    mark : str
+        Placeholder of the parameters, see ``placeholder``
+
+    Returns
+    -------
+    query : str
+    params : list
+    """
+
+    where = []
+    params = []
+    if start is not None:
+        where.append(f'timestamp >= {mark}')
+        params.append(str(pd.Timestamp(start)))
+    if end is not None:
+        where.append(f'timestamp < {mark}')
+        params.append(str(pd.Timestamp(end)))
+    if users is not None:
+        users = list(users)
+        where.append(f'user_id IN ({", ".join([mark] * len(users))})')
+        params.extend(users)
+
+    query = f'SELECT {", ".join(EVENT_COLUMNS)} ' \
+        f'FROM {quote_identifier(table)}'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+
+    return query + ' ORDER BY timestamp', params
+
+
+def stream_events(connection, table='events', start=None, end=None,
+                  users=None, chunksize=BATCH_SIZE, nrows=None, cursor=None):
+    """Reads the events of a table in time order, one chunk at a time
+
+    Parameters
+    ----------
+    connection : DB-API connection
+        Connection to the database, e.g. ``sqlite3.connect('events.db')``
+    table : str
+        Table with the columns ``timestamp, user_id, friend_id,
+        friend_name``
+    start, end : str or pd.Timestamp, optional
+        Only events with ``start <= timestamp < end``
+    users : list of str, optional
+        Only events of these users
+    chunksize : int
+        Rows fetched at once
+    nrows : int, optional
+        Maximum number of events read
+    cursor : DB-API cursor, optional
+        Cursor used to run the query, e.g. a server-side cursor of
+        ``psycopg2`` (``connection.cursor(name='events')``) so that the
+        database streams the rows. By default, ``connection.cursor()``.
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of events sorted by time, in the format of ``load_data``
+    """
+
+    query, params = events_query(table, start, end, users,
+                                 placeholder(connection))
+    cursor = cursor or connection.cursor()
+    try:
+        cursor.execute(query, params)
+        n_read = 0
+        while nrows is None or n_read < nrows:
+            size = chunksize if nrows is None else \
+                min(chunksize, nrows - n_read)
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            n_read += len(rows)
+
+            df = pd.DataFrame.from_records(rows, columns=EVENT_COLUMNS)
+            df['timestamp'] = pd.to_datetime(df.timestamp) \
+                .astype('datetime64[ns]')
+            yield df
+    finally:
+        cursor.close()
+
+
+def read_events(connection, table='events', start=None, end=None,
+                users=None, nrows=None):
+    """Reads the events of a table into one DataFrame, see
+    ``stream_events``"""
+
+    chunks = list(stream_events(connection, table, start, end, users,
+                                nrows=nrows))
+    if not chunks:
+        return pd.DataFrame({
+            'timestamp': pd.Series([], dtype='datetime64[ns]'),
+            'user_id': [], 'friend_id': [], 'friend_name': []})
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def write_notifications(df, connection, table='notifications',
+                        replace=False, batch_size=BATCH_SIZE):
+    """Writes bundled notifications to a table, in one transaction
+
+    The table is created if it does not exist.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Notifications with a rendered 'message' column, see
+        ``messages.render_messages``
+    connection : DB-API connection
+        Connection to the database
+    table : str
+        Output table
+    replace : bool
+        If True, the rows already in the table are deleted first
+    batch_size : int
+        Rows inserted per ``executemany`` call
+    """
+
+    mark = placeholder(connection)
+    table = quote_identifier(table)
+    insert = f'INSERT INTO {table} ({", ".join(NOTIFICATION_COLUMNS)}) ' \
+        f'VALUES ({", ".join([mark] * len(NOTIFICATION_COLUMNS))})'
+
+    columns = [df.notification_sent.astype(str).tolist(),
+               df.timestamp_first_tour.astype(str).tolist(),
+               df.tours.astype('int64').tolist(),
+               df.receiver_id.astype(str).tolist(),
+               df.message.astype(str).tolist()]
+    rows = list(zip(*columns))
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(SCHEMA.format(table=table))
+        if replace:
+            cursor.execute(f'DELETE FROM {table}')
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(insert, rows[i:i+batch_size])
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def connect_url(url, table):
+    """Opens the SQLite database of a URL in write-ahead log mode
+
+    Parameters
+    ----------
+    url : str
+        SQLite URL, see ``parse_url``
+    table : str
+        Table used if the URL does not name one
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+    table : str
+    """
+
+    path, table = parse_url(url, table)
+    connection = sqlite3.connect(path)
+    # Write-ahead log, so that notifications can be written to the database
+    # while events are still being read from it
+    connection.execute('PRAGMA journal_mode=WAL')
+
+    return connection, table
+
+
+def stream_url(url, chunksize=BATCH_SIZE, nrows=None):
+    """Reads the events of a SQLite URL in chunks, see ``stream_events``"""
+
+    connection, table = connect_url(url, 'events')
+    try:
+        yield from stream_events(connection, table, chunksize=chunksize,
+                                 nrows=nrows)
+    finally:
+        connection.close()
@@ -0,0 +1,297 @@
+"""Delivery of bundled notifications to a push endpoint.
+
+Notifications are sent as JSON arrays of ``batch_size`` objects, POSTed by
+``concurrency`` asyncio workers. Each worker keeps one HTTP/1.1 keep-alive
+connection open and reuses it for all its requests, so the connections
+form a pool that is not opened again for every batch. A token bucket
+limits the number of requests per second sent to the endpoint.
+
+Requests that fail with a connection error, a timeout, 429 or a 5xx status
+are retried with exponential backoff; other statuses are final. Batches are
+serialized by pandas, and the producer waits when the queue of pending
+batches is full, so streams of any length are sent in bounded memory.
+
+Only the standard library is used: the client speaks the subset of HTTP/1.1
+needed to POST JSON and read the response.
+
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import pandas as pd
+
+from .messages import ENGLISH, render_messages
+from .metrics import Metrics
+
+# Statuses worth retrying: the endpoint is overloaded or failing
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Token bucket shared by the workers of a dispatcher
+
+    Parameters
+    ----------
+    rate : float or None
+        Requests per second. None for no limit.
+    burst : int
+        Maximum number of requests sent at once after an idle period
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a request can be sent"""
+
+        if self.rate is None:
+            return
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Connection:
+    """Keep-alive HTTP/1.1 connection to one endpoint
+
+    Parameters
+    ----------
+    url : str
+        http:// or https:// URL of the endpoint
+    timeout : float
+        Seconds to wait for connecting and for each response
+    headers : dict, optional
+        Extra request headers, e.g. for authentication
+    """
+
+    def __init__(self, url, timeout=10.0, headers=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Only http and https URLs are supported: {url}')
+
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        self.path = (parts.path or '/') + \
+            (f'?{parts.query}' if parts.query else '')
+        self.timeout = timeout
+        self.headers = ''.join(f'{name}: {value}\r\n'
+                               for name, value in (headers or {}).items())
+        self.reader = self.writer = None
+
+    async def open(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl),
+                self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def post(self, body):
+        """Sends a JSON body and returns the status of the response
+
+        The connection is opened if needed, and closed if the server asks
+        for it or if the request fails.
+        """
+
+        await self.open()
+        try:
+            self.writer.write(
+                f'POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n{self.headers}\r\n'
+                .encode() + body)
+            await self.writer.drain()
+            return await asyncio.wait_for(self.read_response(), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by the server')
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.readexactly(
+                int(headers.get('content-length', 0)))
+
+        if headers.get('connection') == 'close':
+            self.close()
+
+        return status
+
+
+def batches(frames, batch_size, templates=ENGLISH):
+    """Splits notifications in JSON request bodies
+
+    Parameters
+    ----------
+    frames : iterable of pd.DataFrame
+        Bundled notifications, see ``bundle``. Messages are rendered if
+        needed.
+    batch_size : int
+        Notifications per request
+    templates : messages.MessageTemplates
+        Templates used to render the messages, if needed
+
+    Yields
+    ------
+    body : bytes
+        JSON array of notifications, with timestamps in ISO 8601
+    n : int
+        Number of notifications in the body
+    """
+
+    for df in frames:
+        for i in range(0, len(df), batch_size):
+            block = render_messages(df.iloc[i:i+batch_size], templates)
+            yield block.to_json(orient='records', date_format='iso',
+                                date_unit='s').encode(), len(block)
+
+
+async def dispatch_async(frames, url, concurrency=16, batch_size=100,
+                         rate_limit=None, max_retries=5, backoff=0.1,
+                         timeout=10.0, headers=None, templates=ENGLISH):
+    """Sends notifications to an endpoint, see ``dispatch``"""
+
+    Connection(url)  # Fail early on invalid URLs
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    limiter = RateLimiter(rate_limit, burst=concurrency)
+    stats = {'delivered': 0, 'failed': 0, 'requests': 0, 'retries': 0}
+
+    async def worker():
+        connection = Connection(url, timeout=timeout, headers=headers)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                body, n = item
+                for attempt in range(max_retries + 1):
+                    if attempt:
+                        stats['retries'] += 1
+                        await asyncio.sleep(backoff * 2**(attempt - 1))
+                    await limiter.acquire()
+                    stats['requests'] += 1
+                    try:
+                        status = await connection.post(body)
+                    except (OSError, asyncio.TimeoutError, ValueError,
+                            asyncio.IncompleteReadError):
+                        continue
+                    if status not in RETRY_STATUSES:
+                        break
+                else:
+                    status = None
+                if status is not None and 200 <= status < 300:
+                    stats['delivered'] += n
+                else:
+                    stats['failed'] += n
+        finally:
+            connection.close()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        # The queue is bounded: the producer waits for the workers
+        for item in batches(frames, batch_size, templates):
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    return stats
+
+
+def dispatch(frames, url, concurrency=16, batch_size=100, rate_limit=None,
+             max_retries=5, backoff=0.1, timeout=10.0, headers=None,
+             templates=ENGLISH, metrics=None):
+    """POSTs bundled notifications to a push endpoint
+
+    Parameters
+    ----------
+    frames : pd.DataFrame or iterable of pd.DataFrame
+        Bundled notifications, e.g. the output of ``bundle`` or of
+        ``streaming.bundle_stream``
+    url : str
+        http:// or https:// URL that receives JSON arrays of notifications
+        with the columns of ``bundle`` as keys
+    concurrency : int
+        Number of connections, and of requests in flight
+    batch_size : int
+        Notifications per request
+    rate_limit : float, optional
+        Maximum number of requests per second to the endpoint
+    max_retries : int
+        Retries of a request that fails with a connection error, a timeout,
+        429 or a 5xx status. The n-th retry waits ``backoff * 2**(n-1)``
+        seconds.
+    backoff : float
+        Seconds before the first retry
+    timeout : float
+        Seconds to wait for connecting and for each response
+    headers : dict, optional
+        Extra request headers
+    templates : messages.MessageTemplates
+        Templates used to render the messages, if needed
+    metrics : metrics.Metrics, optional
+        Records the 'dispatch' stage and the counters of the returned stats
+
+    Returns
+    -------
+    dict
+        Number of notifications ``'delivered'`` and ``'failed'``, of
+        ``'requests'`` and ``'retries'``, ``'seconds'`` and delivered
+        notifications ``'per_second'``
+    """
+
+    metrics = metrics or Metrics()
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+
+    start = time.perf_counter()
+    with metrics.stage('dispatch'):
+        stats = asyncio.run(dispatch_async(
+            frames, url, concurrency=concurrency, batch_size=batch_size,
+            rate_limit=rate_limit, max_retries=max_retries, backoff=backoff,
+            timeout=timeout, headers=headers, templates=templates))
+    stats['seconds'] = time.perf_counter() - start
+    stats['per_second'] = stats['delivered'] / max(stats['seconds'], 1e-9)
+
+    for name in ('delivered', 'failed', 'requests', 'retries'):
+        metrics.count(name, stats[name])
+
+    return stats
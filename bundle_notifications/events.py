@@ -0,0 +1,157 @@
+"""Compact, dictionary-encoded representation of the events.
+
+With pandas, every cell of the 'user_id', 'friend_id' and 'friend_name'
+columns is a Python string object of 80 bytes or more. ``EventTable`` keeps
+one int64 timestamp and three int32 codes per event (20 bytes), plus one
+dictionary of unique strings per column.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+def encode(values, sort=False):
+    """Dictionary-encodes an array of values
+
+    Parameters
+    ----------
+    values : array-like
+        Values to encode. pd.Categorical values are not factorized again.
+    sort : bool
+        If True, the dictionary is sorted, so that codes keep the order of
+        the values
+
+    Returns
+    -------
+    codes : np.array of int32
+        Position of each value in the dictionary
+    uniques : np.array
+        Dictionary of unique values
+    """
+
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype) \
+            and not sort:
+        values = pd.Series(values).cat.remove_unused_categories()
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values, sort=sort)
+
+    return codes.astype(np.int32), np.asarray(uniques, dtype=object)
+
+
+class EventTable:
+    """Table of events with integer-coded columns
+
+    Parameters
+    ----------
+    timestamp : np.array of int64
+        Time of each event, in nanoseconds since the epoch
+    user_code : np.array of int32
+        Code of the user of each event, position in users
+    friend_code : np.array of int32
+        Code of the friend of each event, position in friends
+    name_code : np.array of int32
+        Code of the name of the friend of each event, position in names
+    users : np.array of str
+        Dictionary of user ids. Sorted when built by ``from_frame``.
+    friends : np.array of str
+        Dictionary of friend ids
+    names : np.array of str
+        Dictionary of friend names
+    offsets : np.array of int64, optional
+        Only for events sorted by (user, day, time): start of each (user,
+        day) segment, followed by the number of events. ``bundle`` then
+        uses them instead of sorting. See ``store.open_store``.
+    """
+
+    def __init__(self, timestamp, user_code, friend_code, name_code, users,
+                 friends, names, offsets=None):
+        self.timestamp = timestamp
+        self.user_code = user_code
+        self.friend_code = friend_code
+        self.name_code = name_code
+        self.users = users
+        self.friends = friends
+        self.names = names
+        self.offsets = offsets
+
+    @classmethod
+    def from_frame(cls, df):
+        """Encodes a pd.DataFrame of events. It is not modified.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            DataFrame containing 4 columns:
+            ``['timestamp', 'user_id', 'friend_id', 'friend_name']``.
+            A 'friend_code' column, as added by ``load_data``, is used
+            instead of factorizing the friend ids.
+
+        Returns
+        -------
+        EventTable
+        """
+
+        if 'friend_code' in df:
+            friend_code = df.friend_code.to_numpy().astype(np.int32)
+            codes, first = np.unique(friend_code, return_index=True)
+            friends = np.empty(codes[-1] + 1 if len(codes) else 0,
+                               dtype=object)
+            friends[codes] = df.friend_id.to_numpy()[first]
+        else:
+            friend_code, friends = encode(df.friend_id)
+
+        user_code, users = encode(df.user_id, sort=True)
+        name_code, names = encode(df.friend_name)
+
+        return cls(df.timestamp.to_numpy('datetime64[ns]').view('int64'),
+                   user_code, friend_code, name_code, users, friends, names)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @property
+    def nbytes(self):
+        """Approximate memory use in bytes, including the dictionaries"""
+
+        arrays = [self.timestamp, self.user_code, self.friend_code,
+                  self.name_code]
+        dictionaries = [self.users, self.friends, self.names]
+
+        return sum(a.nbytes for a in arrays) + \
+            sum(pd.Series(d).memory_usage(deep=True, index=False)
+                for d in dictionaries)
+
+    def take(self, idx):
+        """Selects events. Dictionaries are shared, not copied. The
+        selection is not assumed to be sorted, so offsets are dropped.
+
+        Parameters
+        ----------
+        idx : np.array of int or bool
+            Events to keep
+
+        Returns
+        -------
+        EventTable
+        """
+
+        return EventTable(self.timestamp[idx], self.user_code[idx],
+                          self.friend_code[idx], self.name_code[idx],
+                          self.users, self.friends, self.names)
+
+    def to_frame(self):
+        """Decodes the events to a pd.DataFrame
+
+        Returns
+        -------
+        pd.DataFrame
+            DataFrame containing 4 columns:
+            ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+        """
+
+        return pd.DataFrame({
+            'timestamp': self.timestamp.view('datetime64[ns]'),
+            'user_id': self.users[self.user_code],
+            'friend_id': self.friends[self.friend_code],
+            'friend_name': self.names[self.name_code]})
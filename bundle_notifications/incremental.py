@@ -0,0 +1,229 @@
+"""Incremental bundling of an append-only csv event log.
+
+The output is a directory with one file per day of notifications and a
+checkpoint. The checkpoint records the byte offset of the input consumed so
+far and the offset where its last day starts. Each run only reads from the
+start of that day: the last day, which may have been incomplete, and the new
+events are bundled, and only the partitions of those days are rewritten.
+The cost of a run is therefore proportional to the new data, not to the
+whole history.
+
+The whole log is bundled again when there is no checkpoint, when the
+parameters change, when the input was truncated or replaced, or when new
+events belong to a day before the last one (the log is then not sorted by
+day). The input must have one event per line: newlines inside quoted fields
+are not supported.
+
+"""
+import hashlib
+import io
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from .bundle_notifications import COLUMNS, bundle, save_data
+from .metrics import Metrics
+from .segments import DAY_NS
+
+CHECKPOINT = '_checkpoint.json'
+
+# Bytes at the start of the input used to detect that it was replaced
+HEAD_BYTES = 4096
+
+
+def read_checkpoint(output_dir):
+    """Reads the checkpoint of an output directory
+
+    Returns
+    -------
+    dict or None
+        None if there is no checkpoint
+    """
+
+    path = os.path.join(output_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(output_dir, checkpoint):
+    """Atomically replaces the checkpoint of an output directory"""
+
+    path = os.path.join(output_dir, CHECKPOINT)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def head_digest(path, n_bytes):
+    """Hash of the first bytes of a file, to detect that it was replaced"""
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(n_bytes)).hexdigest()
+
+
+def read_events(path_csv, offset=0):
+    """Reads the complete lines of a csv file from a byte offset
+
+    Parameters
+    ----------
+    path_csv : str
+        Path to a headerless csv file, see ``load_data``
+    offset : int
+        Byte offset of the first line to read
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Events, with the columns of ``load_data``
+    row_offset : np.array of int
+        Byte offset of the line of each event
+    end : int
+        Byte offset after the last complete line. A line that is still
+        being written is left for the next run.
+    """
+
+    with open(path_csv, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    data = data[:data.rfind(b'\n') + 1]
+
+    # Offsets of the non-empty lines, which read_csv turns into rows
+    newline = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+    line_start = np.append(0, newline[:-1] + 1)
+    row_offset = offset + line_start[newline - line_start > 0]
+
+    df = pd.read_csv(io.BytesIO(data), sep=",", header=None, names=COLUMNS,
+                     parse_dates=['timestamp'])
+    df['timestamp'] = df.timestamp.astype('datetime64[ns]')
+    if len(df) != len(row_offset):
+        raise ValueError('Could not map the rows of the csv file to lines')
+
+    return df, row_offset, offset + len(data)
+
+
+def partition_path(output_dir, day, extension='.csv'):
+    """Path of the partition of a day number, named after its date"""
+
+    date = pd.Timestamp(day * DAY_NS).strftime('%Y-%m-%d')
+    return os.path.join(output_dir, date + extension)
+
+
+def bundle_incremental(path_csv, output_dir, max_notifications=4,
+                       solver='local_search', n_jobs=1, extension='.csv',
+                       cache=None, metrics=None, dedup=None):
+    """Bundles the events appended to a csv log since the last run
+
+    Parameters
+    ----------
+    path_csv : str
+        Path to the append-only csv log of events, sorted by time
+    output_dir : str
+        Directory with one file of notifications per day and the
+        checkpoint. It is created if needed.
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes, see ``bundle``
+    extension : str
+        Extension of the partitions, which sets their format. See
+        ``save_data``.
+    cache : cache.ResultCache, optional
+        Persistent cache of schedules. The user-days of the last day that
+        did not change are then not solved again.
+    metrics : metrics.Metrics, optional
+        Records stage times and counters
+    dedup : float, optional
+        Window in seconds to drop duplicate events, see ``bundle``. The
+        days that are bundled again are read whole, so their duplicates are
+        always found.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Notifications of the days that were bundled
+    summary : dict
+        ``'rows_read'``, ``'days_written'`` and ``'full_rebuild'``, True if
+        the whole log was bundled again
+    """
+
+    metrics = metrics or Metrics()
+    os.makedirs(output_dir, exist_ok=True)
+
+    params = {'max_notifications': max_notifications, 'solver': solver,
+              'extension': extension}
+    if dedup is not None:
+        params['dedup'] = dedup
+    checkpoint = read_checkpoint(output_dir)
+    full_rebuild = checkpoint is None or \
+        checkpoint['params'] != params or \
+        os.path.getsize(path_csv) < checkpoint['offset'] or \
+        head_digest(path_csv, checkpoint['head_bytes']) != checkpoint['head']
+
+    empty = bundle(pd.DataFrame({
+        'timestamp': np.array([], dtype='datetime64[ns]'),
+        'user_id': [], 'friend_id': [], 'friend_name': []}), render=False)
+    summary = {'rows_read': 0, 'days_written': 0,
+               'full_rebuild': full_rebuild}
+    if not full_rebuild and \
+            os.path.getsize(path_csv) == checkpoint['offset']:
+        return empty, summary
+
+    with metrics.stage('load'):
+        df, row_offset, end = read_events(
+            path_csv, 0 if full_rebuild else checkpoint['day_offset'])
+        day = df.timestamp.to_numpy('datetime64[ns]').view('int64') // DAY_NS
+
+        # Late events of days that were closed: start from scratch
+        if not full_rebuild and len(df) and day.min() < checkpoint['day']:
+            full_rebuild = True
+            df, row_offset, end = read_events(path_csv, 0)
+            day = df.timestamp.to_numpy('datetime64[ns]').view('int64') // \
+                DAY_NS
+
+    summary['full_rebuild'] = full_rebuild
+    if full_rebuild:
+        for name in os.listdir(output_dir):
+            if re.fullmatch(r'\d{4}-\d{2}-\d{2}' + re.escape(extension), name):
+                os.remove(os.path.join(output_dir, name))
+    if len(df) == 0:
+        return empty, summary
+
+    df_out = bundle(df, max_notifications=max_notifications, solver=solver,
+                    n_jobs=n_jobs, render=False, metrics=metrics,
+                    cache=cache, dedup=dedup)
+
+    # Rewrite the partitions of the days that were bundled
+    out_day = df_out.notification_sent.to_numpy('datetime64[ns]') \
+        .view('int64') // DAY_NS
+    days = np.unique(out_day)
+    for d in days:
+        path = partition_path(output_dir, d, extension)
+        tmp = path[:-len(extension)] + '.tmp' + extension
+        save_data(df_out[out_day == d], tmp, metrics=metrics)
+        os.replace(tmp, path)
+
+    last_day = day.max()
+    write_checkpoint(output_dir, {
+        'input': os.path.abspath(path_csv),
+        'params': params,
+        'head': head_digest(path_csv, min(HEAD_BYTES, end)),
+        'head_bytes': min(HEAD_BYTES, int(end)),
+        'offset': int(end),
+        'day': int(last_day),
+        'day_offset': int(row_offset[np.argmax(day == last_day)])})
+
+    metrics.count('rows_read', len(df))
+    metrics.count('days_written', len(days))
+
+    summary.update(rows_read=len(df), days_written=len(days))
+
+    return df_out, summary
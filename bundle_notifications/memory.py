@@ -0,0 +1,255 @@
+"""Memory budget of a run.
+
+``--memory_limit`` chooses how to run from the size of the input, so that
+the process stays under a hard memory limit, e.g. the one of a container:
+
+- If the whole input fits, it is loaded and bundled at once, which is the
+  fastest.
+- Otherwise, it is bundled out of core by ``partitioned.bundle_partitioned``
+  with chunks and partitions small enough for the budget.
+
+The plan is made once, before reading the input: the footprint is estimated
+from the number of rows of the input, see ``estimate_rows``, and the bytes
+per event measured for each mode. These account for the parsed strings and
+for the copies made while sorting and bundling. The memory already used by
+the process (libraries, compiled kernels) is subtracted from the budget.
+
+While a csv file is split in partitions, ``adaptive_chunks`` measures the
+resident memory after each chunk and reads smaller chunks when it gets
+close to the limit, e.g. because the dictionaries of ids grow. The number
+of partitions is not changed during the run.
+
+"""
+import json
+import math
+import os
+import urllib.request
+
+from . import database, store
+from .metrics import Metrics, current_rss_mb, peak_rss_mb
+
+# Memory per event of the input when it is bundled at once: encoded
+# columns, dictionaries, sorted copies and output
+BYTES_PER_EVENT = 250
+
+# Memory per row of a chunk of strings being read and split in partitions
+CHUNK_BYTES_PER_ROW = 500
+
+# Memory per event of a partition of strings being bundled
+PARTITION_BYTES_PER_EVENT = 300
+
+# Memory kept free for allocations that do not grow with the input, in MB
+RESERVE_MB = 64
+
+# Partitions are filled unevenly by the hash of the users: plan for the
+# largest to be this much bigger than the mean
+PARTITION_SKEW = 2
+
+# Bytes of a csv file read to measure the length of its lines
+SAMPLE_BYTES = 2**20
+
+# Seconds to wait for the size of a remote file
+TIMEOUT = 10
+
+# Limits of the chosen chunks, in rows
+MIN_CHUNKSIZE = 1000
+MAX_CHUNKSIZE = 10**6
+
+# Partitions used when the number of rows of the input is unknown
+DEFAULT_PARTITIONS = 64
+
+
+def estimate_rows(path):
+    """Estimates the number of events of an input without reading it
+
+    Parameters
+    ----------
+    path : str
+        Input path, in any format of ``load_data``
+
+    Returns
+    -------
+    int or None
+        Number of rows stored in the metadata of Parquet, Feather, store
+        and SQLite inputs, or estimated from the size of a csv file and the
+        length of its first lines. The size and the first lines of http(s)
+        files are requested without downloading them. None if the size is
+        not known.
+    """
+
+    from .bundle_notifications import file_format
+
+    fmt = file_format(path)
+    if fmt == 'store':
+        with open(os.path.join(path, store.META)) as f:
+            return json.load(f)['n_events']
+    elif fmt == 'sqlite':
+        connection, table = database.connect_url(path, 'events')
+        try:
+            return connection.execute(
+                'SELECT COUNT(*) FROM '
+                f'{database.quote_identifier(table)}').fetchone()[0]
+        finally:
+            connection.close()
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    elif fmt == 'feather':
+        # One record batch at a time: compressed files would be decompressed
+        # whole by read_all
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            return sum(reader.get_batch(i).num_rows
+                       for i in range(reader.num_record_batches))
+
+    if path.startswith(('http://', 'https://')):
+        size, sample = remote_sample(path)
+        if size is None:
+            return None
+    elif os.path.isfile(path):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            sample = f.read(SAMPLE_BYTES)
+    else:
+        return None
+    lines = max(sample.count(b'\n'), 1)
+
+    return math.ceil(size * lines / max(len(sample), 1))
+
+
+def remote_sample(url):
+    """Size and first bytes of a remote file, without downloading it
+
+    Returns
+    -------
+    size : int or None
+        Content-Length of a HEAD request, None if it failed
+    sample : bytes
+        Up to SAMPLE_BYTES first bytes, from a range request
+    """
+
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            size = int(response.headers['Content-Length'])
+        request = urllib.request.Request(
+            url, headers={'Range': f'bytes=0-{SAMPLE_BYTES - 1}'})
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            # Servers without range requests send the whole file
+            sample = response.read(SAMPLE_BYTES)
+    except (OSError, ValueError, TypeError):
+        return None, b''
+
+    return size, sample
+
+
+def adaptive_chunks(chunks, memory_limit, chunksize, metrics=None):
+    """Reads chunks, shrinking them when memory gets close to the limit
+
+    After each chunk has been processed, the next one is sized for the
+    memory left under the limit, at ``CHUNK_BYTES_PER_ROW``. It is halved
+    if the peak memory went over the limit while processing the chunk.
+    Chunks only shrink, down to ``MIN_CHUNKSIZE`` rows.
+
+    Parameters
+    ----------
+    chunks : pd.io.parsers.TextFileReader or iterable of pd.DataFrame
+        Reader of ``load_data(path_csv, chunksize=...)``. Readers without
+        ``get_chunk``, i.e. of Parquet and Feather files, are iterated as
+        they are: their chunks have at most the planned size.
+    memory_limit : float
+        Memory limit of the process, in MB
+    chunksize : int
+        Rows of the first chunk
+    metrics : metrics.Metrics, optional
+        Counts the ``'chunk_resizes'``, and records the last chunk size as
+        the setting ``'memory_chunksize'``
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of events
+    """
+
+    metrics = metrics or Metrics()
+    if not hasattr(chunks, 'get_chunk'):
+        yield from chunks
+        return
+
+    peak = peak_rss_mb()
+    while True:
+        try:
+            chunk = chunks.get_chunk(chunksize)
+        except StopIteration:
+            chunks.close()
+            return
+        yield chunk
+        del chunk
+
+        available = memory_limit - (current_rss_mb() or 0) - RESERVE_MB
+        target = int(available * 1024**2 / CHUNK_BYTES_PER_ROW)
+        last_peak, peak = peak, peak_rss_mb()
+        if peak is not None and peak > memory_limit and peak > last_peak:
+            target = min(target, chunksize // 2)
+
+        if target < chunksize and chunksize > MIN_CHUNKSIZE:
+            chunksize = max(target, MIN_CHUNKSIZE)
+            metrics.count('chunk_resizes')
+            metrics.setting('memory_chunksize', chunksize)
+
+
+def plan_memory(n_rows, memory_limit, used=None):
+    """Chooses how to bundle an input under a memory limit
+
+    Parameters
+    ----------
+    n_rows : int or None
+        Number of events of the input, see ``estimate_rows``. If None, the
+        input is bundled out of core.
+    memory_limit : float
+        Memory limit of the process, in MB
+    used : float, optional
+        Memory already used by the process, in MB. By default, its current
+        resident memory.
+
+    Returns
+    -------
+    dict
+        ``'mode'``: ``'memory'`` to bundle at once, or ``'partitioned'``
+        with the ``'chunksize'`` and number of ``'partitions'`` to use.
+        ``'budget_mb'``: memory available for the data, and
+        ``'estimated_mb'``: estimate of the memory needed for the data in
+        that mode.
+
+    Raises
+    ------
+    ValueError
+        If the process already uses more memory than the limit allows
+    """
+
+    used = (current_rss_mb() if used is None else used) or 0
+    budget = memory_limit - used - RESERVE_MB
+    if budget <= 0:
+        raise ValueError(f'The memory limit of {memory_limit:.0f} MB is too '
+                         f'low: {used:.0f} MB are already used, and '
+                         f'{RESERVE_MB} MB are kept in reserve')
+
+    mb = 1024**2
+    if n_rows is not None and n_rows * BYTES_PER_EVENT / mb <= budget:
+        return {'mode': 'memory', 'budget_mb': budget,
+                'estimated_mb': n_rows * BYTES_PER_EVENT / mb}
+
+    chunksize = int(min(max(budget * mb / CHUNK_BYTES_PER_ROW,
+                            MIN_CHUNKSIZE), MAX_CHUNKSIZE))
+    if n_rows is None:
+        partitions = DEFAULT_PARTITIONS
+    else:
+        partitions = math.ceil(n_rows * PARTITION_BYTES_PER_EVENT *
+                               PARTITION_SKEW / (budget * mb))
+
+    return {'mode': 'partitioned', 'chunksize': chunksize,
+            'partitions': partitions, 'budget_mb': budget,
+            'estimated_mb': max(chunksize * CHUNK_BYTES_PER_ROW,
+                                (n_rows or 0) * PARTITION_BYTES_PER_EVENT *
+                                PARTITION_SKEW / partitions) / mb}
@@ -0,0 +1,157 @@
+"""Template-based rendering of the notification messages.
+
+A bundled notification only needs the name of the first friend and the
+number of tours to build its message. ``bundle(..., render=False)`` keeps
+them as a categorical 'name_first' column (an int code per row plus a
+dictionary of names) and the text is rendered only when it is written out,
+vectorized over whole columns. Other languages or wordings are supported by
+creating another ``MessageTemplates``.
+
+"""
+import string
+
+import numpy as np
+import pandas as pd
+
+
+class MessageTemplates:
+    """Message templates, chosen by the number of tours
+
+    Templates are ``str.format`` strings with the fields ``{name}`` (first
+    friend) and ``{others}`` (number of tours minus one).
+
+    Parameters
+    ----------
+    single : str
+        Template for 1 tour
+    one_other : str
+        Template for 2 tours
+    many : str
+        Template for 3 or more tours
+    """
+
+    def __init__(self, single, one_other, many):
+        self.templates = (single, one_other, many)
+
+    def select(self, tours):
+        """Template id of each notification
+
+        Parameters
+        ----------
+        tours : np.array of int
+            Number of tours
+
+        Returns
+        -------
+        np.array of int8
+            Position of the template in ``templates``
+        """
+
+        tours = np.asarray(tours)
+        if np.any(tours < 1):
+            raise ValueError('Number of tours not recognized.')
+
+        return (np.minimum(tours, 3) - 1).astype(np.int8)
+
+    def render(self, tours, name_first):
+        """Renders the messages of many notifications at once
+
+        Parameters
+        ----------
+        tours : np.array of int
+            Number of tours
+        name_first : array-like of str
+            Name of the first friend, or a pd.Categorical of names
+
+        Returns
+        -------
+        np.array of str
+            Messages, as an object array
+        """
+
+        tours = np.asarray(tours)
+        template_id = self.select(tours)
+        message = np.empty(len(tours), dtype=object)
+
+        for i, template in enumerate(self.templates):
+            mask = template_id == i
+            if not mask.any():
+                continue
+            fields = {'name': take_names(name_first, mask),
+                      'others': (tours[mask] - 1).astype(str).astype(object)}
+            message[mask] = format_columns(template, fields, mask.sum())
+
+        return message
+
+
+def take_names(name_first, mask):
+    """Names of the selected rows, as an object array"""
+
+    if isinstance(name_first, pd.Categorical):
+        names = name_first.categories.astype(str).to_numpy(dtype=object)
+        return names[name_first.codes[mask]]
+
+    return pd.Series(np.asarray(name_first, dtype=object)[mask]) \
+        .astype(str).to_numpy(dtype=object)
+
+
+def format_columns(template, fields, n):
+    """Vectorized ``str.format`` over columns of values
+
+    Parameters
+    ----------
+    template : str
+        Format string
+    fields : dict
+        Object array of values of each field
+    n : int
+        Number of rows
+
+    Returns
+    -------
+    np.array of str
+        Object array with the formatted strings
+    """
+
+    result = np.full(n, '', dtype=object)
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            result = result + literal
+        if field is not None:
+            result = result + fields[field]
+
+    return result
+
+
+# Default English templates, as in ``create_message_single``
+ENGLISH = MessageTemplates('{name} went on a tour',
+                           '{name} and 1 other went on a tour',
+                           '{name} and {others} others went on a tour')
+
+
+def render_messages(df, templates=ENGLISH):
+    """Adds the 'message' column to notifications bundled with
+    ``bundle(..., render=False)``
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Bundled notifications with the columns 'tours' and 'name_first'
+    templates : MessageTemplates
+        Templates of the messages
+
+    Returns
+    -------
+    pd.DataFrame
+        Copy of df where 'name_first' is replaced by 'message'
+    """
+
+    if 'name_first' not in df:
+        return df
+
+    name_first = df.name_first
+    if isinstance(name_first.dtype, pd.CategoricalDtype):
+        name_first = name_first.array
+
+    return df.drop(columns='name_first').assign(
+        message=templates.render(df.tours.to_numpy(), name_first))
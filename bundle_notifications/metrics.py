@@ -0,0 +1,270 @@
+"""Per-stage timers, counters and memory of a bundling run.
+
+A ``Metrics`` object is passed to ``bundle``, ``save_data`` and the
+streaming functions. Each stage of the pipeline is
+timed with ``Metrics.stage``, which accumulates wall and CPU time when a
+stage runs several times (e.g. once per block or per day). The CLI prints
+the report with ``--profile`` and saves it with ``--metrics-json``.
+
+Stages of a run, in order:
+
+- ``load``: reading and parsing the input
+- ``keys``: day numbers and (user, day) segment offsets
+- ``sort``: sorting the events by (user, day, time)
+- ``solve``: notification schedules
+- ``tours``: unique friends per notification
+- ``render``: message text
+- ``write``: writing the output
+
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # Not available on Windows
+
+STAGES = ('load', 'keys', 'sort', 'solve', 'tours', 'render', 'write')
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process, in MB
+
+    Returns
+    -------
+    float or None
+        None if it cannot be measured on this platform
+    """
+
+    if resource is None:  # pragma: no cover
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident memory of the process, in MB
+
+    Returns
+    -------
+    float or None
+        None if it cannot be measured on this platform
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except OSError:  # pragma: no cover
+        # Not Linux: the peak is an upper bound
+        return peak_rss_mb()
+
+    return pages * resource.getpagesize() / 1024**2
+
+
+def log2_bins(values):
+    """Histogram of positive integers in power-of-two bins
+
+    Parameters
+    ----------
+    values : np.array of int
+        Values, all greater than 0
+
+    Returns
+    -------
+    dict
+        Count of values per bin, with labels like ``'1'``, ``'2-3'``,
+        ``'4-7'``. Empty bins are left out.
+    """
+
+    values = np.asarray(values, dtype=np.int64)
+    counts = np.bincount(np.floor(np.log2(values)).astype(np.int64)) \
+        if len(values) else []
+
+    bins = {}
+    for e, count in enumerate(counts):
+        if count:
+            label = '1' if e == 0 else f'{2**e}-{2**(e + 1) - 1}'
+            bins[label] = int(count)
+
+    return bins
+
+
+class Metrics:
+    """Collects the metrics of a run
+
+    Parameters
+    ----------
+    progress : bool
+        If True, ``progress`` shows a progress bar with an ETA on stderr
+    memory_limit : float, optional
+        Memory limit of the run, in MB. The first stage that ends with a
+        peak memory above it is recorded in ``settings`` as
+        ``'memory_limit_exceeded'``, and the report compares the peak with
+        the limit.
+
+    Attributes
+    ----------
+    stages : dict
+        Wall time, CPU time (in seconds), number of calls and peak memory at
+        the end of each stage, by stage name
+    counters : dict
+        Integer counters, see ``count``
+    histograms : dict
+        Histograms in power-of-two bins, see ``histogram``
+    settings : dict
+        Parameters chosen during the run, see ``setting``
+    """
+
+    def __init__(self, progress=False, memory_limit=None):
+        self.show_progress = progress
+        self.memory_limit = memory_limit
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self.settings = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Times a stage. Times of repeated stages are added up."""
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(
+                name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stats['wall'] += time.perf_counter() - wall
+            stats['cpu'] += time.process_time() - cpu
+            stats['calls'] += 1
+            stats['peak_rss_mb'] = peak_rss_mb()
+            if self.memory_limit is not None and \
+                    stats['peak_rss_mb'] is not None and \
+                    stats['peak_rss_mb'] > self.memory_limit:
+                self.settings.setdefault('memory_limit_exceeded', name)
+
+    def iterate(self, iterable, name):
+        """Iterates while timing each step as the given stage, e.g. to time
+        the reading of the chunks of a file"""
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def count(self, name, value=1):
+        """Adds value to a counter"""
+
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def setting(self, name, value):
+        """Records a parameter of the run, e.g. a threshold"""
+
+        self.settings[name] = value
+
+    def histogram(self, name, values):
+        """Adds values to a histogram with power-of-two bins"""
+
+        bins = self.histograms.get(name, {})
+        for label, count in log2_bins(values).items():
+            bins[label] = bins.get(label, 0) + count
+
+        # Keep the bins sorted by their lower bound
+        self.histograms[name] = dict(sorted(
+            bins.items(), key=lambda item: int(item[0].split('-')[0])))
+
+    @contextmanager
+    def progress(self, label, length):
+        """Progress bar of a stage
+
+        Click shows the ETA from the throughput measured so far. Nothing is
+        shown unless the metrics were created with ``progress=True``.
+
+        Parameters
+        ----------
+        label : str
+            Text shown before the bar
+        length : int
+            Total amount of work, e.g. number of events
+
+        Yields
+        ------
+        callable
+            Function to call with the amount of work done since last call
+        """
+
+        if not self.show_progress:
+            yield lambda n: None
+            return
+
+        import click
+
+        with click.progressbar(length=length, label=label, show_eta=True,
+                               file=sys.stderr) as bar:
+            yield bar.update
+
+    def to_dict(self):
+        """Metrics as a dict of JSON-serializable values"""
+
+        return {'wall_time': time.perf_counter() - self.start,
+                'peak_rss_mb': peak_rss_mb(),
+                'memory_limit_mb': self.memory_limit,
+                'stages': self.stages,
+                'counters': self.counters,
+                'histograms': self.histograms,
+                'settings': self.settings}
+
+    def write_json(self, path):
+        """Saves the metrics to a JSON file"""
+
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        """Human-readable summary of the metrics
+
+        Returns
+        -------
+        str
+            One line per stage, in pipeline order, followed by the counters,
+            histograms and settings
+        """
+
+        order = [s for s in STAGES if s in self.stages] + \
+            [s for s in self.stages if s not in STAGES]
+        width = max([8] + [len(name) for name in order])
+        lines = [f'{"stage":<{width}} {"wall (s)":>10} {"cpu (s)":>10} '
+                 f'{"peak (MB)":>10}']
+        for name in order:
+            stats = self.stages[name]
+            peak = stats['peak_rss_mb']
+            peak = '-' if peak is None else f'{peak:.1f}'
+            lines.append(f'{name:<{width}} {stats["wall"]:>10.3f} '
+                         f'{stats["cpu"]:>10.3f} {peak:>10}')
+
+        lines.extend(f'{name}: {value}'
+                     for name, value in self.counters.items())
+        for name, bins in self.histograms.items():
+            lines.append(f'{name}: ' + ', '.join(
+                f'{label}: {count}' for label, count in bins.items()))
+        lines.extend(f'{name} = {value}'
+                     for name, value in self.settings.items())
+
+        peak = peak_rss_mb()
+        if peak is not None:
+            lines.append(f'peak memory: {peak:.1f} MB' + (
+                '' if self.memory_limit is None else
+                f' of {self.memory_limit:.0f} MB limit'))
+
+        return '\n'.join(lines)
@@ -0,0 +1,289 @@
+"""Online bundling: decide event by event whether to notify now.
+
+The optimal schedules of ``bundle`` are computed in hindsight, once all the
+events of the day are known. ``OnlineBundler`` takes decisions as the events
+arrive, keeping a small state per user and day:
+
+- While more than one notification is left in the daily budget, the pending
+  events are notified when the time since the last notification is at least
+  the remaining time of the day divided by the remaining budget. Sparse
+  users are therefore notified right away, and busy users get their
+  notifications spread along the day.
+- The last notification of the day is held until the day ends, see
+  ``OnlineBundler.flush``.
+
+The memory per user is bounded. The distinct friends pending since the last
+notification are kept in a set while there are at most
+``MAX_PENDING_FRIENDS``, so that their count is exact. Beyond that, e.g.
+for a bot, they are hashed into a fixed bitmap of ``BITMAP_BITS`` bits and
+counted by linear counting: the number of distinct friends is estimated
+from the fraction of bits still unset, within a few percent up to a few
+times ``BITMAP_BITS`` friends.
+
+"""
+import math
+from collections import namedtuple
+
+import pandas as pd
+
+from .bundle_notifications import create_message_single
+from .segments import DAY_NS
+
+# Same fields as the columns of the output of ``bundle``
+Notification = namedtuple('Notification', [
+    'notification_sent', 'timestamp_first_tour', 'tours', 'receiver_id',
+    'message'])
+
+# Pending friends of a user counted exactly, in a set
+MAX_PENDING_FRIENDS = 256
+
+# Size of the bitmap of pending friends beyond MAX_PENDING_FRIENDS, 1 KB
+BITMAP_BITS = 8192
+
+MASK64 = 2**64 - 1
+
+
+def mix_hash(value):
+    """Hash of a friend id with uniformly scrambled bits, so that
+    consecutive ids land on random bits. splitmix64 finalizer, like
+    ``cache.mix``, on Python integers."""
+
+    z = hash(value) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+class UserState:
+    """State of a user during a day. Only the friends pending since the last
+    notification are kept, and they are cleared when it is sent. They take
+    at most ``MAX_PENDING_FRIENDS`` set entries or ``BITMAP_BITS`` bits."""
+
+    __slots__ = ('day', 'n_sent', 'last_sent', 'first_ts', 'first_name',
+                 'friends', 'bitmap', 'n_bits')
+
+    def __init__(self, day):
+        self.day = day
+        self.n_sent = 0
+        self.last_sent = day * DAY_NS
+        self.first_ts = None
+        self.first_name = None
+        self.clear_friends()
+
+    def clear_friends(self):
+        """Forgets the pending friends"""
+
+        self.friends = set()
+        self.bitmap = None
+        self.n_bits = 0
+
+    def add_friend(self, friend_id):
+        """Adds a pending friend, switching to the bitmap when there are
+        more than ``MAX_PENDING_FRIENDS``"""
+
+        if self.bitmap is None:
+            self.friends.add(friend_id)
+            if len(self.friends) <= MAX_PENDING_FRIENDS:
+                return
+            self.bitmap = bytearray(BITMAP_BITS // 8)
+            friends, self.friends = self.friends, set()
+            for friend in friends:
+                self.set_bit(friend)
+        else:
+            self.set_bit(friend_id)
+
+    def set_bit(self, friend_id):
+        """Sets the bit of a friend in the bitmap"""
+
+        bit = mix_hash(friend_id) % BITMAP_BITS
+        if not self.bitmap[bit // 8] & (1 << bit % 8):
+            self.bitmap[bit // 8] |= 1 << bit % 8
+            self.n_bits += 1
+
+    def n_friends(self):
+        """Number of distinct pending friends: exact up to
+        ``MAX_PENDING_FRIENDS``, estimated by linear counting above"""
+
+        if self.bitmap is None:
+            return len(self.friends)
+
+        # Saturated bitmap: at least as many friends as if one bit was unset
+        unset = max(BITMAP_BITS - self.n_bits, 1)
+        return max(round(BITMAP_BITS * math.log(BITMAP_BITS / unset)),
+                   MAX_PENDING_FRIENDS + 1)
+
+
+class OnlineBundler:
+    """Stateful bundler that decides in O(1) per event
+
+    Parameters
+    ----------
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+
+    Examples
+    --------
+    ::
+
+        bundler = OnlineBundler()
+        for row in events:
+            notification = bundler.push(row.timestamp, row.user_id,
+                                        row.friend_id, row.friend_name)
+            if notification is not None:
+                send(notification)
+
+        # At midnight, send what is pending
+        for notification in bundler.flush(now):
+            send(notification)
+    """
+
+    def __init__(self, max_notifications=4):
+        self.max_notifications = max_notifications
+        self.users = {}
+        self.closed = []  # Pending notifications of days already over
+
+    def push(self, timestamp, user_id, friend_id, friend_name):
+        """Processes an event
+
+        Parameters
+        ----------
+        timestamp : int or datetime-like
+            Time of the event. Integers are nanoseconds since the epoch.
+        user_id : str
+            Receiver of the notification
+        friend_id : str or int
+            Friend who went on a tour
+        friend_name : str
+            Name of the friend
+
+        Returns
+        -------
+        Notification or None
+            Notification to send now, if any
+        """
+
+        if not isinstance(timestamp, int):
+            timestamp = pd.Timestamp(timestamp).value
+        day = timestamp // DAY_NS
+
+        state = self.users.get(user_id)
+        if state is None or state.day != day:
+            if state is not None and state.first_ts is not None:
+                self.closed.append(self.notify(state, user_id, None))
+            state = UserState(day)
+            self.users[user_id] = state
+
+        if state.first_ts is None:
+            state.first_ts = timestamp
+            state.first_name = friend_name
+        state.add_friend(friend_id)
+
+        # Spread the remaining budget over the remaining time of the day
+        budget = self.max_notifications - state.n_sent
+        if budget > 1 and (timestamp - state.last_sent) * budget >= \
+                (day + 1) * DAY_NS - state.last_sent:
+            return self.notify(state, user_id, timestamp)
+
+        return None
+
+    def notify(self, state, user_id, timestamp):
+        """Creates the notification of the pending events of a user and
+        resets them
+
+        Parameters
+        ----------
+        state : UserState
+            State of the user
+        user_id : str
+            Receiver of the notification
+        timestamp : int or None
+            Time when the notification is sent. If None, at the end of the
+            day.
+
+        Returns
+        -------
+        Notification
+        """
+
+        if timestamp is None:
+            timestamp = (state.day + 1) * DAY_NS - 1
+
+        tours = state.n_friends()
+        notification = Notification(
+            pd.Timestamp(timestamp), pd.Timestamp(state.first_ts), tours,
+            user_id, create_message_single(tours, state.first_name))
+
+        state.n_sent += 1
+        state.last_sent = timestamp
+        state.first_ts = None
+        state.first_name = None
+        state.clear_friends()
+
+        return notification
+
+    def flush(self, until=None):
+        """Sends the pending notifications of the days that are over, and
+        forgets those users
+
+        Parameters
+        ----------
+        until : int or datetime-like, optional
+            Current time. Days before it are closed. By default, all days.
+
+        Returns
+        -------
+        list of Notification
+            Notifications sent at the end of their day
+        """
+
+        if until is None:
+            day = None
+        elif isinstance(until, int):
+            day = until // DAY_NS
+        else:
+            day = pd.Timestamp(until).value // DAY_NS
+
+        notifications, self.closed = self.closed, []
+        for user_id, state in list(self.users.items()):
+            if day is None or state.day < day:
+                if state.first_ts is not None:
+                    notifications.append(self.notify(state, user_id, None))
+                del self.users[user_id]
+
+        return notifications
+
+    def replay(self, df):
+        """Replays a historical stream of events, e.g. from ``load_data``
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            DataFrame containing 4 columns:
+            ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+
+        Returns
+        -------
+        pd.DataFrame
+            Notifications in the order they were sent, with the same columns
+            as the output of ``bundle``
+        """
+
+        df = df.sort_values('timestamp', kind='stable')
+        timestamp_ns = df.timestamp.to_numpy('datetime64[ns]').view('int64')
+
+        notifications = []
+        current_day = None
+        for t, user_id, friend_id, friend_name in zip(
+                timestamp_ns.tolist(), df.user_id, df.friend_id,
+                df.friend_name):
+            # The clock passed midnight: close the previous days
+            if current_day is not None and t // DAY_NS > current_day:
+                notifications.extend(self.flush(t))
+            current_day = t // DAY_NS
+
+            notification = self.push(t, user_id, friend_id, friend_name)
+            if notification is not None:
+                notifications.append(notification)
+        notifications.extend(self.flush())
+
+        return pd.DataFrame(notifications, columns=Notification._fields)
@@ -2,13 +2,19 @@
 notification times.
 
 Functions decorated with @jit are not included in the coverage report.
+They are cached on disk (``cache=True``), so they are compiled once and then
+loaded by every new process instead of compiled again on first call.
 
 """
+import time
+
 import numpy as np
 from numba import jit
 
+from .solvers import AUTO, SOLVER_NAMES, SOLVERS
+
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def delay(t, x):  # pragma: no cover
     """Calculates delay if notifications are sent at indexes indicated by
     notification_idx
@@ -17,22 +23,133 @@ def delay(t, x):  # pragma: no cover
     ----------
     t : np.array
         Array containing the timestamps of the events
+    x : np.array of int
+        Indexes where the notifications are sent. The last notification is
+        always sent at the last element of t.
 
     Returns
     --------
-    datetime[ns]
-        Sum of total delay
+    float
+        Sum of total delay, in the unit of t. A float, since the delay of
+        a few hundred thousand events of a day in nanoseconds overflows an
+        int64.
     """
 
-    p1 = t[x[0]] - t[:x[0]]
-    p2 = t[x[1]] - t[x[0]+1:x[1]]
-    p3 = t[x[2]] - t[x[1]+1:x[2]]
-    p4 = t[-1] - t[(x[2]+1):]
+    total = 0.0
+    start = 0
+    for i in range(len(x)):
+        end = x[i] if i < len(x) - 1 else len(t) - 1
+        for m in range(start, end):
+            total += t[end] - t[m]
+        start = end + 1
+
+    return total
+
+
+# Maximum of the prefix sums, so that sums of batch delays cannot overflow
+# an int64
+MAX_PREFIX_SUM = 2**62
+
 
-    return p1.sum() + p2.sum() + p3.sum() + p4.sum()
+@jit(nopython=True, cache=True)
+def time_unit(r):  # pragma: no cover
+    """Unit of the relative timestamps r whose prefix sums stay below
+    ``MAX_PREFIX_SUM``
+
+    The sums grow as ``len(r) * r[-1]``: in nanoseconds, they overflow at
+    about 100 thousand events spread over a day. Then, the largest common
+    divisor of r is used if it is coarse enough, e.g. a second for
+    timestamps in whole seconds, so that the sums stay exact. Otherwise,
+    the smallest unit that fits, which rounds each relative timestamp down
+    by less than a unit.
+
+    Returns
+    --------
+    int
+        Unit, 1 if the sums fit as they are
+    """
 
+    N = len(r)
+    if N == 0 or N * float(r[N - 1]) <= MAX_PREFIX_SUM:
+        return 1
 
-def total_delay_brute(timestamp):  # pragma: no cover
+    g = 0
+    for i in range(N):
+        a, b = r[i], g
+        while b:
+            a, b = b, a % b
+        g = a
+    if N * float(r[N - 1] // g) <= MAX_PREFIX_SUM:
+        return g
+
+    return int(np.ceil(N * float(r[N - 1]) / MAX_PREFIX_SUM))
+
+
+@jit(nopython=True, cache=True)
+def prefix_sums(t):  # pragma: no cover
+    """Cumulative sums of the timestamps, relative to the first one
+
+    Timestamps are shifted by ``t[0]`` and divided by ``time_unit`` so that
+    the sums fit in an int64. The unit is 1 unless there are more than
+    about 100 thousand events in a day of nanoseconds, and the delays of
+    ``batch_delay`` are then in that unit. If the timestamps are not
+    multiples of the unit, the delay of each event is rounded by less than
+    a unit, tens of nanoseconds for a million events in a day, and the
+    solvers are exact up to that rounding.
+
+    Parameters
+    ----------
+    t : np.array (int)
+        Sorted array of timestamps
+
+    Returns
+    --------
+    r : np.array (int)
+        Timestamps relative to the first one, ``r = (t - t[0]) // unit``
+    P : np.array (int)
+        Array of length ``len(t) + 1`` where ``P[i] = r[:i].sum()``
+    """
+
+    N = len(t)
+    r = np.empty(N, dtype=np.int64)
+    P = np.zeros(N + 1, dtype=np.int64)
+    for i in range(N):
+        r[i] = t[i] - t[0]
+    unit = time_unit(r)
+    for i in range(N):
+        if unit > 1:
+            r[i] //= unit
+        P[i + 1] = P[i] + r[i]
+
+    return r, P
+
+
+@jit(nopython=True, cache=True)
+def batch_delay(r, P, i, j):  # pragma: no cover
+    """Delay of the events ``i..j`` (both included) if they are notified
+    together at ``j``. Runs in O(1) given the output of ``prefix_sums``.
+
+    Parameters
+    ----------
+    r : np.array (int)
+        Relative timestamps, see ``prefix_sums``
+    P : np.array (int)
+        Prefix sums of r, see ``prefix_sums``
+    i : int
+        First event of the batch
+    j : int
+        Last event of the batch, when the notification is sent
+
+    Returns
+    --------
+    int
+        Sum of ``r[j] - r[m]`` for ``m`` in ``i..j``
+    """
+
+    return (j - i + 1) * r[j] - (P[j + 1] - P[i])
+
+
+def total_delay_brute(timestamp, k=4):  # pragma: no cover
     """ Given a Series of Timestamps, calculate total delay using brute force:
     try out all possible combinations
 
@@ -43,11 +160,13 @@ def total_delay_brute(timestamp):  # pragma: no cover
     ----------
     t : np.array
         Array containing the timestamps of the events
+    k : int
+        Number of notifications to send
 
     Returns
     --------
     np.array
-        array of length 4. Each element indicates an index where the optimal
+        array of length k. Each element indicates an index where the optimal
         notification should be sent.
 
     """
@@ -56,7 +175,7 @@ def total_delay_brute(timestamp):  # pragma: no cover
 
     # Calculate possible combinations
     N = len(timestamp)
-    list_possible = list(it.combinations(list(range(0, N-1)), 3))
+    list_possible = list(it.combinations(list(range(0, N-1)), k-1))
 
     # Add last element to all
     list_possible = [list(tup)+[N-1] for tup in list_possible]
@@ -72,41 +191,455 @@ def total_delay_brute(timestamp):  # pragma: no cover
     return np.array(list_possible[np.argmin(tot_delay)])
 
 
+@jit(nopython=True, cache=True)
+def total_delay_enumerate(timestamp, k=4):  # pragma: no cover
+    """Exact optimization of the notification schedule by enumeration
+
+    Compiled version of ``total_delay_brute``: all the ``C(N-1, k-1)``
+    schedules are tried in lexicographic order, each one evaluated in O(k)
+    with ``prefix_sums``. It is faster than ``total_delay_dp`` for small N,
+    see ``auto_solvers``.
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps
+    k : int
+        Maximum number of notifications to send
+
+    Returns
+    --------
+    np.array
+        Optimal notification schedule. If there are k events or less, all of
+        them are notified.
+    """
+
+    N = len(timestamp)
+    if N <= k:
+        return np.arange(N)
+
+    r, P = prefix_sums(timestamp)
+
+    # Current combination of the first k-1 notifications
+    x = np.empty(k, dtype=np.int64)
+    for i in range(k - 1):
+        x[i] = i
+    x[k - 1] = N - 1
+    best = x.copy()
+    best_delay = schedule_delay(r, P, x)
+
+    while True:
+        # Next combination: increase the last position that can move
+        i = k - 2
+        while i >= 0 and x[i] == N - k + i:
+            i -= 1
+        if i < 0:
+            break
+        x[i] += 1
+        for j in range(i + 1, k - 1):
+            x[j] = x[j - 1] + 1
+
+        d = schedule_delay(r, P, x)
+        if d < best_delay:
+            best_delay = d
+            best[:] = x
+
+    return best
+
+
 # Heuristic: distribute equally along the day
-@jit(nopython=True)
-def total_delay_initial(timestamp):  # pragma: no cover
-    """ Given a Series of Timestamps, sample 4 points equally distributed
+@jit(nopython=True, cache=True)
+def total_delay_initial(timestamp, k=4):  # pragma: no cover
+    """ Given a Series of Timestamps, sample k points equally distributed
     index-wise
 
     Parameters
     ----------
     t : np.array
         Array containing the timestamps of the events
+    k : int
+        Number of notifications to send
 
     Returns
     --------
     np.array
-        array of length 4. Each element indicates an index where the initial
+        array of length k. Each element indicates an index where the initial
         optimal notification should be sent.
 
     """
     # Calculate possible combinations
     N = len(timestamp)
 
-    # Compute total delay.
-    x = [int(N/4), int(N/2), int(0.75*N), N-1]
+    # Compute total delay. For k=4: [N/4, N/2, 0.75*N, N-1]
+    x = np.empty(k, dtype=np.int64)
+    for i in range(k - 1):
+        x[i] = int((i + 1) * N / k)
+    x[k - 1] = N - 1
 
     # END
-    return np.array(x)
+    return x
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
+def total_delay_dp(timestamp, k=4):  # pragma: no cover
+    """Exact optimization of the notification schedule
+
+    Splits the sorted events into k consecutive batches, each one notified
+    at its last event, so that the total delay is minimal. Let ``D[c, j]``
+    be the minimal delay of the events ``0..j`` using ``c+1`` notifications,
+    the last one sent at ``j``::
+
+        D[c, j] = min_i D[c-1, i] + batch_delay(i+1, j)
+
+    The batch delay satisfies the quadrangle inequality, so the optimal
+    ``i`` is monotone in ``j`` and each layer is solved by divide and
+    conquer in O(N log N). Batch delays are O(1) thanks to ``prefix_sums``.
+    Total cost is O(k N log N) time and O(k N) memory.
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps, e.g. datetime64[ns] as int
+    k : int
+        Maximum number of notifications to send
+
+    Returns
+    --------
+    np.array
+        Optimal notification schedule. Each item corresponds to an index of
+        timestamp where the notification should have been sent. If there are
+        k events or less, all of them are notified.
+    """
+
+    N = len(timestamp)
+    if N <= k:
+        return np.arange(N)
+
+    r, P = prefix_sums(timestamp)
+
+    return candidates_dp(r, P, np.arange(N), k)
+
+
+@jit(nopython=True, cache=True)
+def candidates_dp(r, P, cand, k):  # pragma: no cover
+    """Dynamic program of ``total_delay_dp``, with the notifications
+    restricted to a subset of the events
+
+    Parameters
+    ----------
+    r : np.array (int)
+        Relative timestamps, see ``prefix_sums``
+    P : np.array (int)
+        Prefix sums of r, see ``prefix_sums``
+    cand : np.array of int
+        Sorted events where a notification can be sent. The last one must
+        be the last event.
+    k : int
+        Maximum number of notifications to send
+
+    Returns
+    --------
+    np.array
+        Best schedule among the candidates. All of them are notified if
+        there are k or less.
+    """
+
+    M = len(cand)
+    if M <= k:
+        return cand.copy()
+
+    # Layer 0: a single notification sent at cand[j]
+    prev = np.empty(M, dtype=np.int64)
+    for j in range(M):
+        prev[j] = batch_delay(r, P, 0, cand[j])
+
+    # arg[c, j]: end of the previous batch in the best solution for D[c, j]
+    arg = np.zeros((k, M), dtype=np.int64)
+    cur = np.empty(M, dtype=np.int64)
+    stack = np.empty((130, 4), dtype=np.int64)
+
+    for c in range(1, k):
+        # Explicit stack of (lo, hi, opt_lo, opt_hi) instead of recursion
+        stack[0, 0] = c
+        stack[0, 1] = M - 1
+        stack[0, 2] = c - 1
+        stack[0, 3] = M - 2
+        top = 1
+        while top > 0:
+            top -= 1
+            lo = stack[top, 0]
+            hi = stack[top, 1]
+            opt_lo = stack[top, 2]
+            opt_hi = stack[top, 3]
+            if lo > hi:
+                continue
+
+            mid = (lo + hi) // 2
+            best_i = opt_lo
+            best_f = prev[opt_lo] + batch_delay(r, P, cand[opt_lo] + 1,
+                                                cand[mid])
+            for i in range(opt_lo + 1, min(mid - 1, opt_hi) + 1):
+                f = prev[i] + batch_delay(r, P, cand[i] + 1, cand[mid])
+                if f < best_f:
+                    best_f = f
+                    best_i = i
+            cur[mid] = best_f
+            arg[c, mid] = best_i
+
+            stack[top, 0] = lo
+            stack[top, 1] = mid - 1
+            stack[top, 2] = opt_lo
+            stack[top, 3] = best_i
+            stack[top + 1, 0] = mid + 1
+            stack[top + 1, 1] = hi
+            stack[top + 1, 2] = best_i
+            stack[top + 1, 3] = opt_hi
+            top += 2
+
+        prev[:] = cur
+
+    # Backtrack from the last candidate
+    j = np.empty(k, dtype=np.int64)
+    j[k - 1] = M - 1
+    for c in range(k - 1, 0, -1):
+        j[c - 1] = arg[c, j[c]]
+
+    # END
+    return cand[j]
+
+
+@jit(nopython=True, cache=True)
+def total_delay_bucketed(timestamp, k=4, buckets=1024,
+                         max_moves=64):  # pragma: no cover
+    """Approximate optimization of the notification schedule in O(N)
+
+    The time range of the events is split in ``buckets`` intervals of equal
+    length and notifications may only be sent at the last event of each
+    interval. ``candidates_dp`` finds the best such schedule in
+    O(k B log B) for B buckets. The moves of ``local_search_converge`` then
+    shift the notifications to any event, which only lowers the delay.
+
+    Error bound: moving each notification of the optimal schedule to the
+    last event of its interval delays each event by at most the length of
+    an interval, and the result is one of the schedules considered. So the
+    total delay exceeds the optimum by at most ``N * (t[-1] - t[0]) / B``:
+    the mean delay per event is at most ``(t[-1] - t[0]) / B`` above the
+    optimal mean, e.g. 84 seconds for a day and 1024 buckets. Above about
+    100 thousand events in a day of nanoseconds, delays are rounded to the
+    unit of ``prefix_sums``, which adds less than a unit per event.
+
+    The cost is O(N + k B log B + max_moves k log N) whatever the
+    distribution of the events, so it bounds the time of user-days that are
+    too large for ``total_delay_dp``. The local search alone is usually a
+    bit faster, but has no error bound.
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps
+    k : int
+        Maximum number of notifications to send
+    buckets : int
+        Number of intervals. More buckets lower the error bound and cost
+        O(k B log B).
+    max_moves : int
+        Maximum number of local search moves after the DP
+
+    Returns
+    --------
+    np.array
+        Notification schedule. All events are notified if there are k or
+        less.
+    """
+
+    N = len(timestamp)
+    if N <= k:
+        return np.arange(N)
+
+    r, P = prefix_sums(timestamp)
+
+    # Last event of each non-empty interval. The last event is a candidate.
+    scale = buckets / (r[N - 1] + 1)
+    cand = np.empty(min(N, buckets), dtype=np.int64)
+    M = 0
+    bucket = 0
+    for i in range(1, N):
+        b = int(r[i] * scale)
+        if b != bucket:
+            cand[M] = i - 1
+            M += 1
+            bucket = b
+    cand[M] = N - 1
+    M += 1
+
+    # Refine with the moves of local_search_converge, at most max_moves
+    x = candidates_dp(r, P, cand[:M], k)
+    n_moves = 0
+    while n_moves < max_moves:
+        x, n_neg = descend(r, P, x, -1, 2, max_moves - n_moves)
+        x, n_pos = descend(r, P, x, 1, 2, max_moves - n_moves - n_neg)
+        n_moves += n_neg + n_pos
+        if n_neg + n_pos == 0:
+            break
+
+    return x
+
+
+@jit(nopython=True, cache=True)
+def schedule_delay(r, P, x):  # pragma: no cover
+    """Total delay of the schedule x in O(len(x)). Equivalent to ``delay``
+    given the output of ``prefix_sums``.
+
+    Parameters
+    ----------
+    r : np.array (int)
+        Relative timestamps, see ``prefix_sums``
+    P : np.array (int)
+        Prefix sums of r, see ``prefix_sums``
+    x : np.array of int
+        Indexes where the notifications are sent
+
+    Returns
+    --------
+    int
+        Sum of total delay, in the unit of r
+    """
+
+    total = 0
+    start = 0
+    for i in range(len(x)):
+        end = x[i] if i < len(x) - 1 else len(r) - 1
+        total += batch_delay(r, P, start, end)
+        start = end + 1
+
+    return total
+
+
+@jit(nopython=True, cache=True)
+def shift_gain(r, P, x, k, m, d):  # pragma: no cover
+    """Delay saved by shifting the m consecutive notifications
+    ``x[k], ..., x[k+m-1]`` by d positions. Only the m+1 batches around them
+    change, so the cost is O(m) regardless of the number of events.
+
+    Parameters
+    ----------
+    r : np.array (int)
+        Relative timestamps, see ``prefix_sums``
+    P : np.array (int)
+        Prefix sums of r, see ``prefix_sums``
+    x : np.array of int
+        Indexes where the notifications are sent
+    k : int
+        First notification to shift. The last notification is never moved.
+    m : int
+        Number of consecutive notifications to shift (1 or 2 in practice)
+    d : int
+        Number of positions to shift, negative or positive
+
+    Returns
+    --------
+    gain : int
+        Old delay minus new delay. Positive if the move improves.
+    valid : bool
+        False if the move would leave an empty batch
+    """
+
+    K = len(x)
+    if k + m > K - 1:
+        return 0, False
+
+    lo = x[k - 1] + 1 if k > 0 else 0
+    hi = x[k + m] if k + m < K - 1 else len(r) - 1
+    if x[k] + d < lo or x[k + m - 1] + d >= hi:
+        return 0, False
+
+    gain = 0
+    start_old = lo
+    start_new = lo
+    for i in range(k, k + m):
+        gain += batch_delay(r, P, start_old, x[i])
+        gain -= batch_delay(r, P, start_new, x[i] + d)
+        start_old = x[i] + 1
+        start_new = x[i] + d + 1
+    gain += batch_delay(r, P, start_old, hi)
+    gain -= batch_delay(r, P, start_new, hi)
+
+    return gain, True
+
+
+@jit(nopython=True, cache=True)
+def descend(r, P, x, sign, max_shift, max_iter):  # pragma: no cover
+    """Steepest descent over shift moves in one direction
+
+    At each iteration, every block of 1 to max_shift consecutive
+    notifications is shifted by ``sign * step`` with ``step = 1, 2, 4, ...``
+    and the best strictly improving move is applied. Each candidate move
+    costs O(1), see ``shift_gain``.
+
+    Parameters
+    ----------
+    r : np.array (int)
+        Relative timestamps, see ``prefix_sums``
+    P : np.array (int)
+        Prefix sums of r, see ``prefix_sums``
+    x : np.array of int
+        Indexes where the notifications are sent. Modified in place.
+    sign : int
+        -1 for negative moves, +1 for positive moves
+    max_shift : int
+        Maximum number of consecutive notifications moved together.
+        1 only moves single notifications, 2 also moves pairs (2-opt style).
+    max_iter : int
+        Maximum number of moves to apply
+
+    Returns
+    --------
+    x : np.array
+        Optimized notification schedule
+    n_iter : int
+        Number of moves applied
+    """
+
+    N = len(r)
+    K = len(x)
+    n_iter = 0
+    while n_iter < max_iter:
+        best_gain = 0
+        best_k = -1
+        best_m = 0
+        best_d = 0
+        for m in range(1, max_shift + 1):
+            for k in range(0, K - m):
+                step = 1
+                while step < N:
+                    gain, valid = shift_gain(r, P, x, k, m, sign * step)
+                    if not valid:
+                        break
+                    if gain > best_gain:
+                        best_gain = gain
+                        best_k = k
+                        best_m = m
+                        best_d = sign * step
+                    step *= 2
+
+        # No improving move left: local optimum
+        if best_k < 0:
+            break
+
+        for i in range(best_k, best_k + best_m):
+            x[i] += best_d
+        n_iter += 1
+
+    return x, n_iter
+
+
+@jit(nopython=True, cache=True)
 def local_search_negative(timestamp, x, max_iter=20):  # pragma: no cover
     """Local search negative step
 
     Parameters
     ----------
-    t : np.array (DateTime)
+    t : np.array (int)
         array of timestamps
     x : list of int
         Indicate indexes where the notification is sent
@@ -120,110 +653,254 @@ def local_search_negative(timestamp, x, max_iter=20):  # pragma: no cover
         optimized notification schedule. Each item corresponds to an index of t
     """
 
-    i = 0
+    r, P = prefix_sums(timestamp)
+    x, n_iter = descend(r, P, x, -1, 1, max_iter)
 
-    while i < max_iter:
-        # Calculate initial delay
-        f = delay(timestamp, x)
-        i += 1
-        max_improve = -9999999999
+    return x
 
-        # Now try to decrease the notification indexes one by one.
-        # Keep solution if improves.
-        for k in range(0, 3):
 
-            if x[k] == 0:
-                continue
+@jit(nopython=True, cache=True)
+def local_search_positive(timestamp, x, max_iter=20):  # pragma: no cover
+    """Local search positive step
 
-            x_aux = x.copy()
-            x_aux[k] -= 1
-            f1 = delay(timestamp, x_aux)
-            improve = f - f1
-            # print(f"{k} Total delay swap: {f1} x_aux: {x_aux}")
+    Parameters
+    ----------
+    t : np.array (int)
+        array of timestamps
+    x : list of int
+        Indicate indexes where the notification is sent
+    max_iter : int
+        Maximum number of local search steps to be performed
 
-            if improve > max_improve:
-                max_improve = improve
-                k_improve = k
+    Returns
+    --------
+    np.array
+        optimized notification schedule. Each item corresponds to an index of t
 
-        # Now we've got the most improving index. If no improvement: stop
-        if max_improve < 0:
-            i = max_iter + 100
-            return x
+    """
 
-        # If there is improvement then swap and repeat
-        else:
-            x[k_improve] -= 1
-            i += 1
+    r, P = prefix_sums(timestamp)
+    x, n_iter = descend(r, P, x, 1, 1, max_iter)
 
     return x
 
 
-@jit(nopython=True)
-def local_search_positive(timestamp, x, max_iter=20):  # pragma: no cover
-    """Local search negative step
+@jit(nopython=True, cache=True)
+def local_search_converge(timestamp, x, max_iter):  # pragma: no cover
+    """Alternates negative and positive moves, of single notifications and
+    pairs of notifications, until no move improves the total delay.
 
     Parameters
     ----------
-    t : np.array (DateTime)
+    t : np.array (int)
         array of timestamps
-    x : list of int
-        Indicate indexes where the notification is sent
+    x : np.array of int
+        Initial schedule. Modified in place.
     max_iter : int
-        Maximum number of local search steps to be performed
+        Maximum number of moves to apply
+
+    Returns
+    --------
+    x : np.array
+        Locally optimal notification schedule
+    n_iter : int
+        Number of moves applied
+    """
+
+    r, P = prefix_sums(timestamp)
+    n_iter = 0
+    while n_iter < max_iter:
+        x, n_neg = descend(r, P, x, -1, 2, max_iter - n_iter)
+        x, n_pos = descend(r, P, x, 1, 2, max_iter - n_iter - n_neg)
+        n_iter += n_neg + n_pos
+        if n_neg + n_pos == 0:
+            break
+
+    return x, n_iter
+
+
+# Maximum number of sweeps of ``rolling_refine``, so that the rolling
+# schedule costs O(N*k) whatever the events
+ROLLING_SWEEPS = 8
+
+
+@jit(nopython=True, cache=True)
+def rolling_schedule(timestamp, k, window,
+                     max_sweeps=ROLLING_SWEEPS):  # pragma: no cover
+    """Notification schedule with at most k notifications in any rolling
+    window, computed in one pass over the whole history of a user
+
+    Events are scanned in time order and each one is first notified right
+    away. When the last k+1 notifications fall within the window, the
+    cheapest of the first k of them is merged into the next one, i.e. its
+    events wait for the next notification. Merging batch j into batch j+1
+    adds ``n_j * (t[x[j+1]] - t[x[j]])`` to the total delay, where n_j is
+    the number of events of batch j. One merge always restores the
+    constraint, so the cost is O(N*k). The schedule is then improved by
+    at most max_sweeps sweeps of ``rolling_refine``, O(N) each.
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps of all the events of a user
+    k : int
+        Maximum number of notifications in any window
+    window : int
+        Length of the window, in the unit of timestamp (e.g. ``DAY_NS``)
+    max_sweeps : int
+        Maximum number of sweeps of ``rolling_refine``
 
     Returns
     --------
     np.array
-        optimized notification schedule. Each item corresponds to an index of t
+        Notification schedule. The last event is always notified, and
+        ``t[x[j+k]] - t[x[j]] >= window`` for all j.
+    """
+
+    N = len(timestamp)
+    x = np.empty(N, dtype=np.int64)
+    size = np.empty(N, dtype=np.int64)  # Events in each batch
+    m = 0  # Number of notifications
+
+    for i in range(N):
+        x[m] = i
+        size[m] = 1
+        m += 1
+        if m <= k or timestamp[i] - timestamp[x[m - k - 1]] >= window:
+            continue
+
+        # Cheapest merge among the k notifications before i
+        best = m - k - 1
+        best_cost = size[best] * (timestamp[x[best + 1]] - timestamp[x[best]])
+        for j in range(m - k, m - 1):
+            cost = size[j] * (timestamp[x[j + 1]] - timestamp[x[j]])
+            if cost < best_cost:
+                best = j
+                best_cost = cost
+
+        size[best + 1] += size[best]
+        for j in range(best, m - 1):
+            x[j] = x[j + 1]
+            size[j] = size[j + 1]
+        m -= 1
+
+    x, _ = rolling_refine(timestamp, x[:m].copy(), k, window, max_sweeps)
+    return x
+
+
+@jit(nopython=True, cache=True)
+def rolling_refine(timestamp, x, k, window, max_sweeps):  # pragma: no cover
+    """Improves a rolling-window schedule by coordinate descent
 
+    Each notification but the last one is moved to the best event between
+    its two neighbours that keeps at most k notifications in any window,
+    i.e. at least ``window`` after the notification k places before and
+    at least ``window`` before the one k places after. The delays of the
+    two batches around it are updated incrementally while scanning the
+    candidates, so a sweep costs O(N). Sweeps are repeated until no
+    notification moves, or max_sweeps times. Each sweep only lowers the
+    delay, and the first ones move most notifications, so the cap keeps
+    the cost linear at little loss.
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps
+    x : np.array of int
+        Feasible schedule, see ``rolling_schedule``. Modified in place.
+    k : int
+        Maximum number of notifications in any window
+    window : int
+        Length of the window, in the unit of timestamp
+    max_sweeps : int
+        Maximum number of sweeps
+
+    Returns
+    --------
+    x : np.array
+        Improved schedule
+    n_sweeps : int
+        Number of sweeps run
     """
 
-    i = 0
-    while i < max_iter:
+    m = len(x)
+    improved = True
+    n_sweeps = 0
+    while improved and n_sweeps < max_sweeps:
+        improved = False
+        n_sweeps += 1
+        for j in range(m - 1):
+            lo = x[j - 1] + 1 if j > 0 else 0
+            hi = x[j + 1]
+            T = timestamp[hi]
 
-        # Calculate initial delay
-        f = delay(timestamp, x)
-        i += 1
-        max_improve = -9999999999
+            # Delay of the batches lo..p and p+1..hi, starting at p = lo
+            cost1 = 0
+            cost2 = 0
+            for e in range(lo + 1, hi + 1):
+                cost2 += T - timestamp[e]
 
-        # Now try to decrease the notification indexes one by one.
-        # Keep solution if improves.
-        for k in range(0, 3):
-            if x[k] == 0:
-                continue
+            best = -1
+            best_cost = 0
+            current = 0
+            for p in range(lo, hi):
+                if p > lo:
+                    cost1 += (p - lo) * (timestamp[p] - timestamp[p - 1])
+                    cost2 -= T - timestamp[p]
+                if p == x[j]:
+                    current = cost1 + cost2
+                if j >= k and timestamp[p] - timestamp[x[j - k]] < window:
+                    continue
+                if j + k < m and timestamp[x[j + k]] - timestamp[p] < window:
+                    break
+                if best < 0 or cost1 + cost2 < best_cost:
+                    best = p
+                    best_cost = cost1 + cost2
 
-            x_aux = x.copy()
-            x_aux[k] += 1
-            f1 = delay(timestamp, x_aux)
-            improve = f - f1
-            # print(f"{k} Total delay swap: {f1} x_aux: {x_aux}")
+            if best >= 0 and best_cost < current:
+                x[j] = best
+                improved = True
 
-            if improve > max_improve:
-                max_improve = improve
-                k_improve = k
+    return x, n_sweeps
 
-        # Now we've got the most improving index. If no improvement: stop
-        if max_improve < 0:
-            i = max_iter + 100
-            return x
 
-        # If there is improvement then swap and repeat
-        else:
-            x[k_improve] += 1
-            i += 1
+def as_int_timestamp(timestamp):
+    """Casts timestamps to an int64 array, as preferred by the JIT compiler
 
-    return x
+    Parameters
+    ----------
+    timestamp : np.array or pd.Series
+        Integer timestamps or datetime64 values of any unit
+
+    Returns
+    --------
+    np.array (int64)
+        Timestamps as integers. datetime64 values are cast to nanoseconds.
+    """
+
+    timestamp = np.asarray(timestamp)
+    if timestamp.dtype.kind == 'M':
+        return timestamp.astype('datetime64[ns]').view('int64')
 
+    return timestamp.astype('int64', copy=False)
 
-def local_search(timestamp):
+
+def local_search(timestamp, k=4, max_iter=None):
     """Heuristic optimization of the notification schedule
 
+    Starts from ``total_delay_initial`` and runs ``local_search_converge``.
+    The delay of each candidate move is evaluated in O(1) with prefix sums,
+    so the cost per move does not depend on the number of events.
+
     Parameters
     ----------
-    t : np.array (int)
-        Array of integer values. These could correspond to datetime64[ns].
-        The inputs needs to be an integer as it is better supported by the JIT
-        compiler (TODO: allow for datetime64 type)
+    t : np.array (int or datetime64)
+        Sorted array of timestamps. Integer values could correspond to
+        datetime64[ns].
+    k : int
+        Number of notifications to send
+    max_iter : int, optional
+        Maximum number of moves. By default, run until convergence.
 
     Returns
     --------
@@ -232,13 +909,301 @@ def local_search(timestamp):
         where the notification should have been sent.
     """
 
-    # Initial solution
-    x = total_delay_initial(timestamp)
+    timestamp = as_int_timestamp(timestamp)
+    if max_iter is None:
+        max_iter = np.iinfo(np.int64).max
 
-    # Negative moves
-    x = local_search_negative(timestamp, x)
+    # Initial solution
+    x = total_delay_initial(timestamp, k)
 
-    # Postive moves
-    x = local_search_positive(timestamp, x)
+    # Negative and positive moves until convergence
+    x, _ = local_search_converge(timestamp, x, max_iter)
 
     return np.array(x)
+
+
+# Number of intervals and of refining moves of the 'bucketed' solver, see
+# ``total_delay_bucketed``
+BUCKETS = 1024
+BUCKET_MOVES = 64
+
+# Segments with more schedules than this are solved by the DP when
+# 'enumerate' is chosen: there are C(N-1, k-1) schedules of N events, so
+# enumeration would hang on long segments. At O(k) per schedule, this is
+# about a millisecond.
+ENUMERATE_MAX_SCHEDULES = 10**5
+
+# Limits of the 'auto' solver: exact enumeration of up to 'enumerate'
+# schedules, exact DP for up to 'dp' events, local search for up to
+# 'local_search' events and the bucketed solver above. The local search has
+# no error bound, so it is not used by default. They can be changed, or
+# measured on the current machine with ``calibrate``.
+AUTO_THRESHOLDS = {'enumerate': 35, 'dp': 5000, 'local_search': 0}
+
+# Upper bound on the number of local search moves, i.e. run to convergence
+MAX_ITER = 2**62
+
+
+@jit(nopython=True, cache=True)
+def count_schedules(N, k):  # pragma: no cover
+    """Number of schedules ``C(N-1, k-1)`` of N > k events, as a float"""
+
+    count = 1.0
+    for i in range(1, k):
+        count = count * (N - k + i) / i
+
+    return count
+
+
+@jit(nopython=True, cache=True)
+def schedule_iter(timestamp, k, solver_id):  # pragma: no cover
+    """Compiled dispatch of the solvers, so that it can be called from other
+    compiled functions
+
+    Parameters
+    ----------
+    timestamp : np.array (int)
+        Sorted array of integer timestamps
+    k : int
+        Maximum number of notifications to send
+    solver_id : int
+        Value of ``SOLVERS`` for the chosen method
+
+    Returns
+    --------
+    x : np.array
+        Notification schedule. All events are notified if there are k or less.
+    n_iter : int
+        Number of local search moves applied. 0 if the initial solution was
+        already a local optimum, or if local search was not used.
+    """
+
+    N = len(timestamp)
+    if N <= k:
+        return np.arange(N), 0
+
+    if solver_id == 1:
+        return total_delay_dp(timestamp, k), 0
+    if solver_id == 2 and \
+            count_schedules(N, k) <= ENUMERATE_MAX_SCHEDULES:
+        return total_delay_enumerate(timestamp, k), 0
+    if solver_id == 2:
+        return total_delay_dp(timestamp, k), 0
+    if solver_id == 3:
+        return total_delay_bucketed(timestamp, k, BUCKETS, BUCKET_MOVES), 0
+
+    x = total_delay_initial(timestamp, k)
+    return local_search_converge(timestamp, x, MAX_ITER)
+
+
+@jit(nopython=True, cache=True)
+def schedule(timestamp, k, solver_id):  # pragma: no cover
+    """Notification schedule computed by ``schedule_iter``
+
+    Returns
+    --------
+    np.array
+        Notification schedule. All events are notified if there are k or less.
+    """
+
+    x, _ = schedule_iter(timestamp, k, solver_id)
+    return x
+
+
+def optimal_schedule(timestamp, k=4, solver='local_search'):
+    """Computes the notification schedule with the chosen solver
+
+    Parameters
+    ----------
+    timestamp : np.array (int or datetime64)
+        Sorted array of timestamps
+    k : int
+        Maximum number of notifications to send
+    solver : str
+        One of the keys of ``SOLVERS``: ``'local_search'`` (heuristic),
+        ``'dp'`` or ``'enumerate'`` (exact), ``'bucketed'`` (approximate,
+        with an error bound), or ``'auto'`` to choose one from the number of
+        events, see ``auto_solvers``
+
+    Returns
+    --------
+    np.array
+        Notification schedule. Each item corresponds to an index of timestamp
+        where the notification should have been sent.
+    """
+
+    timestamp = as_int_timestamp(timestamp)
+    if solver == AUTO:
+        id_ = auto_solvers(np.array([len(timestamp)]), k)[0]
+    else:
+        id_ = solver_id(solver)
+
+    return np.array(schedule(timestamp, k, id_))
+
+
+def binomial(n, r):
+    """Binomial coefficient ``C(n, r)`` of non-negative integers
+
+    Exact integer product, since ``math.comb`` needs Python 3.8
+    """
+
+    if r < 0 or r > n:
+        return 0
+    r = min(r, n - r)
+    result = 1
+    for i in range(1, r + 1):
+        # Exact at each step: the product of i consecutive integers is
+        # divisible by i!
+        result = result * (n - r + i) // i
+
+    return result
+
+
+def n_schedules(sizes, k):
+    """Number of possible schedules of segments, ``C(n-1, k-1)`` for n
+    events, or 1 if they are at most k
+
+    Parameters
+    ----------
+    sizes : np.array of int
+        Number of events of each segment
+    k : int
+        Maximum number of notifications
+
+    Returns
+    --------
+    np.array of float
+        Number of schedules. Floats, since they overflow integers quickly.
+    """
+
+    uniques, inverse = np.unique(sizes, return_inverse=True)
+    counts = np.array([float(binomial(n - 1, k - 1)) if n > k else 1.0
+                       for n in uniques])
+
+    return counts[inverse] if len(uniques) else np.empty(0)
+
+
+def auto_solvers(sizes, k, thresholds=None):
+    """Chooses the solver of each segment from its number of events
+
+    Exact enumeration costs O(k) per schedule, so it is used while there are
+    few schedules to try. Exact DP costs O(k N log N), so it is used up to a
+    number of events. Larger segments, which would take too long to solve
+    exactly, get the bucketed solver, whose time and error are bounded (see
+    ``total_delay_bucketed``).
+
+    With the default thresholds, each segment is therefore solved either
+    exactly, or with a mean delay per event at most ``1 / BUCKETS`` of its
+    time range above the optimum, in O(N) time. A ``'local_search'``
+    threshold above ``'dp'`` gives the segments in between to the local
+    search instead, which is often faster than the DP but has no error
+    bound and runs until no move improves.
+
+    Parameters
+    ----------
+    sizes : np.array of int
+        Number of events of each segment
+    k : int
+        Maximum number of notifications
+    thresholds : dict, optional
+        ``'enumerate'``: maximum number of schedules to enumerate,
+        ``'dp'`` and ``'local_search'``: maximum number of events for the
+        DP and for the local search. By default, ``AUTO_THRESHOLDS``.
+
+    Returns
+    --------
+    np.array of int
+        Value of ``SOLVERS`` for each segment
+    """
+
+    thresholds = thresholds or AUTO_THRESHOLDS
+    sizes = np.asarray(sizes)
+    ids = np.full(len(sizes), SOLVERS['bucketed'], dtype=np.int64)
+    ids[sizes <= thresholds['local_search']] = SOLVERS['local_search']
+    ids[sizes <= thresholds['dp']] = SOLVERS['dp']
+    ids[n_schedules(sizes, k) <= thresholds['enumerate']] = \
+        SOLVERS['enumerate']
+
+    return ids
+
+
+@jit(nopython=True, cache=True)
+def schedule_blocks(timestamp, n, k, solver_id):  # pragma: no cover
+    """Solves consecutive blocks of n events, to time the solvers"""
+
+    for a in range(0, len(timestamp) - n + 1, n):
+        schedule_iter(timestamp[a:a + n], k, solver_id)
+
+
+def calibrate(k=4, budget=1e-3, n_events=200000, seed=0):
+    """Measures the thresholds of the 'auto' solver on this machine
+
+    Enumeration is used while it is faster than the DP, and the DP while it
+    solves a segment within the time budget. Each size is timed on many
+    random segments, so that the call overhead is not measured. Whether to
+    use the local search is about error bounds, not time, so its threshold
+    is kept from ``AUTO_THRESHOLDS``.
+
+    Parameters
+    ----------
+    k : int
+        Maximum number of notifications
+    budget : float
+        Maximum time to solve a segment exactly, in seconds
+    n_events : int
+        Number of events solved to time each size
+    seed : int
+        Seed of the random timestamps
+
+    Returns
+    --------
+    dict
+        Thresholds, see ``auto_solvers``. Assign them to
+        ``AUTO_THRESHOLDS`` to use them by default.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    def seconds(solver, n):
+        m = max(n_events // n, 1)
+        timestamp = np.sort(rng.randint(0, 86400 * 10**9, (m, n)), axis=1)
+        timestamp = timestamp.ravel().astype(np.int64)
+        schedule_blocks(timestamp[:n], n, k, SOLVERS[solver])  # Compile
+        start = time.perf_counter()
+        schedule_blocks(timestamp, n, k, SOLVERS[solver])
+        return (time.perf_counter() - start) / m
+
+    # Above ENUMERATE_MAX_SCHEDULES, 'enumerate' runs the DP
+    n = k + 1
+    while count_schedules(n, k) <= ENUMERATE_MAX_SCHEDULES and \
+            seconds('enumerate', n) < seconds('dp', n):
+        n += 1
+    enumerate_max = int(n_schedules(np.array([n - 1]), k)[0])
+
+    n = 64
+    while n < 2**24 and seconds('dp', 2 * n) <= budget:
+        n *= 2
+
+    return {'enumerate': enumerate_max, 'dp': n,
+            'local_search': AUTO_THRESHOLDS['local_search']}
+
+
+def solver_id(solver):
+    """Returns the id of a solver, raising an error if it is unknown
+
+    Parameters
+    ----------
+    solver : str
+        Name of the solver, one of the keys of ``SOLVERS``
+
+    Returns
+    --------
+    int
+        Id used by ``schedule``
+    """
+
+    if solver not in SOLVERS:
+        raise ValueError(f'Solver not recognized: {solver}. '
+                         f'Use one of {SOLVER_NAMES}')
+
+    return SOLVERS[solver]
@@ -0,0 +1,129 @@
+"""Multi-core bundling with a process pool.
+
+The (user, day) segments are independent, so they are split in shards by a
+stable hash of the user id and each shard is solved in a separate process.
+The sorted arrays are not pickled: they are saved once to a temporary
+directory and every worker opens them as read-only memory-mapped arrays,
+sharing the page cache. Workers only send back the (small) bundled results,
+which are merged in the same order as the single-process engine.
+
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .segments import solve_segments
+
+# Arrays shared with the workers
+SHARED_ARRAYS = ('timestamp', 'friend_code', 'starts', 'ends', 'shard')
+
+
+def user_shards(user_id, n_jobs):
+    """Assigns users to shards with a stable hash
+
+    The hash does not depend on the process or on the order of the users, so
+    a user always lands in the same shard for a given n_jobs.
+
+    Parameters
+    ----------
+    user_id : array-like of str
+        User ids
+    n_jobs : int
+        Number of shards
+
+    Returns
+    -------
+    np.array of int
+        Shard of each user, from 0 to n_jobs-1
+    """
+
+    user_id = np.asarray(user_id, dtype=object)
+    return (pd.util.hash_array(user_id) % np.uint64(n_jobs)).astype(np.int64)
+
+
+def solve_shard(directory, shard, k, solver_id, window):
+    """Solves the segments of a shard. Runs in a worker process.
+
+    Parameters
+    ----------
+    directory : str
+        Directory with the arrays of ``SHARED_ARRAYS`` saved as .npy files
+    shard : int
+        Shard to solve
+    k : int
+        Maximum number of notifications per segment
+    solver_id : int
+        Solver id, see ``optimal_delay.SOLVERS``
+    window : int
+        Length of the rolling window, or 0. See ``segments.solve_segments``.
+
+    Returns
+    -------
+    tuple of np.array
+        ``(sent_idx, first_idx, tours)``, see ``segments.solve_segments``
+    """
+
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode='r')
+              for name in SHARED_ARRAYS}
+    mask = arrays['shard'] == shard
+
+    return solve_segments(arrays['timestamp'], arrays['friend_code'],
+                          np.ascontiguousarray(arrays['starts'][mask]),
+                          np.ascontiguousarray(arrays['ends'][mask]),
+                          k, solver_id, window)
+
+
+def solve_segments_parallel(timestamp, friend_code, starts, ends,
+                            segment_shard, k, solver_id, n_jobs, window=0):
+    """Parallel version of ``segments.solve_segments``
+
+    Parameters
+    ----------
+    timestamp : np.array of int
+        Sorted timestamps, as integers
+    friend_code : np.array of int
+        Dense integer code of the friend of each event
+    starts : np.array of int
+        First event of each segment to solve, e.g. ``offsets[:-1]``
+    ends : np.array of int
+        End (excluded) of each segment to solve, e.g. ``offsets[1:]``
+    segment_shard : np.array of int
+        Shard of each segment, from 0 to n_jobs-1. See ``user_shards``.
+    k : int
+        Maximum number of notifications per segment
+    solver_id : int
+        Solver id, see ``optimal_delay.SOLVERS``
+    n_jobs : int
+        Number of worker processes
+    window : int
+        Length of the rolling window, or 0. See ``segments.solve_segments``.
+
+    Returns
+    -------
+    tuple of np.array
+        ``(sent_idx, first_idx, tours)`` in the same order as
+        ``segments.solve_segments`` would return them
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        arrays = {'timestamp': timestamp, 'friend_code': friend_code,
+                  'starts': starts, 'ends': ends,
+                  'shard': segment_shard}
+        for name in SHARED_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), arrays[name])
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(solve_shard, directory, shard, k,
+                                       solver_id, window)
+                       for shard in range(n_jobs)]
+            results = [future.result() for future in futures]
+
+    # Merge: events are sorted by (user, day, time), so are the notifications
+    sent_idx, first_idx, tours = (np.concatenate(r) for r in zip(*results))
+    order = np.argsort(sent_idx, kind='stable')
+
+    return sent_idx[order], first_idx[order], tours[order]
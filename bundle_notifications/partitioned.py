@@ -0,0 +1,253 @@
+"""Out-of-core bundling of inputs larger than memory.
+
+The input is processed in two passes:
+
+1. It is read in chunks. The strings of each chunk are encoded to integer
+   codes with dictionaries shared by all the chunks, and its events are
+   appended to on-disk partitions by a stable hash of the user id, see
+   ``parallel.user_shards``. All the events of a user, and therefore all
+   their days, land in the same partition.
+2. Each partition is loaded, sorted and bundled on its own, and the
+   notifications are passed on to be written before the next partition is
+   loaded.
+
+A partition is a single append-only file of fixed-width records, like the
+columns of ``store``: an int64 timestamp and int32 codes of the user, the
+friend and the name, 20 bytes per event. Only the dictionaries of unique
+strings stay in memory during the whole run.
+
+Peak memory is one chunk of strings in the first pass, and one partition of
+encoded events plus the copies made by ``bundle`` to sort it in the
+second. The number of partitions should be chosen so that the largest one
+fits. The hash spreads users evenly, but a partition holds whole users, so
+it can never be smaller than the events of its largest user: use
+``max_events`` to fail before bundling instead of running out of memory.
+The input does not need to be sorted, unlike with
+``streaming.bundle_stream``.
+
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .bundle_notifications import bundle
+from .events import EventTable
+from .metrics import Metrics
+from .parallel import user_shards
+
+# Layout of the events in the partition files
+RECORD = np.dtype([('timestamp', '<i8'), ('user_code', '<i4'),
+                   ('friend_code', '<i4'), ('name_code', '<i4')])
+
+
+def encode_chunk(values, dictionary):
+    """Encodes values with a dictionary that grows with each chunk
+
+    Parameters
+    ----------
+    values : array-like
+        Values of a chunk
+    dictionary : dict
+        Code of each value seen so far. New values are added with the next
+        codes.
+
+    Returns
+    -------
+    np.array of int32
+        Code of each value, -1 if it is missing
+    """
+
+    codes, uniques = pd.factorize(values)
+    mapping = np.array([dictionary.setdefault(value, len(dictionary))
+                        for value in uniques], dtype=np.int32)
+
+    return np.where(codes >= 0, mapping[np.maximum(codes, 0)],
+                    -1).astype(np.int32)
+
+
+def partition_events(chunks, directory, n_partitions, dictionaries=None,
+                     metrics=None):
+    """Appends chunks of events to on-disk partitions by user
+
+    Parameters
+    ----------
+    chunks : iterable of pd.DataFrame
+        Chunks of events in any order, e.g. the output of
+        ``load_data(path_csv, chunksize=10**6)``
+    directory : str
+        Directory where the partitions are written. Partition p is the file
+        ``p.bin``, with the records of ``RECORD``.
+    n_partitions : int
+        Number of partitions
+    dictionaries : dict, optional
+        Dictionaries of ``'users'``, ``'friends'`` and ``'names'``, see
+        ``encode_chunk``. They are filled with the values of the chunks.
+    metrics : metrics.Metrics, optional
+        Records the time of the 'load' and 'partition' stages
+
+    Returns
+    -------
+    np.array of int
+        Number of events of each partition
+    """
+
+    metrics = metrics or Metrics()
+    if dictionaries is None:
+        dictionaries = {'users': {}, 'friends': {}, 'names': {}}
+    counts = np.zeros(n_partitions, dtype=np.int64)
+
+    for chunk in metrics.iterate(chunks, 'load'):
+        with metrics.stage('partition'):
+            records = np.empty(len(chunk), dtype=RECORD)
+            records['timestamp'] = chunk.timestamp.to_numpy(
+                'datetime64[ns]').view('int64')
+            records['user_code'] = encode_chunk(chunk.user_id,
+                                                dictionaries['users'])
+            records['friend_code'] = encode_chunk(chunk.friend_id,
+                                                  dictionaries['friends'])
+            records['name_code'] = encode_chunk(chunk.friend_name,
+                                                dictionaries['names'])
+
+            # Hash each user once, not each event. Users are hashed by id,
+            # so the partition of a user does not depend on the chunks.
+            user_id = chunk.user_id.astype('category')
+            shard = user_shards(user_id.cat.categories, n_partitions)[
+                user_id.cat.codes.to_numpy()]
+            shard[user_id.cat.codes.to_numpy() < 0] = 0
+
+            order = np.argsort(shard, kind='stable')
+            bounds = np.searchsorted(shard[order], np.arange(n_partitions + 1))
+            for p in np.flatnonzero(np.diff(bounds)):
+                with open(os.path.join(directory, f'{p}.bin'), 'ab') as f:
+                    records[order[bounds[p]:bounds[p + 1]]].tofile(f)
+            counts += np.diff(bounds)
+
+    return counts
+
+
+def read_partition(directory, p, dictionaries):
+    """Reads the events of a partition written by ``partition_events``
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the partitions
+    p : int
+        Partition
+    dictionaries : dict
+        Dictionaries filled by ``partition_events``, as sorted arrays of
+        ``'users'``, the inverse permutation ``'user_rank'`` that maps user
+        codes to positions in it, and arrays of ``'friends'`` and ``'names'``
+
+    Returns
+    -------
+    events.EventTable or None
+        Events of the partition, in the order they were read, or None if it
+        is empty
+    """
+
+    path = os.path.join(directory, f'{p}.bin')
+    if not os.path.isfile(path):
+        return None
+
+    records = np.fromfile(path, dtype=RECORD)
+    user_code = records['user_code']
+    # Sorted dictionary of users, like EventTable.from_frame
+    user_code = np.where(user_code >= 0,
+                         dictionaries['user_rank'][np.maximum(user_code, 0)],
+                         -1).astype(np.int32)
+
+    return EventTable(records['timestamp'].copy(), user_code,
+                      records['friend_code'].copy(),
+                      records['name_code'].copy(), dictionaries['users'],
+                      dictionaries['friends'], dictionaries['names'])
+
+
+def bundle_partitioned(chunks, n_partitions=16, max_notifications=4,
+                       solver='local_search', n_jobs=1, window='calendar',
+                       cache=None, directory=None, metrics=None,
+                       dedup=None, max_events=None):
+    """Bundles events that do not fit in memory, one partition at a time
+
+    Parameters
+    ----------
+    chunks : iterable of pd.DataFrame
+        Chunks of events in any order, with the columns
+        ``['timestamp', 'user_id', 'friend_id', 'friend_name']``
+    n_partitions : int
+        Number of partitions. Each one should fit in memory.
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes used to bundle each partition
+    window : str
+        ``'calendar'`` or ``'rolling'``, see ``bundle``. Both are supported,
+        since partitions contain whole users.
+    cache : cache.ResultCache, optional
+        Persistent cache of schedules, see ``bundle``
+    directory : str, optional
+        Directory of the temporary partitions. By default, a new temporary
+        directory, removed at the end.
+    metrics : metrics.Metrics, optional
+        Records stage times and counters, added up over all the partitions,
+        and the size of the largest partition as the setting
+        ``'largest_partition'``
+    dedup : float, optional
+        Window in seconds to drop duplicate events, see ``bundle``.
+        Duplicates are always in the same partition.
+    max_events : int, optional
+        Maximum number of events of a partition, e.g. from a memory budget
+
+    Yields
+    ------
+    pd.DataFrame
+        Bundled notifications of each partition, in the format of
+        ``bundle``. Rows are grouped by partition, and sorted by receiver,
+        day and time within a partition.
+
+    Raises
+    ------
+    ValueError
+        If a partition has more than max_events events, before any of them
+        is bundled
+    """
+
+    metrics = metrics or Metrics()
+    dictionaries = {'users': {}, 'friends': {}, 'names': {}}
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        counts = partition_events(chunks, tmp, n_partitions,
+                                  dictionaries=dictionaries, metrics=metrics)
+        metrics.count('partitions', (counts > 0).sum())
+        metrics.histogram('events_per_partition', counts[counts > 0])
+        metrics.setting('largest_partition', int(counts.max()))
+        if max_events is not None and counts.max() > max_events:
+            raise ValueError(
+                f'The largest partition has {counts.max()} events, more than '
+                f'{max_events}. Use more partitions, unless it holds a single'
+                f' user with more events than that.')
+
+        users = np.asarray(list(dictionaries['users']), dtype=object)
+        order = np.argsort(users, kind='stable')
+        user_rank = np.empty(len(users), dtype=np.int32)
+        user_rank[order] = np.arange(len(users))
+        dictionaries = {
+            'users': users[order], 'user_rank': user_rank,
+            'friends': np.asarray(list(dictionaries['friends']),
+                                  dtype=object),
+            'names': np.asarray(list(dictionaries['names']), dtype=object)}
+
+        for p in range(n_partitions):
+            with metrics.stage('load'):
+                events = read_partition(tmp, p, dictionaries)
+            if events is None:
+                continue
+
+            yield bundle(events, max_notifications=max_notifications,
+                         solver=solver, n_jobs=n_jobs, metrics=metrics,
+                         window=window, cache=cache, dedup=dedup)
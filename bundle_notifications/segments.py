@@ -0,0 +1,315 @@
+"""Segmented pipeline to bundle all the (user, day) groups at once.
+
+Instead of a pandas groupby-apply, the events are sorted once by integer
+keys. Each (user, day) group becomes a contiguous segment of the sorted
+arrays, delimited by CSR-style offsets: the events of segment s are
+``offsets[s]:offsets[s+1]``. The compiled kernels then loop over all the
+segments and the output columns are built once at the end.
+
+Functions decorated with @jit are not included in the coverage report.
+
+"""
+import numpy as np
+from numba import jit
+
+from .optimal_delay import rolling_schedule, schedule_iter
+
+# Nanoseconds in a day. Day numbers are ``timestamp_ns // DAY_NS``, so that
+# the same day of the year in different years is a different segment.
+DAY_NS = 86400 * 10**9
+
+
+@jit(nopython=True, cache=True)
+def presorted(user_code, timestamp_ns):  # pragma: no cover
+    """Checks in one pass whether the events are already in order
+
+    Parameters
+    ----------
+    user_code : np.array of int
+        Integer code of the user of each event
+    timestamp_ns : np.array of int
+        Timestamp of each event
+
+    Returns
+    -------
+    by_user : bool
+        True if the events are sorted by (user, timestamp), and therefore by
+        (user, day, timestamp)
+    by_time : bool
+        True if the events are sorted by timestamp
+    """
+
+    by_user = True
+    by_time = True
+    for i in range(1, len(user_code)):
+        if timestamp_ns[i] < timestamp_ns[i-1]:
+            by_time = False
+            if user_code[i] == user_code[i-1]:
+                by_user = False
+        if user_code[i] < user_code[i-1]:
+            by_user = False
+        if not (by_user or by_time):
+            break
+
+    return by_user, by_time
+
+
+def segment_order(user_code, day, timestamp_ns):
+    """Sorts the events by user, day and timestamp
+
+    Inputs that are already sorted are detected by ``presorted``. Events
+    sorted by time only need a stable sort by user, which keeps the time
+    order within each user, instead of a sort by three keys.
+
+    Parameters
+    ----------
+    user_code : np.array of int
+        Integer code of the user of each event
+    day : np.array of int
+        Day number of each event
+    timestamp_ns : np.array of int
+        Timestamp of each event
+
+    Returns
+    -------
+    np.array of int
+        Permutation that sorts the events. The sort is stable, so events
+        with the same timestamp keep their input order.
+    """
+
+    by_user, by_time = presorted(user_code, timestamp_ns)
+    if by_user:
+        return np.arange(len(user_code))
+    if by_time:
+        return np.argsort(user_code, kind='stable')
+
+    return np.lexsort((timestamp_ns, day, user_code))
+
+
+def segment_offsets(user_code, day):
+    """Computes the offsets of the (user, day) segments of sorted arrays
+
+    Parameters
+    ----------
+    user_code : np.array of int
+        Integer code of the user of each event, sorted
+    day : np.array of int
+        Day number of each event, sorted within each user
+
+    Returns
+    -------
+    np.array of int
+        Array of length ``n_segments + 1``. The events of segment s are
+        ``offsets[s]:offsets[s+1]``.
+    """
+
+    N = len(user_code)
+    new_segment = np.ones(N, dtype=bool)
+    new_segment[1:] = (user_code[1:] != user_code[:-1]) | \
+        (day[1:] != day[:-1])
+
+    return np.append(np.flatnonzero(new_segment), N).astype(np.int64)
+
+
+@jit(nopython=True, cache=True)
+def schedule_segments(timestamp, starts, ends, k, solver_id,
+                      window):  # pragma: no cover
+    """Computes the notification schedule of each segment
+
+    Parameters
+    ----------
+    timestamp : np.array of int
+        Sorted timestamps, as integers
+    starts : np.array of int
+        First event of each segment to solve, e.g. ``offsets[:-1]``
+    ends : np.array of int
+        End (excluded) of each segment to solve, e.g. ``offsets[1:]``
+    k : int
+        Maximum number of notifications per segment, or per window
+    solver_id : int
+        Solver used in segments with more than k events, see
+        ``optimal_delay.SOLVERS``
+    window : int
+        If 0, segments are (user, day) groups that get at most k
+        notifications each. Otherwise, segments are the whole history of a
+        user and get at most k notifications in any rolling window of this
+        length, see ``optimal_delay.rolling_schedule``. solver_id is then
+        not used.
+
+    Returns
+    -------
+    sent_idx : np.array of int
+        Index of the event at which each notification is sent, sorted
+    n_iter : np.array of int
+        Number of local search moves of each segment, see
+        ``optimal_delay.schedule_iter``
+    """
+
+    # At most one notification per event
+    n_out = 0
+    for s in range(len(starts)):
+        n_out += ends[s] - starts[s] if window > 0 else \
+            min(ends[s] - starts[s], k)
+    sent_idx = np.empty(n_out, dtype=np.int64)
+    n_iter = np.zeros(len(starts), dtype=np.int64)
+
+    b = 0
+    for s in range(len(starts)):
+        if window > 0:
+            x = rolling_schedule(timestamp[starts[s]:ends[s]], k, window)
+        else:
+            x, moves = schedule_iter(timestamp[starts[s]:ends[s]], k,
+                                     solver_id)
+            n_iter[s] = moves
+        for j in range(len(x)):
+            sent_idx[b] = starts[s] + x[j]
+            b += 1
+
+    return sent_idx[:b], n_iter
+
+
+@jit(nopython=True, cache=True)
+def count_segment_tours(friend_code, starts, ends,
+                        sent_idx):  # pragma: no cover
+    """Counts the number of unique friends in each batch of events
+
+    Unique friends are counted with a generation-stamped array:
+    ``stamp[f] == b`` if friend f was already seen in batch b, so nothing
+    has to be reset between batches.
+
+    Parameters
+    ----------
+    friend_code : np.array of int
+        Dense integer code of the friend of each event, from 0 to n_friends-1
+    starts : np.array of int
+        First event of each segment
+    ends : np.array of int
+        End (excluded) of each segment
+    sent_idx : np.array of int
+        Index of the event at which each notification is sent, see
+        ``schedule_segments``. The last event of each segment is notified.
+
+    Returns
+    -------
+    first_idx : np.array of int
+        Index of the first event of each batch
+    tours : np.array of int
+        Number of unique friends in each batch
+    """
+
+    first_idx = np.empty(len(sent_idx), dtype=np.int64)
+    tours = np.empty(len(sent_idx), dtype=np.int64)
+
+    n_friends = 0
+    for i in range(len(friend_code)):
+        n_friends = max(n_friends, friend_code[i] + 1)
+    stamp = np.full(n_friends, -1, dtype=np.int64)
+
+    b = 0
+    for s in range(len(starts)):
+        batch_start = starts[s]
+        while b < len(sent_idx) and sent_idx[b] < ends[s]:
+            count = 0
+            for i in range(batch_start, sent_idx[b] + 1):
+                if stamp[friend_code[i]] != b:
+                    stamp[friend_code[i]] = b
+                    count += 1
+            first_idx[b] = batch_start
+            tours[b] = count
+            batch_start = sent_idx[b] + 1
+            b += 1
+
+    return first_idx, tours
+
+
+@jit(nopython=True, cache=True)
+def solve_segments(timestamp, friend_code, starts, ends, k, solver_id,
+                   window):  # pragma: no cover
+    """Bundles the notifications of all segments: schedules them with
+    ``schedule_segments`` and counts the tours of each batch with
+    ``count_segment_tours``
+
+    Parameters
+    ----------
+    timestamp : np.array of int
+        Sorted timestamps, as integers
+    friend_code : np.array of int
+        Dense integer code of the friend of each event, from 0 to n_friends-1
+    starts : np.array of int
+        First event of each segment to solve, e.g. ``offsets[:-1]``
+    ends : np.array of int
+        End (excluded) of each segment to solve, e.g. ``offsets[1:]``. Any
+        subset of the segments can be solved, see ``parallel``.
+    k : int
+        Maximum number of notifications per segment, or per window
+    solver_id : int
+        Solver used in segments with more than k events, see
+        ``optimal_delay.SOLVERS``
+    window : int
+        Length of the rolling window, or 0 for (user, day) segments. See
+        ``schedule_segments``.
+
+    Returns
+    -------
+    sent_idx : np.array of int
+        Index of the event at which each notification is sent
+    first_idx : np.array of int
+        Index of the first event of each batch
+    tours : np.array of int
+        Number of unique friends in each batch
+    """
+
+    sent_idx, _ = schedule_segments(timestamp, starts, ends, k, solver_id,
+                                    window)
+    first_idx, tours = count_segment_tours(friend_code, starts, ends,
+                                           sent_idx)
+
+    return sent_idx, first_idx, tours
+
+
+@jit(nopython=True, cache=True)
+def count_tours(notification_counter, friend_code):  # pragma: no cover
+    """Counts the unique friends since the last notification was sent
+
+    Unique friends are counted with a generation-stamped array instead of a
+    set: ``stamp[f] == g`` if friend f was already seen in the current batch
+    g, so nothing has to be reset when a new batch starts.
+
+    Parameters
+    ----------
+    notification_counter : np.array of int
+        Counter of the notification of each event, starting from 1. See
+        ``add_notif_counter``.
+    friend_code : np.array of int
+        Dense integer code of the friend of each event
+
+    Returns
+    -------
+    tours : np.array of int
+        Running count of unique friends in the batch of each event
+    first_idx : np.array of int
+        Index of the first event of each batch. Used to get the name and
+        timestamp of the first friend without copying strings.
+    """
+
+    N = len(notification_counter)
+    tours = np.empty(N, dtype=np.int64)
+    first_idx = np.zeros(notification_counter[-1], dtype=np.int64)
+
+    n_friends = 0
+    for i in range(N):
+        n_friends = max(n_friends, friend_code[i] + 1)
+    stamp = np.full(n_friends, -1, dtype=np.int64)
+
+    count = 0
+    for i in range(N):
+        g = notification_counter[i]
+        if i == 0 or g != notification_counter[i - 1]:
+            first_idx[g - 1] = i
+            count = 0
+        if stamp[friend_code[i]] != g:
+            stamp[friend_code[i]] = g
+            count += 1
+        tours[i] = count
+
+    return tours, first_idx
@@ -0,0 +1,23 @@
+"""Names and ids of the schedule solvers.
+
+They are kept apart from the compiled solvers of ``optimal_delay`` so that
+the command line can list them without importing numba.
+
+"""
+
+# Available methods to compute the notification schedule. The integer ids
+# are used to select the method inside compiled code, see
+# ``optimal_delay.schedule``.
+SOLVERS = {
+    'local_search': 0,
+    'dp': 1,
+    'enumerate': 2,
+    'bucketed': 3,
+}
+
+# Chooses one of SOLVERS for each segment, see
+# ``optimal_delay.auto_solvers``
+AUTO = 'auto'
+
+# Values accepted for the solver, e.g. by ``bundle`` and ``--solver``
+SOLVER_NAMES = sorted(list(SOLVERS) + [AUTO])
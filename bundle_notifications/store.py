@@ -0,0 +1,116 @@
+"""Memory-mapped binary store of events.
+
+``bundle_notifications convert`` parses the input once and writes a
+directory of fixed-width columns, sorted by (user, day, time):
+
+- ``timestamp.npy``: int64 nanoseconds since the epoch
+- ``user_code.npy``, ``friend_code.npy``, ``name_code.npy``: int32 codes
+- ``offsets.npy``: int64 start of each (user, day) segment, followed by
+  the number of events
+- ``meta.json``: format version and the dictionaries of users, friends and
+  names
+
+``open_store`` maps the columns with ``np.load(..., mmap_mode='r')``, so
+nothing is parsed or copied and the operating system loads pages only when
+they are read. The events are already sorted and segmented, so ``bundle``
+skips the sort. Several processes bundling the same store share the page
+cache.
+
+"""
+import json
+import os
+
+import numpy as np
+
+from .events import EventTable
+from .segments import DAY_NS, segment_offsets, segment_order
+
+# Bump when the layout of the store changes
+STORE_VERSION = 1
+
+META = 'meta.json'
+
+ARRAYS = ('timestamp', 'user_code', 'friend_code', 'name_code', 'offsets')
+
+
+def is_store(path):
+    """True if path is a directory written by ``write_store``"""
+
+    return os.path.isfile(os.path.join(str(path), META))
+
+
+def write_store(events, directory):
+    """Writes events to a binary store
+
+    Parameters
+    ----------
+    events : events.EventTable
+        Events to write, e.g. from ``load_data(path, compact=True)``
+    directory : str
+        Output directory. It is created if needed, and a previous store in
+        it is overwritten.
+
+    Returns
+    -------
+    int
+        Number of (user, day) segments
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    # The metadata is written last: a store without it is incomplete
+    meta = os.path.join(directory, META)
+    if os.path.exists(meta):
+        os.remove(meta)
+
+    day = events.timestamp // DAY_NS
+    order = segment_order(events.user_code, day, events.timestamp)
+    user_code = events.user_code[order]
+    arrays = {'timestamp': events.timestamp[order].astype(np.int64),
+              'user_code': user_code.astype(np.int32),
+              'friend_code': events.friend_code[order].astype(np.int32),
+              'name_code': events.name_code[order].astype(np.int32),
+              'offsets': segment_offsets(user_code, day[order])}
+    for name in ARRAYS:
+        np.save(os.path.join(directory, name + '.npy'), arrays[name])
+
+    with open(meta, 'w') as f:
+        json.dump({'version': STORE_VERSION, 'n_events': len(events),
+                   'users': events.users.tolist(),
+                   'friends': events.friends.tolist(),
+                   'names': events.names.tolist()}, f)
+
+    return len(arrays['offsets']) - 1
+
+
+def open_store(directory):
+    """Opens a binary store as memory-mapped arrays
+
+    Parameters
+    ----------
+    directory : str
+        Directory written by ``write_store``
+
+    Returns
+    -------
+    events.EventTable
+        Events sorted by (user, day, time), with read-only ``np.memmap``
+        columns and the ``offsets`` of the segments
+    """
+
+    with open(os.path.join(directory, META)) as f:
+        meta = json.load(f)
+    if meta['version'] != STORE_VERSION:
+        raise ValueError(f'Store version {meta["version"]} is not supported,'
+                         f' convert the events again')
+
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode='r')
+              for name in ARRAYS}
+
+    return EventTable(arrays['timestamp'], arrays['user_code'],
+                      arrays['friend_code'], arrays['name_code'],
+                      np.asarray(meta['users'], dtype=object),
+                      np.asarray(meta['friends'], dtype=object),
+                      np.asarray(meta['names'], dtype=object),
+                      offsets=arrays['offsets'])
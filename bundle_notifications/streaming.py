@@ -0,0 +1,174 @@
+"""Bounded-memory bundling of event streams.
+
+Events are read in chunks and buffered only while their day is still open.
+The input is assumed to be sorted by time, so the timestamp of the latest
+event is a watermark: once it passes midnight, all the user-days of the
+previous days are complete and can be bundled and written out. Peak memory
+is proportional to the events of the open days, not to the size of the file.
+
+"""
+import numpy as np
+import pandas as pd
+
+from . import database
+from .bundle_notifications import bundle, file_format
+from .metrics import Metrics
+from .segments import DAY_NS
+
+
+def bundle_stream(chunks, max_notifications=4, solver='local_search',
+                  n_jobs=1, metrics=None, dedup=None):
+    """Bundles a stream of event chunks, day by day
+
+    Parameters
+    ----------
+    chunks : iterable of pd.DataFrame
+        Chunks of events sorted by time, for example the output of
+        ``load_data(path_csv, chunksize=100000)``. Each one contains the
+        columns ``['timestamp', 'user_id', 'friend_id', 'friend_name']``.
+    max_notifications : int
+        Maximum number of notifications sent to a user per day
+    solver : str
+        Method used to compute the schedule, see
+        ``optimal_delay.optimal_schedule``
+    n_jobs : int
+        Number of processes used to bundle each block of days
+    metrics : metrics.Metrics, optional
+        Records the time spent reading chunks ('load') and bundling, added
+        up over all the blocks of days
+    dedup : float, optional
+        Window in seconds to drop duplicate events, see ``bundle``. Days
+        are cleaned when they are bundled, so bursts that span midnight are
+        not collapsed.
+
+    Yields
+    ------
+    pd.DataFrame
+        Bundled notifications of the days closed by each chunk, in the format
+        of ``bundle``. Rows are sorted by day, and by receiver within a day.
+
+    Raises
+    ------
+    ValueError
+        If an event belongs to a day that was already bundled, i.e. the input
+        is not sorted by time.
+    """
+
+    metrics = metrics or Metrics()
+    buffer = []
+    open_day = None  # First day that has not been bundled yet
+
+    for chunk in metrics.iterate(chunks, 'load'):
+        if chunk.shape[0] == 0:
+            continue
+
+        day = chunk.timestamp.to_numpy('datetime64[ns]').view('int64') // \
+            DAY_NS
+        if open_day is not None and day.min() < open_day:
+            raise ValueError('Events are not sorted by time: got an event of'
+                             ' a day that was already bundled.')
+
+        # Watermark: days before the latest event are complete
+        watermark = day.max()
+        if open_day is None:
+            open_day = day.min()
+        buffer.append(chunk)
+        if watermark == open_day:
+            continue
+
+        df = pd.concat(buffer, ignore_index=True)
+        day = df.timestamp.to_numpy('datetime64[ns]').view('int64') // DAY_NS
+        closed = day < watermark
+        buffer = [df[~closed]]
+        open_day = watermark
+
+        yield bundle(df[closed], max_notifications=max_notifications,
+                     solver=solver, n_jobs=n_jobs, metrics=metrics,
+                     dedup=dedup)
+
+    # End of the stream: close the remaining days
+    if buffer:
+        yield bundle(pd.concat(buffer, ignore_index=True),
+                     max_notifications=max_notifications, solver=solver,
+                     n_jobs=n_jobs, metrics=metrics, dedup=dedup)
+
+
+def write_stream(frames, path, nrows=0, metrics=None):
+    """Writes a stream of bundled notifications to a csv or Parquet file, or
+    to a SQLite table
+
+    Parameters
+    ----------
+    frames : iterable of pd.DataFrame
+        Bundled notifications, for example the output of ``bundle_stream``
+    path : str
+        Path to the output file. It is overwritten. Parquet is used if the
+        extension is .parquet or .pq, with dictionary-encoded 'receiver_id'
+        and 'message' columns, and the rows of the table of a SQLite URL are
+        replaced (see ``database.parse_url``). Otherwise, csv.
+    nrows : int
+        Number of rows to keep in memory and return
+    metrics : metrics.Metrics, optional
+        Records the time of the 'write' stage
+
+    Returns
+    -------
+    head : pd.DataFrame
+        First nrows rows written
+    n_rows : int
+        Total number of rows written
+    """
+
+    fmt = file_format(path)
+    if fmt == 'feather':
+        raise ValueError('Feather/Arrow output is not supported in streaming'
+                         ' mode. Use csv or Parquet.')
+
+    # Empty table with the output columns
+    empty = bundle(pd.DataFrame({
+        'timestamp': np.array([], dtype='datetime64[ns]'),
+        'user_id': [], 'friend_id': [], 'friend_name': []}))
+
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([('notification_sent', pa.timestamp('ns')),
+                            ('timestamp_first_tour', pa.timestamp('ns')),
+                            ('tours', pa.int64()),
+                            ('receiver_id', pa.string()),
+                            ('message', pa.string())])
+        writer = pq.ParquetWriter(path, schema,
+                                  use_dictionary=['receiver_id', 'message'])
+    elif fmt == 'sqlite':
+        connection, table = database.connect_url(path, 'notifications')
+
+    metrics = metrics or Metrics()
+    head = []
+    n_rows = 0
+    for df in frames:
+        with metrics.stage('write'):
+            if fmt == 'parquet':
+                writer.write_table(pa.Table.from_pandas(
+                    df, schema=schema, preserve_index=False))
+            elif fmt == 'sqlite':
+                database.write_notifications(df, connection, table,
+                                             replace=n_rows == 0)
+            else:
+                df.to_csv(path, index=False, header=n_rows == 0,
+                          mode='w' if n_rows == 0 else 'a')
+        if n_rows < nrows:
+            head.append(df.head(nrows - n_rows))
+        n_rows += df.shape[0]
+
+    if fmt == 'parquet':
+        writer.close()
+    elif fmt == 'sqlite':
+        if n_rows == 0:
+            database.write_notifications(empty, connection, table,
+                                         replace=True)
+        connection.close()
+    elif n_rows == 0:
+        empty.to_csv(path, index=False)
+
+    return pd.concat(head or [empty], ignore_index=True), n_rows
@@ -10,7 +10,10 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['Click>=7.0', 'pandas>=1.0.0','tabulate>=0.8.6']
+requirements = ['Click>=7.0', 'pandas>=1.0.0', 'numba>=0.48.0',
+                'tabulate>=0.8.6']
+
+extra_requirements = {'parquet': ['pyarrow>=0.15.0']}
 
 setup_requirements = ['pytest-runner', ]
 
@@ -34,6 +37,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -113,3 +113,1077 @@ def test_total_delay():
     tot = optimal_delay.delay(t, x)
     # (10-3) + (10-4) = 13
     assert tot == 13, 'Unexpected delay calculation'
+
+
+def test_total_delay_dp():
+    """Test the exact solver against brute force"""
+
+    rng = np.random.RandomState(0)
+    for k in [1, 2, 3, 4, 5]:
+        for N in [k + 1, 8, 13]:
+            t = np.sort(rng.randint(0, 10**6, N)).astype('int64')
+            x_dp = optimal_delay.total_delay_dp(t, k)
+            x_brute = optimal_delay.total_delay_brute(t, k)
+
+            assert len(x_dp) == k and x_dp[-1] == N - 1
+            assert np.all(np.diff(x_dp) > 0), 'Schedule is not increasing'
+            assert optimal_delay.delay(t, x_dp) == \
+                optimal_delay.delay(t, x_brute), 'DP solution is not optimal'
+
+    # Never worse than the heuristic
+    t = np.sort(rng.randint(0, 10**9, 500)).astype('int64')
+    assert optimal_delay.delay(t, optimal_delay.total_delay_dp(t, 4)) <= \
+        optimal_delay.delay(t, optimal_delay.local_search(t))
+
+    # Few events: send them all
+    assert list(optimal_delay.total_delay_dp(t[:3], 4)) == [0, 1, 2]
+
+
+def exact_delay(t, x):
+    """Total delay of the schedule x with Python integers, which cannot
+    overflow"""
+
+    r = [int(v) - int(t[0]) for v in t]
+    total = 0
+    start = 0
+    for i in range(len(x)):
+        end = int(x[i]) if i < len(x) - 1 else len(t) - 1
+        total += (end - start + 1) * r[end] - sum(r[start:end + 1])
+        start = end + 1
+
+    return total
+
+
+def test_large_user_day():
+    """Test that delays of a million events in a day do not overflow"""
+
+    rng = np.random.RandomState(27)
+    N = 10**6
+    t = np.sort(rng.randint(0, 86400 * 10**9, N)).astype('int64')
+    r, P = optimal_delay.prefix_sums(t)
+    unit = optimal_delay.time_unit(t - t[0])
+    assert unit > 1 and P[-1] <= optimal_delay.MAX_PREFIX_SUM
+
+    # The DP is optimal up to the rounding of each delay to the unit
+    x_dp = optimal_delay.total_delay_dp(t, 4)
+    optimum = exact_delay(t, x_dp)
+    assert optimum <= exact_delay(t, optimal_delay.local_search(t)) + N * unit
+    assert abs(optimal_delay.delay(t, x_dp) - optimum) <= 1e-9 * optimum
+    assert abs(optimal_delay.schedule_delay(r, P, x_dp) * unit - optimum) <= \
+        N * unit
+
+    # Whole seconds are divided exactly
+    t_s = t // 10**9
+    assert np.all(optimal_delay.total_delay_dp(t_s * 10**9, 4) ==
+                  optimal_delay.total_delay_dp(t_s, 4))
+
+
+def test_bundle_max_notifications():
+    """Test bundling with a custom cap and the exact solver"""
+
+    timestamps = pd.date_range('2017-08-01 00:00', periods=10, freq='37min')
+    df = pd.DataFrame({'timestamp': timestamps,
+                       'user_id': 'A',
+                       'friend_id': ['F%d' % (i % 3) for i in range(10)],
+                       'friend_name': ['N%d' % (i % 3) for i in range(10)]})
+
+    df_test = bundle_notifications.bundle(df.copy(), max_notifications=2,
+                                          solver='dp')
+    assert df_test.shape == (2, 5)
+    assert df_test.notification_sent.iloc[-1] == timestamps[-1]
+
+    with pytest.raises(ValueError):
+        bundle_notifications.bundle(df.copy(), solver='unknown')
+
+
+def test_local_search():
+    """Test the prefix-sum local search"""
+
+    rng = np.random.RandomState(1)
+    t = np.sort(rng.randint(0, 86400 * 10**9, 300)).astype('int64')
+
+    # Incremental delay matches the reference implementation
+    r, P = optimal_delay.prefix_sums(t)
+    x0 = optimal_delay.total_delay_initial(t, 4)
+    assert optimal_delay.schedule_delay(r, P, x0) == optimal_delay.delay(t, x0)
+
+    # datetime64 is accepted directly
+    x = optimal_delay.local_search(t)
+    x_dt = optimal_delay.local_search(t.view('datetime64[ns]'))
+    assert np.all(x == x_dt)
+    assert optimal_delay.delay(t, x) <= optimal_delay.delay(t, x0)
+
+    # Converged: no single move improves
+    for k in range(3):
+        for d in [-1, 1]:
+            gain, valid = optimal_delay.shift_gain(r, P, x, k, 1, d)
+            assert not valid or gain <= 0, 'Local search did not converge'
+
+
+def test_bundle_segments():
+    """Test the segmented engine against the pandas groupby-apply"""
+
+    rng = np.random.RandomState(2)
+    N = 400
+    friends = rng.randint(0, 15, N)
+    df = pd.DataFrame({
+        'timestamp': pd.Timestamp('2017-08-01') +
+        pd.to_timedelta(np.sort(rng.randint(0, 3 * 86400, N)), unit='s'),
+        'user_id': rng.choice(['A', 'B', 'C', 'D'], N),
+        'friend_id': ['F%d' % f for f in friends],
+        'friend_name': ['Name%d' % f for f in friends]})
+    df_input = df.copy()
+
+    df_seg = bundle_notifications.bundle(df)
+    df_pd = bundle_notifications.bundle(df.copy(), engine='pandas')
+
+    assert df.equals(df_input), 'Input DataFrame was modified'
+    assert np.all(df_seg.columns == df_pd.columns)
+    assert np.all(df_seg.values == df_pd.values), 'Engines do not match'
+
+    # Same day of the year, different years: two segments
+    df_years = df.iloc[:3].copy()
+    df_years['user_id'] = 'A'
+    df_years['timestamp'] = pd.to_datetime(
+        ['2017-08-01 10:00', '2018-08-01 10:00', '2018-08-01 11:00'])
+    assert bundle_notifications.bundle(df_years, max_notifications=1) \
+        .shape[0] == 2
+
+
+def test_count_tours_per_notif():
+    """Test the count of unique friends per notification"""
+
+    counter = np.array([1, 1, 1, 2, 2, 3, 4, 4])
+    friend_id = np.array(['a', 'a', 'b', 'c', 'a', 'a', 'd', 'd'])
+    friend_name = np.array(['A', 'A', 'B', 'C', 'A', 'A', 'D', 'D'])
+    timestamp = np.arange(8).astype('datetime64[ns]')
+
+    tours, name_first, timestamp_first_tour, message = \
+        bundle_notifications.count_tours_per_notif(
+            counter, friend_id, friend_name, timestamp)
+
+    assert list(tours) == [1, 1, 2, 1, 2, 1, 1, 1]
+    assert list(name_first) == ['A', 'C', 'A', 'D']
+    assert list(timestamp_first_tour) == list(timestamp[[0, 3, 5, 6]])
+    assert message[0] == 'A and 1 other went on a tour'
+    assert message[3] == 'D went on a tour'
+
+    # Integer codes give the same result
+    codes = pd.factorize(friend_id)[0].astype('int32')
+    tours_codes, _, _, _ = bundle_notifications.count_tours_per_notif(
+        counter, codes, friend_name, timestamp)
+    assert np.all(tours == tours_codes)
+
+
+def fake_events(N=400, n_days=3, seed=0):
+    """Random stream of events sorted by time"""
+
+    rng = np.random.RandomState(seed)
+    friends = rng.randint(0, 15, N)
+
+    return pd.DataFrame({
+        'timestamp': pd.Timestamp('2017-08-01') + pd.to_timedelta(
+            np.sort(rng.randint(0, n_days * 86400, N)), unit='s'),
+        'user_id': rng.choice(['A', 'B', 'C', 'D'], N),
+        'friend_id': ['F%d' % f for f in friends],
+        'friend_name': ['Name%d' % f for f in friends]})
+
+
+def test_bundle_stream(tmp_path):
+    """Test chunked bundling against bundling the whole stream"""
+
+    from bundle_notifications import streaming
+
+    df = fake_events()
+    path_csv = str(tmp_path / 'events.csv')
+    df.to_csv(path_csv, header=False, index=False)
+
+    chunks = bundle_notifications.load_data(path_csv, chunksize=37)
+    df_stream = pd.concat(streaming.bundle_stream(chunks), ignore_index=True)
+
+    df_full = bundle_notifications.bundle(df)
+    df_full = df_full.sort_values(
+        ['notification_sent', 'receiver_id']).reset_index(drop=True)
+    df_stream = df_stream.sort_values(
+        ['notification_sent', 'receiver_id']).reset_index(drop=True)
+    assert df_stream.equals(df_full), 'Streaming result does not match'
+
+    # Unsorted input is detected
+    with pytest.raises(ValueError):
+        list(streaming.bundle_stream([df.iloc[200:], df.iloc[:200]]))
+
+    # CLI
+    path_output = str(tmp_path / 'output.csv')
+    result = CliRunner().invoke(cli.main, ['-p', path_csv, '-o', path_output,
+                                           '-c', '50', '-n', '5'])
+    assert result.exit_code == 0
+    assert 'Great!' in result.output
+    assert pd.read_csv(path_output).shape == df_full.shape
+
+
+def test_bundle_parallel():
+    """Test that sharded bundling matches the single process result"""
+
+    from bundle_notifications import parallel
+
+    df = fake_events(N=300, seed=3)
+    df_serial = bundle_notifications.bundle(df)
+    df_parallel = bundle_notifications.bundle(df, n_jobs=2)
+    assert df_parallel.equals(df_serial), 'Parallel result does not match'
+
+    # Shards are stable
+    shards = parallel.user_shards(['A', 'B', 'C', 'D'], 3)
+    assert np.all(shards == parallel.user_shards(['A', 'B', 'C', 'D'], 3))
+    assert shards.min() >= 0 and shards.max() < 3
+
+
+def test_online_bundler():
+    """Test the online bundler"""
+
+    from bundle_notifications.online import OnlineBundler
+
+    df = fake_events(N=500, seed=4)
+    df_online = OnlineBundler(max_notifications=4).replay(df)
+
+    assert np.all(df_online.columns == ['notification_sent',
+                                        'timestamp_first_tour', 'tours',
+                                        'receiver_id', 'message'])
+    per_day = df_online.groupby(
+        ['receiver_id', df_online.notification_sent.dt.date]).size()
+    assert per_day.max() <= 4, 'Daily cap not respected'
+    assert np.all(df_online.timestamp_first_tour <=
+                  df_online.notification_sent)
+
+    # Sparse events are sent right away, the last one waits until midnight
+    bundler = OnlineBundler(max_notifications=2)
+    t = pd.Timestamp('2017-08-01 18:00')
+    notification = bundler.push(t, 'A', 'F1', 'Mona')
+    assert notification.notification_sent == t
+    assert notification.message == 'Mona went on a tour'
+    assert bundler.push(t, 'A', 'F2', 'Geir') is None
+    assert bundler.push(t, 'A', 'F2', 'Geir') is None
+    pending = bundler.flush(pd.Timestamp('2017-08-02 00:10'))
+    assert len(pending) == 1 and pending[0].tours == 1
+    assert pending[0].notification_sent.date() == t.date()
+    assert bundler.flush() == []
+
+    # Bounded memory for users with many pending friends
+    from bundle_notifications import online
+    t = pd.Timestamp('2017-08-01 00:00:01')
+    for n in [online.MAX_PENDING_FRIENDS, 5000]:
+        for i in range(2 * n):
+            assert bundler.push(t, 'B', i % n, 'Mona') is None
+        state = bundler.users['B']
+        assert len(state.friends) <= online.MAX_PENDING_FRIENDS
+        tours = bundler.flush()[0].tours
+        assert tours == n if n <= online.MAX_PENDING_FRIENDS else \
+            abs(tours - n) < 0.03 * n
+
+
+def test_columnar_formats(tmp_path, monkeypatch):
+    """Test reading and writing Parquet and Feather files"""
+
+    pytest.importorskip('pyarrow')
+    from bundle_notifications import streaming
+
+    df = fake_events(N=200, seed=5)
+    df_bundle = bundle_notifications.bundle(df)
+
+    for extension in ['.parquet', '.feather']:
+        path_input = str(tmp_path / ('events' + extension))
+        if extension == '.parquet':
+            df.assign(extra=1).to_parquet(path_input)
+        else:
+            df.assign(extra=1).to_feather(path_input)
+
+        df_read = bundle_notifications.load_data(path_input)
+        assert list(df_read.columns) == list(df.columns), \
+            'Columns are not projected'
+        assert df_read.equals(df)
+
+        path_output = str(tmp_path / ('output' + extension))
+        bundle_notifications.save_data(df_bundle, path_output)
+        if extension == '.parquet':
+            df_out = pd.read_parquet(path_output)
+        else:
+            df_out = pd.read_feather(path_output)
+        assert df_out.receiver_id.dtype == 'category'
+        assert np.all(df_out.astype({'receiver_id': object,
+                                     'message': object}).values ==
+                      df_bundle.values)
+
+    # Streaming Parquet in and out
+    chunks = bundle_notifications.load_data(
+        str(tmp_path / 'events.parquet'), chunksize=40)
+    path_output = str(tmp_path / 'stream.parquet')
+    _, n_rows = streaming.write_stream(streaming.bundle_stream(chunks),
+                                       path_output)
+    assert n_rows == df_bundle.shape[0]
+    assert pd.read_parquet(path_output).shape == df_bundle.shape
+
+    # Feather is read one record batch at a time, never whole
+    path_input = str(tmp_path / 'batches.feather')
+    df.assign(extra=1).to_feather(path_input, chunksize=64)
+    monkeypatch.setattr(pd, 'read_feather', None)
+    chunks = list(bundle_notifications.load_data(path_input, chunksize=40))
+    assert [len(chunk) for chunk in chunks] == [40, 24] * 3 + [8]
+    assert pd.concat(chunks, ignore_index=True).equals(df)
+
+
+def test_event_table(tmp_path):
+    """Test the compact representation of the events"""
+
+    from bundle_notifications.events import EventTable
+
+    df = fake_events(N=300, seed=6)
+    events = EventTable.from_frame(df)
+
+    assert len(events) == 300
+    assert events.user_code.dtype == np.int32
+    assert events.to_frame().equals(df), 'Decoded events do not match'
+    assert events.nbytes < df.memory_usage(deep=True).sum()
+
+    df_bundle = bundle_notifications.bundle(df)
+    assert bundle_notifications.bundle(events).equals(df_bundle)
+
+    # Loaded in compact form
+    path_csv = str(tmp_path / 'events.csv')
+    df.to_csv(path_csv, header=False, index=False)
+    events = bundle_notifications.load_data(path_csv, compact=True)
+    assert isinstance(events, EventTable)
+    assert bundle_notifications.bundle(events).equals(df_bundle)
+    assert events.take(events.user_code == 0).to_frame().equals(
+        df[df.user_id == 'A'].reset_index(drop=True))
+
+
+def test_render_messages(tmp_path):
+    """Test lazy, template-based messages"""
+
+    from bundle_notifications import messages
+
+    tours = np.array([1, 2, 3, 10])
+    names = np.array(['Javi', 'Javier', 'Saez', 'Gallego'])
+    expected = [bundle_notifications.create_message_single(t, n)
+                for t, n in zip(tours, names)]
+    assert list(messages.ENGLISH.render(tours, names)) == expected
+    assert list(messages.ENGLISH.render(
+        tours, pd.Categorical(names))) == expected
+
+    spanish = messages.MessageTemplates(
+        '{name} hizo una ruta', '{name} y otra persona hicieron una ruta',
+        '{name} y {others} personas más hicieron una ruta')
+    assert spanish.render([3], ['Mona'])[0] == \
+        'Mona y 2 personas más hicieron una ruta'
+
+    # Bundle without messages, render when saving
+    df = fake_events(N=200, seed=7)
+    df_lazy = bundle_notifications.bundle(df, render=False)
+    assert 'message' not in df_lazy
+    assert df_lazy.name_first.dtype == 'category'
+    assert messages.render_messages(df_lazy).equals(
+        bundle_notifications.bundle(df))
+
+    path_csv = str(tmp_path / 'output.csv')
+    bundle_notifications.save_data(df_lazy, path_csv, templates=spanish)
+    assert pd.read_csv(path_csv).message.str.contains('ruta').all()
+
+
+def test_synthetic_generator():
+    """Test the seeded generator of the benchmarks"""
+
+    from benchmarks.generate import generate_events
+
+    df = generate_events(5000, n_days=3, seed=1)
+    assert len(df) == 5000
+    assert df.timestamp.is_monotonic_increasing
+    assert df.user_id.str.len().eq(30).all()
+    assert df.equals(generate_events(5000, n_days=3, seed=1))
+    assert not df.equals(generate_events(5000, n_days=3, seed=2))
+
+    # Friends repeat within user-days, so bundling has something to do
+    df_out = bundle_notifications.bundle(df)
+    assert df_out.tours.max() > 1
+
+
+def test_metrics(tmp_path):
+    """Test per-stage metrics of the CLI and of bundle"""
+
+    import json
+    from bundle_notifications import metrics
+
+    assert metrics.log2_bins([1, 2, 3, 4, 9]) == {'1': 1, '2-3': 2,
+                                                  '4-7': 1, '8-15': 1}
+
+    df = fake_events(N=300, seed=3)
+    m = metrics.Metrics()
+    df_out = bundle_notifications.bundle(df, metrics=m)
+    assert df_out.equals(bundle_notifications.bundle(df))
+    assert {'keys', 'sort', 'solve', 'tours', 'render'} <= set(m.stages)
+    assert m.counters['events'] == 300
+    assert m.counters['user_days_small'] + m.counters['user_days_large'] == \
+        m.counters['user_days']
+    assert m.counters['notifications'] == len(df_out)
+    assert sum(m.histograms['events_per_user_day'].values()) == \
+        m.counters['user_days']
+
+    path_csv = str(tmp_path / 'events.csv')
+    path_json = str(tmp_path / 'metrics.json')
+    df.to_csv(path_csv, header=False, index=False)
+    result = CliRunner().invoke(cli.main, [
+        '-p', path_csv, '-o', str(tmp_path / 'output.csv'), '-n', '0',
+        '--profile', '--metrics-json', path_json])
+    assert result.exit_code == 0
+    assert 'local_search_moves' in result.output
+
+    with open(path_json) as f:
+        report = json.load(f)
+    assert report['counters']['notifications'] == len(df_out)
+    assert set(metrics.STAGES) <= set(report['stages'])
+
+
+def test_warmup():
+    """Test the warm-up hook and the solvers known by the lazy CLI"""
+
+    assert cli.SOLVER_NAMES == sorted(list(optimal_delay.SOLVERS) +
+                                      [optimal_delay.AUTO])
+    assert bundle_notifications.warmup() >= 0
+
+
+def test_rolling_window():
+    """Test the rolling 24-hour cap"""
+
+    day = 86400 * 10**9
+
+    # 4 notifications late on a day and 4 early the next day are allowed
+    # per calendar day, but not in a rolling window
+    t = (np.array([20, 21, 22, 23, 25, 26, 27, 28]) * 3600 * 10**9) \
+        .astype(np.int64)
+    x = optimal_delay.rolling_schedule(t, 4, day)
+    assert x[-1] == len(t) - 1
+    assert len(x) == 4
+    assert np.array_equal(
+        optimal_delay.rolling_schedule(t, 4, 3600 * 10**9),
+        np.arange(len(t)))
+
+    # Refining sweeps are capped, and each one only lowers the delay
+    rng = np.random.RandomState(28)
+    t = np.sort(rng.randint(0, 10 * day, 20000)).astype(np.int64)
+    x = optimal_delay.rolling_schedule(t, 4, day, 0)
+    delays = [optimal_delay.delay(t, x)]
+    for max_sweeps in [1, 2, optimal_delay.ROLLING_SWEEPS]:
+        x_refined, n_sweeps = optimal_delay.rolling_refine(
+            t, x.copy(), 4, day, max_sweeps)
+        assert n_sweeps <= max_sweeps
+        assert np.all(t[x_refined[4:]] - t[x_refined[:-4]] >= day)
+        delays.append(optimal_delay.delay(t, x_refined))
+    assert delays == sorted(delays, reverse=True) and delays[1] < delays[0]
+    assert np.array_equal(optimal_delay.rolling_schedule(t, 4, day),
+                          x_refined)
+
+    # Never more than k notifications in 24 hours, over several days
+    df = fake_events(N=600, n_days=5, seed=11)
+    df_out = bundle_notifications.bundle(df, window='rolling')
+    for _, g in df_out.groupby('receiver_id'):
+        sent = np.sort(g.notification_sent.to_numpy().view('int64'))
+        assert np.all(sent[4:] - sent[:-4] >= day)
+    assert df_out.tours.sum() >= df.groupby('user_id').size().size
+
+    assert bundle_notifications.bundle(df, window='rolling', n_jobs=2) \
+        .equals(df_out)
+    with pytest.raises(ValueError):
+        bundle_notifications.bundle(df, window='weekly')
+
+
+def test_result_cache(tmp_path):
+    """Test the persistent cache of segment schedules"""
+
+    from bundle_notifications.cache import ResultCache
+    from bundle_notifications.metrics import Metrics
+
+    df = fake_events(N=400, seed=12)
+    df_out = bundle_notifications.bundle(df)
+    path = str(tmp_path / 'cache.sqlite')
+
+    with ResultCache(path) as cache:
+        m = Metrics()
+        assert bundle_notifications.bundle(df, cache=cache, metrics=m) \
+            .equals(df_out)
+        assert m.counters['cache_hits'] == 0
+        n_entries = len(cache)
+        assert n_entries == m.counters['cache_misses'] > 0
+
+    # Second run: everything comes from the cache
+    with ResultCache(path) as cache:
+        m = Metrics()
+        assert bundle_notifications.bundle(df, cache=cache, metrics=m) \
+            .equals(df_out)
+        assert m.counters['cache_hits'] == n_entries
+        assert m.counters['cache_misses'] == 0
+
+        # Appending a day only solves the new user-days
+        df_more = pd.concat([df, fake_events(N=100, seed=13).assign(
+            timestamp=lambda d: d.timestamp + pd.Timedelta(days=10))])
+        m = Metrics()
+        assert bundle_notifications.bundle(df_more, cache=cache, metrics=m) \
+            .equals(bundle_notifications.bundle(df_more))
+        assert m.counters['cache_hits'] == n_entries
+
+        # Other parameters are cached separately
+        assert bundle_notifications.bundle(df, solver='dp', cache=cache) \
+            .equals(bundle_notifications.bundle(df, solver='dp'))
+
+    # Least recently used entries are evicted
+    with ResultCache(path, max_entries=3) as cache:
+        assert cache.evict() > 0
+        assert len(cache) == 3
+
+
+def test_incremental(tmp_path):
+    """Test that appending events only rewrites the days they touch"""
+
+    from bundle_notifications.incremental import bundle_incremental
+
+    df = fake_events(N=600, n_days=4, seed=14)
+    day = df.timestamp.dt.floor('D')
+    path_csv = str(tmp_path / 'events.csv')
+    output_dir = str(tmp_path / 'output')
+
+    def read_output():
+        df_out = pd.concat([
+            pd.read_csv(str(path)) for path in sorted(
+                (tmp_path / 'output').glob('*.csv'))], ignore_index=True)
+        return df_out.sort_values(
+            ['notification_sent', 'receiver_id']).reset_index(drop=True)
+
+    # The last day is still being written when the first run happens
+    first = day < day.max()
+    df[first].iloc[:-10].to_csv(path_csv, header=False, index=False)
+    _, summary = bundle_incremental(path_csv, output_dir)
+    assert summary['full_rebuild']
+    with open(path_csv, 'a') as f:
+        df[first].iloc[-10:].to_csv(f, header=False, index=False)
+        df[~first].to_csv(f, header=False, index=False)
+
+    _, summary = bundle_incremental(path_csv, output_dir)
+    assert not summary['full_rebuild']
+    assert summary['rows_read'] < len(df) and summary['days_written'] <= 2
+
+    path_full = str(tmp_path / 'full.csv')
+    bundle_notifications.save_data(bundle_notifications.bundle(df),
+                                   path_full)
+    df_full = pd.read_csv(path_full).sort_values(
+        ['notification_sent', 'receiver_id']).reset_index(drop=True)
+    assert read_output().equals(df_full), 'Incremental result does not match'
+
+    # Nothing new, then a late event
+    assert bundle_incremental(path_csv, output_dir)[1]['rows_read'] == 0
+    with open(path_csv, 'a') as f:
+        df.iloc[:1].to_csv(f, header=False, index=False)
+    assert bundle_incremental(path_csv, output_dir)[1]['full_rebuild']
+
+    # CLI
+    result = CliRunner().invoke(cli.main, ['-p', path_csv, '-o', output_dir,
+                                           '--incremental', '-n', '5'])
+    assert result.exit_code == 0
+    assert 'Read 0 events' in result.output
+
+
+def test_database(tmp_path):
+    """Test reading events from and writing notifications to SQLite"""
+
+    import sqlite3
+    from bundle_notifications import database, streaming
+
+    df = fake_events(N=300, seed=15)
+    path_db = str(tmp_path / 'events.db')
+    connection = sqlite3.connect(path_db)
+    df.sample(frac=1, random_state=0).to_sql('events', connection,
+                                             index=False)
+
+    # Rows come back in time order, in chunks
+    chunks = list(database.stream_events(connection, chunksize=70))
+    assert len(chunks) == 5
+    df_db = pd.concat(chunks, ignore_index=True)
+    assert df_db.timestamp.equals(df.timestamp)
+
+    # Filters are applied by the database
+    start, end = pd.Timestamp('2017-08-02'), pd.Timestamp('2017-08-03')
+    df_day = database.read_events(connection, start=start, end=end,
+                                  users=['A', 'C'])
+    expected = df[(df.timestamp >= start) & (df.timestamp < end) &
+                  df.user_id.isin(['A', 'C'])]
+    assert df_day.timestamp.equals(expected.timestamp.reset_index(drop=True))
+    assert set(df_day.user_id) == {'A', 'C'}
+
+    # Round trip through the sink
+    df_bundle = bundle_notifications.bundle(df)
+    url = 'sqlite:///' + path_db
+    assert bundle_notifications.bundle(
+        bundle_notifications.load_data(url)).equals(df_bundle)
+    bundle_notifications.save_data(df_bundle, url)
+    bundle_notifications.save_data(df_bundle, url)
+    df_out = pd.read_sql('SELECT * FROM notifications', connection,
+                         parse_dates=['notification_sent',
+                                      'timestamp_first_tour'])
+    assert df_out.equals(df_bundle), 'Saved table does not match'
+
+    # Streaming from and to the database
+    chunks = bundle_notifications.load_data(url, chunksize=40)
+    _, n_rows = streaming.write_stream(streaming.bundle_stream(chunks),
+                                       url + '?table=stream')
+    assert n_rows == len(df_bundle)
+    assert connection.execute('SELECT COUNT(*) FROM stream').fetchone()[0] \
+        == n_rows
+
+    result = CliRunner().invoke(cli.main, ['-p', url, '-o', url, '-n', '5'])
+    assert result.exit_code == 0
+
+    # Table names are quoted, and anything else than a name is rejected
+    assert database.quote_identifier('main.events') == '"main"."events"'
+    for table in ['events; DROP TABLE events', 'a"b', '1events', '']:
+        with pytest.raises(ValueError):
+            database.quote_identifier(table)
+    with pytest.raises(ValueError):
+        bundle_notifications.save_data(
+            df_bundle, url + '?table=notifications;DELETE+FROM+events')
+    assert connection.execute('SELECT COUNT(*) FROM events').fetchone()[0] \
+        == len(df)
+    connection.close()
+
+
+def test_store(tmp_path):
+    """Test bundling from a memory-mapped binary store"""
+
+    from bundle_notifications import store
+
+    df = fake_events(N=400, seed=16)
+    path_csv = str(tmp_path / 'events.csv')
+    df.to_csv(path_csv, header=False, index=False)
+    directory = str(tmp_path / 'events.store')
+
+    result = CliRunner().invoke(cli.main, ['convert', path_csv, directory])
+    assert result.exit_code == 0
+    assert store.is_store(directory)
+
+    events = bundle_notifications.load_data(directory, compact=True)
+    assert isinstance(events.timestamp, np.memmap)
+    assert events.offsets[-1] == len(df)
+    for window in ['calendar', 'rolling']:
+        assert bundle_notifications.bundle(events, window=window).equals(
+            bundle_notifications.bundle(df, window=window))
+    assert bundle_notifications.bundle(events, n_jobs=2).equals(
+        bundle_notifications.bundle(df))
+    assert len(bundle_notifications.load_data(directory, nrows=10)) == 10
+
+    path_output = str(tmp_path / 'output.csv')
+    result = CliRunner().invoke(cli.main, ['-p', directory, '-o', path_output,
+                                           '-n', '5'])
+    assert result.exit_code == 0
+    assert pd.read_csv(path_output).shape[0] == \
+        bundle_notifications.bundle(df).shape[0]
+
+
+def test_dispatch(tmp_path):
+    """Test sending notifications to a local stub server"""
+
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from bundle_notifications.dispatch import dispatch
+
+    received = []
+    failures = [2]  # First requests fail with 503
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if failures[0] > 0 or self.path != '/push':
+                failures[0] -= 1
+                status = 503 if self.path == '/push' else 404
+            else:
+                status = 200
+                received.extend(json.loads(body))
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    df = bundle_notifications.bundle(fake_events(N=300, seed=17),
+                                     render=False)
+    stats = dispatch(df, url + '/push', concurrency=4, batch_size=7,
+                     backoff=0.01)
+    assert stats['delivered'] == len(df) == len(received)
+    assert stats['retries'] == 2 and stats['failed'] == 0
+    assert sorted(n['message'] for n in received) == sorted(
+        bundle_notifications.bundle(fake_events(N=300, seed=17)).message)
+
+    # Streams are accepted, other errors are not retried
+    stats = dispatch([df.iloc[:10], df.iloc[10:20]], url + '/missing',
+                     batch_size=4, rate_limit=1000)
+    assert stats['failed'] == 20 and stats['retries'] == 0
+
+    # CLI
+    path_csv = str(tmp_path / 'events.csv')
+    fake_events(N=100, seed=18).to_csv(path_csv, header=False, index=False)
+    result = CliRunner().invoke(cli.main, [
+        '-p', path_csv, '-o', str(tmp_path / 'output.csv'), '-n', '0',
+        '--dispatch', url + '/push', '--rate_limit', '500'])
+    assert result.exit_code == 0
+    assert 'Delivered' in result.output
+    server.shutdown()
+
+
+def test_auto_solver():
+    """Test the choice of the solver by number of events"""
+
+    from bundle_notifications import segments
+    from bundle_notifications.metrics import Metrics
+
+    # C(n-1, k-1) schedules of n events, without math.comb (Python 3.8)
+    assert list(optimal_delay.n_schedules(np.array([3, 8, 60, 8]), 4)) == \
+        [1.0, 35.0, 32509.0, 35.0]
+    assert optimal_delay.binomial(100, 50) == \
+        100891344545564193334812497256
+
+    rng = np.random.RandomState(19)
+
+    # Too many schedules to enumerate: the DP is used instead
+    t = np.sort(rng.randint(0, 10**6, 2000))
+    assert optimal_delay.count_schedules(2000, 4) > \
+        optimal_delay.ENUMERATE_MAX_SCHEDULES
+    assert np.all(optimal_delay.optimal_schedule(t, solver='enumerate') ==
+                  optimal_delay.total_delay_dp(t, 4))
+
+    for n in [5, 7, 12]:
+        t = np.sort(rng.randint(0, 10**6, n))
+        x = optimal_delay.optimal_schedule(t, solver='enumerate')
+        assert np.all(x == optimal_delay.total_delay_brute(t))
+        assert optimal_delay.delay(t, x) == optimal_delay.delay(
+            t, optimal_delay.optimal_schedule(t, solver='auto'))
+
+    ids = optimal_delay.auto_solvers(
+        np.array([3, 8, 9, 100, 10**4, 10**6]), 4)
+    assert list(ids) == [optimal_delay.SOLVERS[s] for s in [
+        'enumerate', 'enumerate', 'dp', 'dp', 'bucketed', 'bucketed']]
+    ids = optimal_delay.auto_solvers(np.array([100, 10**4, 10**6]), 4, {
+        'enumerate': 35, 'dp': 5000, 'local_search': 20000})
+    assert list(ids) == [optimal_delay.SOLVERS[s] for s in [
+        'dp', 'local_search', 'bucketed']]
+
+    # Guarantees: exact up to 'dp' events, within the bucketed bound above
+    for n in [optimal_delay.AUTO_THRESHOLDS['dp'],
+              optimal_delay.AUTO_THRESHOLDS['dp'] + 1]:
+        t = np.sort(rng.randint(0, 86400 * 10**9, n)).astype(np.int64)
+        optimum = exact_delay(t, optimal_delay.total_delay_dp(t, 4))
+        bound = 0 if n <= optimal_delay.AUTO_THRESHOLDS['dp'] else \
+            n * ((t[-1] - t[0]) // optimal_delay.BUCKETS + 1)
+        assert optimum <= exact_delay(t, optimal_delay.optimal_schedule(
+            t, solver='auto')) <= optimum + bound
+
+    df = fake_events(N=600, n_days=2, seed=20)
+    m = Metrics()
+    df_auto = bundle_notifications.bundle(df, solver='auto', metrics=m)
+    assert m.settings['auto_dp_max'] == optimal_delay.AUTO_THRESHOLDS['dp']
+    assert m.counters['auto_enumerate'] + m.counters['auto_dp'] == \
+        m.counters['user_days_large'] > 0
+
+    # Exact for all these user-days, like the DP
+    assert df_auto.equals(bundle_notifications.bundle(df, solver='dp'))
+
+    # Thresholds can be tuned
+    events = bundle_notifications.EventTable.from_frame(df)
+    order = segments.segment_order(events.user_code,
+                                   events.timestamp // segments.DAY_NS,
+                                   events.timestamp)
+    t = events.timestamp[order]
+    offsets = segments.segment_offsets(events.user_code[order],
+                                       t // segments.DAY_NS)
+    local = bundle_notifications.solve_auto(
+        t, events.friend_code[order], offsets[:-1], offsets[1:],
+        thresholds={'enumerate': 0, 'dp': 0, 'local_search': 10**6})
+    expected = bundle_notifications.solve_batches(
+        t, events.friend_code[order], offsets[:-1], offsets[1:])
+    assert all(np.all(a == b) for a, b in zip(local, expected))
+
+
+def test_bucketed_solver():
+    """Test the error bound of the approximate solver"""
+
+    rng = np.random.RandomState(21)
+    for n, buckets in [(50, 4), (3000, 16), (3000, 1024)]:
+        t = np.sort(rng.randint(0, 86400, n)).astype(np.int64)
+        x = optimal_delay.total_delay_bucketed(t, 4, buckets, 0)
+        assert len(x) <= 4 and x[-1] == n - 1
+        optimum = optimal_delay.delay(t, optimal_delay.total_delay_dp(t, 4))
+        approx = optimal_delay.delay(t, x)
+        assert optimum <= approx <= optimum + n * (t[-1] - t[0]) / buckets
+
+        # Refining can only improve
+        assert optimal_delay.delay(t, optimal_delay.optimal_schedule(
+            t, solver='bucketed')) <= approx
+
+    # The bound holds at the sizes the solver is meant for, in nanoseconds
+    N = 10**6
+    t = np.sort(rng.randint(0, 86400 * 10**9, N)).astype(np.int64)
+    unit = optimal_delay.time_unit(t - t[0])
+    x = optimal_delay.optimal_schedule(t, solver='bucketed')
+    optimum = exact_delay(t, optimal_delay.total_delay_dp(t, 4))
+    assert exact_delay(t, x) <= optimum + N * (
+        (t[-1] - t[0]) // optimal_delay.BUCKETS + 2 * unit)
+
+    df = fake_events(N=300, seed=22)
+    assert bundle_notifications.bundle(df, solver='bucketed').shape[0] == \
+        bundle_notifications.bundle(df, solver='dp').shape[0]
+
+
+def test_partitioned(tmp_path):
+    """Test that bundling on-disk partitions matches bundling all events"""
+
+    from bundle_notifications.metrics import Metrics
+    from bundle_notifications.partitioned import bundle_partitioned, \
+        partition_events
+
+    df = fake_events(N=800, n_days=3, seed=22)
+    # Unsorted input: partitions do not need the events in time order
+    df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    chunks = [df.iloc[i:i+150] for i in range(0, len(df), 150)]
+    columns = ['receiver_id', 'notification_sent']
+
+    def sort(df_out):
+        return df_out.sort_values(columns).reset_index(drop=True)
+
+    for window in ['calendar', 'rolling']:
+        metrics = Metrics()
+        df_part = pd.concat(bundle_partitioned(
+            chunks, n_partitions=4, window=window, directory=str(tmp_path),
+            metrics=metrics), ignore_index=True)
+        assert sort(df_part).equals(
+            sort(bundle_notifications.bundle(df, window=window)))
+        assert 1 < metrics.counters['partitions'] <= 4
+    assert list(tmp_path.iterdir()) == [], 'Partitions were not removed'
+
+    # One append-only file per partition, whatever the number of chunks
+    counts = partition_events(chunks, str(tmp_path), 4)
+    assert counts.sum() == len(df)
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        [f'{p}.bin' for p in np.flatnonzero(counts)]
+    assert (tmp_path / '0.bin').stat().st_size == 20 * counts[0]
+    for path in tmp_path.iterdir():
+        path.unlink()
+
+    with pytest.raises(ValueError, match='largest partition'):
+        list(bundle_partitioned(chunks, n_partitions=4,
+                                max_events=counts.max() - 1))
+
+    path_csv = str(tmp_path / 'events.csv')
+    df.to_csv(path_csv, header=False, index=False)
+    path_output = str(tmp_path / 'output.csv')
+    result = CliRunner().invoke(cli.main, [
+        '-p', path_csv, '-o', path_output, '--partitions', '3', '-c', '100',
+        '-n', '5'])
+    assert result.exit_code == 0
+    assert len(pd.read_csv(path_output)) == \
+        len(bundle_notifications.bundle(df))
+
+
+def test_presorted():
+    """Test that sorted inputs are detected and bundled without a full sort"""
+
+    from bundle_notifications import segments
+    from bundle_notifications.events import EventTable
+    from bundle_notifications.metrics import Metrics
+
+    df = fake_events(N=500, n_days=3, seed=23)
+    by_time = df.sort_values('timestamp', kind='stable')
+    by_user = df.sort_values(['user_id', 'timestamp'], kind='stable')
+    shuffled = df.sample(frac=1, random_state=1)
+    expected = bundle_notifications.bundle(shuffled)
+
+    for events, order in [(by_user, 'user'), (by_time, 'time'),
+                          (shuffled, 'none')]:
+        table = EventTable.from_frame(events)
+        assert segments.presorted(table.user_code, table.timestamp) == \
+            (order == 'user', order == 'time')
+        for window in ['calendar', 'rolling']:
+            metrics = Metrics()
+            df_out = bundle_notifications.bundle(events, window=window,
+                                                 metrics=metrics)
+            assert metrics.settings['input_order'] == order
+            assert df_out.equals(bundle_notifications.bundle(
+                shuffled, window=window))
+        assert bundle_notifications.bundle(events).equals(expected)
+
+        day = table.timestamp // segments.DAY_NS
+        order = segments.segment_order(table.user_code, day, table.timestamp)
+        assert np.array_equal(order, np.lexsort(
+            (table.timestamp, day, table.user_code)))
+
+
+def test_clean_events(tmp_path):
+    """Test that duplicate, burst and invalid events are dropped"""
+
+    from bundle_notifications.cleaning import clean_events
+    from bundle_notifications.events import EventTable
+    from bundle_notifications.metrics import Metrics
+
+    df = fake_events(N=300, n_days=2, seed=24)
+    # At-least-once delivery: some events twice, one a few seconds later
+    burst = df.iloc[:5].assign(
+        timestamp=df.timestamp.iloc[:5] + pd.Timedelta(seconds=30))
+    invalid = df.iloc[:2].assign(user_id=np.nan)
+    dirty = pd.concat([df, df.iloc[:20], burst, invalid],
+                      ignore_index=True).sort_values('timestamp')
+
+    events = EventTable.from_frame(dirty)
+    cleaned, counts = clean_events(events)
+    assert counts == {'invalid_events': 2, 'duplicate_events': 20,
+                      'burst_events': 0}
+    assert len(cleaned) == len(df) + 5
+    assert np.all(np.diff(cleaned.timestamp) >= 0), 'Order not kept'
+
+    metrics = Metrics()
+    cleaned, counts = clean_events(events, burst=60, metrics=metrics)
+    assert counts['burst_events'] == 5 and len(cleaned) == len(df)
+    assert metrics.counters['duplicate_events'] == 20
+
+    expected = bundle_notifications.bundle(df)
+    assert bundle_notifications.bundle(dirty, dedup=60).equals(expected)
+    assert bundle_notifications.bundle(df, dedup=0).equals(expected)
+
+    path_csv = str(tmp_path / 'events.csv')
+    dirty.to_csv(path_csv, header=False, index=False)
+    path_output = str(tmp_path / 'output.csv')
+    for options in [[], ['-c', '100']]:
+        result = CliRunner().invoke(cli.main, [
+            '-p', path_csv, '-o', path_output, '--dedup', '60', '-n', '5'] +
+            options)
+        assert result.exit_code == 0
+        assert len(pd.read_csv(path_output)) == len(expected)
+
+
+def test_memory_limit(tmp_path, monkeypatch):
+    """Test the choice of in-memory or out-of-core bundling from a limit"""
+
+    from bundle_notifications import memory
+    from bundle_notifications.metrics import Metrics, current_rss_mb
+
+    df = fake_events(N=2000, seed=25)
+    path_csv = str(tmp_path / 'events.csv')
+    df.to_csv(path_csv, header=False, index=False)
+    assert abs(memory.estimate_rows(path_csv) - len(df)) < 0.05 * len(df)
+    path_parquet = str(tmp_path / 'events.parquet')
+    df.to_parquet(path_parquet)
+    assert memory.estimate_rows(path_parquet) == len(df)
+
+    assert memory.plan_memory(10**6, 1024, used=200)['mode'] == 'memory'
+    plan = memory.plan_memory(10**8, 1024, used=200)
+    assert plan['mode'] == 'partitioned'
+    assert plan['estimated_mb'] <= plan['budget_mb']
+    assert plan['chunksize'] * memory.CHUNK_BYTES_PER_ROW <= 760 * 1024**2
+    with pytest.raises(ValueError):
+        memory.plan_memory(10**6, 100, used=200)
+
+    metrics = Metrics(memory_limit=1)
+    with metrics.stage('load'):
+        pass
+    assert metrics.settings['memory_limit_exceeded'] == 'load'
+
+    # Events 40 times bigger than measured do not fit above the memory in
+    # use, which forces out-of-core bundling
+    path_output = str(tmp_path / 'output.csv')
+    limit = current_rss_mb() + memory.RESERVE_MB + 10
+    monkeypatch.setattr(memory, 'BYTES_PER_EVENT',
+                        40 * memory.BYTES_PER_EVENT)
+    for options, mode in [(['--memory_limit', str(limit)], 'partitions'),
+                          (['--memory_limit', '100000', '--profile'],
+                           'in memory')]:
+        result = CliRunner().invoke(cli.main, [
+            '-p', path_csv, '-o', path_output, '-n', '5'] + options)
+        assert result.exit_code == 0
+        assert mode in result.output
+        assert 'peak memory' in result.output.lower()
+        assert len(pd.read_csv(path_output)) == \
+            len(bundle_notifications.bundle(df))
+
+    # Out of core, Feather inputs are read in chunks too
+    path_feather = str(tmp_path / 'events.feather')
+    df.to_feather(path_feather, chunksize=500)
+    monkeypatch.setattr(pd, 'read_feather', None)
+    limit = current_rss_mb() + memory.RESERVE_MB + 10
+    result = CliRunner().invoke(cli.main, [
+        '-p', path_feather, '-o', path_output, '--memory_limit', str(limit)])
+    assert result.exit_code == 0 and 'partitions' in result.output
+    assert len(pd.read_csv(path_output)) == \
+        len(bundle_notifications.bundle(df))
+
+
+def test_memory_estimates(tmp_path):
+    """Test estimating inputs without reading them, and shrinking chunks"""
+
+    import subprocess
+    import sys
+    import threading
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    import pyarrow as pa
+    from bundle_notifications import memory
+    from bundle_notifications.metrics import Metrics, current_rss_mb
+
+    # 160 MB of compressed batches: counting them must not decompress all
+    path_feather = str(tmp_path / 'events.feather')
+    batch = pa.record_batch([pa.array(np.zeros(10**5, dtype=np.int64))] * 4,
+                            names=['a', 'b', 'c', 'd'])
+    options = pa.ipc.IpcWriteOptions(compression='lz4')
+    with pa.OSFile(path_feather, 'wb') as sink:
+        with pa.ipc.new_file(sink, batch.schema, options=options) as writer:
+            for _ in range(50):
+                writer.write_batch(batch)
+    script = ('import resource; import pyarrow\n'
+              'from bundle_notifications.memory import estimate_rows\n'
+              'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+              f'n = estimate_rows({path_feather!r})\n'
+              'after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+              'print(n, (after - before) // 1024)')
+    n_rows, growth_mb = map(int, subprocess.run(
+        [sys.executable, '-c', script], check=True, capture_output=True,
+        text=True).stdout.split())
+    assert n_rows == 50 * 10**5
+    assert growth_mb < 40
+
+    # Size and first lines of a remote csv file
+    df = fake_events(N=2000, seed=26)
+    df.to_csv(tmp_path / 'events.csv', header=False, index=False)
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                 partial(Handler, directory=str(tmp_path)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    assert abs(memory.estimate_rows(url + '/events.csv') - len(df)) < \
+        0.05 * len(df)
+    assert memory.estimate_rows(url + '/missing.csv') is None
+    server.shutdown()
+
+    # Without memory left under the limit, chunks shrink to the minimum
+    path_csv = str(tmp_path / 'events.csv')
+    metrics = Metrics()
+    limit = current_rss_mb() + memory.RESERVE_MB
+    chunks = list(memory.adaptive_chunks(
+        bundle_notifications.load_data(path_csv, chunksize=100), limit,
+        1500, metrics=metrics))
+    assert [len(chunk) for chunk in chunks[:2]] == \
+        [1500, min(len(df) - 1500, memory.MIN_CHUNKSIZE)]
+    assert pd.concat(chunks).equals(bundle_notifications.load_data(path_csv))
+    assert metrics.counters['chunk_resizes'] == 1
+    assert metrics.settings['memory_chunksize'] == memory.MIN_CHUNKSIZE